@@ -4,23 +4,44 @@
 import sys
 from src.Connector import Connector
 from src.ConnectorException import ConnectorException
+from src.UploadResult import UploadResult
+from src.JobRunner import JobRunner
 
 
 def main():
     try:
         args = sys.argv
+        if len(args) > 2 and args[1] == "--jobs":
+            runJobs(args[2])
+            return
         connector = Connector()
-        connector.login()
-        if len(args) > 1:
-            response = connector.upload(args[1])
-        else:
-            response = connector.upload()
+        try:
+            connector.login()
+            if len(args) > 1:
+                response = connector.upload(args[1])
+            else:
+                response = connector.upload()
+        finally:
+            connector.close()
         print(response)
+        if isinstance(response, UploadResult) and not response.ok:
+            sys.exit(1)
     except ConnectorException as e:
         print(e)
         sys.exit(1)
 
 
+def runJobs(jobsFile):
+    runner = JobRunner.load(jobsFile)
+    failed = False
+    for job, response in zip(runner.jobs, runner.run()):
+        print(job["source"] + ": " + str(response))
+        if isinstance(response, ConnectorException) or (isinstance(response, UploadResult) and not response.ok):
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
 # When the script is started, run the main function
 if __name__ == '__main__':
     main()
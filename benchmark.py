@@ -0,0 +1,211 @@
+# benchmark.py
+
+# Importing libraries
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import resource
+import multiprocessing
+import requests
+from src.Connector import Connector
+from src.ConnectorException import ConnectorException
+from src.FakeGraphServer import FakeGraphServer
+
+# Workloads available, with the description shown in the report
+WORKLOADS = {
+    "tiny": "many tiny files",
+    "huge": "one huge file",
+    "deep": "deep folder tree"
+}
+
+
+# Arguments parsing function. Returns the options of the benchmark
+def parseArguments(args):
+    parser = argparse.ArgumentParser(description="Measure the upload throughput against a local stand-in of OneDrive.")
+    parser.add_argument("--workloads", default="tiny,huge,deep", help="comma-separated workloads to run")
+    parser.add_argument("--files", type=int, default=2000, help="number of files of the tiny workload")
+    parser.add_argument("--size", type=int, default=256, help="size in MB of the file of the huge workload")
+    parser.add_argument("--depth", type=int, default=8, help="depth of the tree of the deep workload")
+    parser.add_argument("--latency", type=float, default=0, help="latency of every request, in milliseconds")
+    parser.add_argument("--throttle", type=float, default=0, help="share of the requests throttled")
+    parser.add_argument("--failures", type=float, default=0, help="share of the requests failed")
+    parser.add_argument("--setting", action="append", default=[], help="connector setting, as KEY=VALUE")
+    parser.add_argument("--output", help="file to write the results to, as JSON")
+    parser.add_argument("--baseline", help="results of a previous run to compare with, as JSON")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="slowdown allowed against the baseline")
+    return parser.parse_args(args)
+
+
+# Workload creation function. Writes the files of the given workload inside the given folder and returns their path
+def createWorkload(name, options, folder):
+    path = os.path.join(folder, name)
+    os.makedirs(path)
+    if name == "tiny":
+        for index in range(options.files):
+            subfolder = os.path.join(path, "group" + str(index // 100))
+            os.makedirs(subfolder, exist_ok=True)
+            with open(os.path.join(subfolder, "file" + str(index) + ".txt"), "wb") as f:
+                f.write(os.urandom(1024))
+    elif name == "huge":
+        block = os.urandom(1024 * 1024)
+        with open(os.path.join(path, "huge.bin"), "wb") as f:
+            for index in range(options.size):
+                f.write(block)
+    elif name == "deep":
+        current = path
+        for depth in range(options.depth):
+            current = os.path.join(current, "level" + str(depth))
+            os.makedirs(current)
+            for index in range(3):
+                with open(os.path.join(current, "file" + str(index) + ".bin"), "wb") as f:
+                    f.write(os.urandom(64 * 1024))
+    else:
+        raise ValueError("unknown workload " + name)
+    return path
+
+
+# Server function. Runs the stand-in server with the given options in its own process, so that its memory is not
+# counted with the one of the connector, and sends back its port
+def runServer(queue, latency, throttleRate, failureRate):
+    server = FakeGraphServer(latency=latency, throttleRate=throttleRate, failureRate=failureRate, hashContent=False)
+    server.start()
+    queue.put(server.port)
+    threading.Event().wait()
+
+
+# Resident memory function. Returns the current resident memory of the process, in bytes, or the peak one where the
+# current one cannot be read
+def getResidentMemory():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# Memory sampling function. Records the highest resident memory seen until the given event is set
+def sampleMemory(peak, stop):
+    while not stop.is_set():
+        peak[0] = max(peak[0], getResidentMemory())
+        stop.wait(0.02)
+
+
+# Workload running function. Uploads the given path through a new connector talking to the given server and returns
+# the measures taken
+def runWorkload(name, path, port, options, folder):
+
+    # Configure a connector for the stand-in server
+    env = os.path.join(folder, "benchmark.env")
+    with open(env, "w") as f:
+        f.write("FILENAME=" + path + "\nBLOCKSIZE=10\nCLIENTID=BENCHMARK\nCLIENTSECRET=BENCHMARK\n")
+        f.write("ACCESSTOKEN=BENCHMARK\nREFRESHTOKEN=BENCHMARK\n")
+        f.write("GRAPHURL=http://127.0.0.1:" + str(port) + "/v1.0\n")
+        f.write("TOKENURL=http://127.0.0.1:" + str(port) + "/common/oauth2/v2.0/token\n")
+        for setting in options.setting:
+            f.write(setting + "\n")
+    connector = Connector(env)
+
+    # Upload while sampling the memory
+    files = sum(len(names) for root, dirs, names in os.walk(path))
+    size = sum(os.path.getsize(os.path.join(root, name)) for root, dirs, names in os.walk(path) for name in names)
+    peak = [getResidentMemory()]
+    stop = threading.Event()
+    sampler = threading.Thread(target=sampleMemory, args=(peak, stop))
+    sampler.start()
+    started = time.monotonic()
+    try:
+        result = connector.upload(path)
+    finally:
+        elapsed = time.monotonic() - started
+        stop.set()
+        sampler.join()
+        connector.close()
+    stats = requests.get("http://127.0.0.1:" + str(port) + "/stats").json()
+
+    # Return the measures
+    return {
+        "workload": name,
+        "files": files,
+        "bytes": size,
+        "seconds": round(elapsed, 3),
+        "filesPerSecond": round(files / elapsed, 2),
+        "megabytesPerSecond": round(size / 1048576 / elapsed, 2),
+        "requests": stats["requests"],
+        "throttled": stats["throttled"],
+        "failed": stats["failed"],
+        "peakMemory": peak[0],
+        "result": str(result)
+    }
+
+
+# Comparison function. Returns the messages describing the workloads that got slower than the baseline by more than
+# the given tolerance
+def compare(results, baseline, tolerance):
+    previous = {entry["workload"]: entry for entry in baseline}
+    regressions = []
+    for entry in results:
+        before = previous.get(entry["workload"])
+        if before is None:
+            continue
+        for measure in ("filesPerSecond", "megabytesPerSecond"):
+            if entry[measure] < before[measure] * (1 - tolerance):
+                regressions.append(entry["workload"] + ": " + measure + " dropped from " + str(before[measure]) +
+                                   " to " + str(entry[measure]))
+    return regressions
+
+
+# Report function. Prints a line with the measures of every workload
+def report(results):
+    print("{:<18} {:>8} {:>10} {:>9} {:>10} {:>9} {:>10} {:>10}".format(
+        "workload", "files", "MB", "seconds", "files/s", "MB/s", "requests", "peak MB"))
+    for entry in results:
+        print("{:<18} {:>8} {:>10.1f} {:>9.2f} {:>10.1f} {:>9.1f} {:>10} {:>10.1f}".format(
+            WORKLOADS[entry["workload"]], entry["files"], entry["bytes"] / 1048576, entry["seconds"],
+            entry["filesPerSecond"], entry["megabytesPerSecond"], entry["requests"], entry["peakMemory"] / 1048576))
+
+
+def main():
+    options = parseArguments(sys.argv[1:])
+    results = []
+    try:
+        for name in options.workloads.split(","):
+            with tempfile.TemporaryDirectory() as folder:
+                path = createWorkload(name, options, folder)
+
+                # Start a new server for every workload, so that every one starts from an empty drive
+                queue = multiprocessing.Queue()
+                server = multiprocessing.Process(target=runServer, daemon=True, args=(
+                    queue, options.latency / 1000, options.throttle, options.failures))
+                server.start()
+                try:
+                    results.append(runWorkload(name, path, queue.get(timeout=10), options, folder))
+                finally:
+                    server.terminate()
+    except (ConnectorException, ValueError) as e:
+        print(e)
+        sys.exit(1)
+
+    # Show and save the results, then compare them with the baseline, if any
+    report(results)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if options.baseline:
+        with open(options.baseline) as f:
+            regressions = compare(results, json.load(f), options.tolerance)
+        for regression in regressions:
+            print("Regression: " + regression)
+        if regressions:
+            sys.exit(1)
+
+
+# When the script is started, run the main function
+if __name__ == '__main__':
+    main()
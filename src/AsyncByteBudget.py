@@ -0,0 +1,26 @@
+# AsyncByteBudget.py
+
+# Importing libraries
+import asyncio
+
+
+class AsyncByteBudget:
+
+    # Object constructor. Sets the maximum amount of bytes that can be in flight at the same time on an event loop
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = asyncio.Condition()
+
+    # Acquire method. Waits until the given amount of bytes fits into the budget. A single request larger than the
+    # whole budget is let through when nothing else is in flight, so that it can never wait forever
+    async def acquire(self, size):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.used == 0 or self.used + size <= self.limit)
+            self.used += size
+
+    # Release method. Gives back the given amount of bytes and wakes up the waiting transfers
+    async def release(self, size):
+        async with self.condition:
+            self.used -= size
+            self.condition.notify_all()
@@ -0,0 +1,62 @@
+# AsyncConcurrencyLimiter.py
+
+# Importing libraries
+import time
+import asyncio
+
+
+class AsyncConcurrencyLimiter:
+
+    # Object constructor. Sets the maximum number of requests in flight at the same time on an event loop. The actual
+    # limit starts from the maximum, is halved when the server throttles and grows back by one after a full round of
+    # successes
+    def __init__(self, maximum, cooldown=1.0):
+        self.maximum = maximum
+        self.limit = maximum
+        self.cooldown = cooldown
+        self.active = 0
+        self.successes = 0
+        self.lastDecrease = 0.0
+        self.resumeAt = 0.0
+        self.condition = asyncio.Condition()
+
+    # Acquire method. Waits while the limit is reached or while the server asked to pause
+    async def acquire(self):
+        async with self.condition:
+            while True:
+                wait = self.resumeAt - time.monotonic()
+                if wait <= 0 and self.active < self.limit:
+                    break
+                try:
+                    await asyncio.wait_for(self.condition.wait(), wait if wait > 0 else None)
+                except asyncio.TimeoutError:
+                    pass
+            self.active += 1
+
+    # Release method. Frees a slot and wakes up the waiting transfers
+    async def release(self):
+        async with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    # Success method. Additive increase: the limit grows by one every time as many requests as the limit succeed
+    async def onSuccess(self):
+        async with self.condition:
+            if self.limit < self.maximum:
+                self.successes += 1
+                if self.successes >= self.limit:
+                    self.limit += 1
+                    self.successes = 0
+                    self.condition.notify_all()
+
+    # Throttle method. Multiplicative decrease: the limit is halved, at most once per cooldown so that a burst of
+    # throttled responses counts once, and every request waits for the time asked by the server, if any
+    async def onThrottle(self, retryAfter=None):
+        async with self.condition:
+            now = time.monotonic()
+            if now - self.lastDecrease >= self.cooldown:
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+                self.lastDecrease = now
+            if retryAfter is not None:
+                self.resumeAt = max(self.resumeAt, now + retryAfter)
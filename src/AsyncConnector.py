@@ -0,0 +1,406 @@
+# AsyncConnector.py
+
+# Importing libraries
+import os
+import json
+import mmap
+import time
+import asyncio
+import hashlib
+import aiohttp
+from .Connector import Connector
+from .ConnectorException import ConnectorException
+from .UploadResult import UploadResult
+from .AsyncByteBudget import AsyncByteBudget
+from .AsyncConcurrencyLimiter import AsyncConcurrencyLimiter
+from .RetryPolicy import RetryPolicy
+from .ThrottledBody import ThrottledBody
+from .ChunkPrefetcher import ChunkPrefetcher
+from .FileScanner import FileScanner
+from urllib.parse import quote
+
+
+class AsyncConnector(Connector):
+
+    # Object constructor. Reads the configuration from the given file, or from the .env file of the script if not
+    # given, exactly like the blocking connector. If another connector of the same account is given, its token,
+    # connection pool and local stores are shared and, if it is an asynchronous one too, so are its HTTP client and its
+    # limit of the requests in flight. The HTTP client and the primitives bound to the event loop are created on first
+    # use, inside the loop that runs the uploads
+    def __init__(self, envFile="", account=None):
+        super().__init__(envFile, account)
+        self.account = account if isinstance(account, AsyncConnector) else None
+        self.client = None
+        self.asyncByteBudget = None
+        self.asyncConcurrency = None
+
+    # Context manager entry. Returns the connector itself
+    async def __aenter__(self):
+        return self
+
+    # Context manager exit. Closes the HTTP client
+    async def __aexit__(self, excType, exc, traceback):
+        await self.close()
+
+    # Close method. Closes the HTTP client and its connections, and stops the processes hashing the files, unless they
+    # are shared with another connector of the same account, which closes them instead
+    async def close(self):
+        super().close()
+        if self.client is not None and self.account is None:
+            await self.client.close()
+        self.client = None
+
+    # Login method. Runs the interactive login of the blocking connector without blocking the event loop
+    async def login(self):
+        await asyncio.to_thread(super().login)
+
+    # Token renewal method. Exchanges the refresh token for a new token pair, unless the given access token has already
+    # been replaced in the meantime. The exchange is left to the token manager in a separate thread, so that only one
+    # renewal runs at a time across the transfers of the event loop and the refreshes started in background
+    async def renewToken(self, expiredToken=None):
+        try:
+            token = await asyncio.to_thread(self.tokenManager.refresh, expiredToken)
+            self.logger.info("Token has been refreshed")
+            return token
+        except Exception as e:
+            raise ConnectorException("Error while exchanging tokens: " + str(e))
+
+    # Token method. Returns the access token to use, waiting for a new one without blocking the event loop if the
+    # current one has already expired
+    async def __getToken(self):
+        if 0 < self.tokenManager.expiresAt <= time.time():
+            return await self.renewToken(self.tokenManager.accessToken)
+        return self.token
+
+    # Upload method. Uploads the given path, or the configured one, into the given remote folder, or the configured
+    # one, running every transfer on the event loop
+    async def upload(self, requiredPath="", destination=None):
+
+        # Find the path to upload and the remote folder, and prepare the chunk size shared by all the transfers
+        path = self._resolvePath(requiredPath)
+        self._resolveDestination(destination)
+        self._prepareChunkSizer()
+        self._prepareMetrics()
+        await self.__prepare()
+        try:
+
+            # If configured path is a directory, let's call directory upload method
+            if os.path.isdir(path):
+                return await self.__uploadDirectory(path)
+
+            # If configured path is a file, let's call file upload method
+            elif os.path.isfile(path):
+                return await self.__uploadFile(path)
+
+            # If configured filename is a special file, exit with an error
+            else:
+                raise ConnectorException("Configured FILENAME is invalid")
+        finally:
+            self._exportMetrics(True)
+
+    # Preparation method. Creates the HTTP client and the primitives bound to the running event loop, if not done yet.
+    # The client and the limit of the requests in flight of another connector of the same account are shared, since
+    # the server throttles the whole account
+    async def __prepare(self):
+        if self.client is None:
+            if self.account is not None:
+                await self.account.__prepare()
+                self.client = self.account.client
+                self.asyncConcurrency = self.account.asyncConcurrency
+            else:
+                poolSize = int(self.poolSize) if self.poolSize != "" else max(10, int(self.workers) * 2)
+                self.client = aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(limit=poolSize),
+                    timeout=aiohttp.ClientTimeout(sock_connect=int(self.timeout), sock_read=int(self.timeout)))
+                self.asyncConcurrency = AsyncConcurrencyLimiter(int(self.workers))
+            self.asyncByteBudget = AsyncByteBudget(int(self.maxInFlight) * 1024 * 1024)
+
+    # Upload directory method. Mirrors the folder tree, then uploads every file as its own task, keeping at most the
+    # configured number of transfers running at the same time
+    async def __uploadDirectory(self, path):
+        try:
+            self.logger.debug("Path that was requested to upload is a directory. Let's upload it.")
+            await self.__createFolderTree(path)
+
+            # Start the transfers while the tree is scanned in background, waiting for a free slot before starting the
+            # next one
+            result = UploadResult()
+            slots = asyncio.Semaphore(int(self.workers))
+            tasks = set()
+            folders = iter(FileScanner(path, onFolder=lambda root, files: self._indexFolder(path, root, files),
+                                       logger=self.logger))
+            try:
+                while (scanned := await asyncio.to_thread(next, folders, None)) is not None:
+                    root, files = scanned
+                    folder = self._getRemoteFolder(path, root) + "/"
+                    for name, stat in files:
+                        await slots.acquire()
+                        task = asyncio.create_task(self.__uploadDirectoryFile(os.path.join(root, name), folder, result))
+                        task.add_done_callback(lambda t: slots.release())
+                        tasks.add(task)
+                        task.add_done_callback(tasks.discard)
+            finally:
+                folders.close()
+            await asyncio.gather(*tasks)
+
+            # Return the aggregated result
+            self.logger.info("%s", result)
+            return result
+        except ConnectorException:
+            raise
+        except Exception as e:
+            raise ConnectorException("Error while uploading directory files: " + str(e))
+
+    # Upload directory file method. Transfers one file of a directory upload, recording the outcome instead of raising
+    async def __uploadDirectoryFile(self, filePath, folder, result):
+        try:
+            remotePath = folder + os.path.basename(filePath)
+            if await asyncio.to_thread(self._isUnchanged, filePath, remotePath):
+                result.addSkipped(filePath)
+                self.telemetry.fileFinished(filePath, "skipped")
+                return
+            stat = os.stat(filePath)
+            self.telemetry.fileStarted(filePath, stat.st_size)
+            _, fileHash = await self.__transferFile(filePath, os.path.basename(filePath), folder)
+            await asyncio.to_thread(self._recordUpload, filePath, remotePath, stat, fileHash)
+            result.addUploaded(filePath, stat.st_size)
+            self.telemetry.fileFinished(filePath, "uploaded")
+        except Exception as e:
+            result.addFailed(filePath, e)
+            self.telemetry.fileFinished(filePath, "failed", e)
+
+    # Upload file method. Transfers a single file to the remote root folder
+    async def __uploadFile(self, path):
+        try:
+            self.logger.debug("Path that was requested to upload is a file. Let's upload it.")
+            folder = self._getDestinationPrefix()
+            self.telemetry.addPending(os.path.getsize(path))
+            if await asyncio.to_thread(self._isUnchanged, path, folder + os.path.basename(path)):
+                message = "File is unchanged since the last upload: nothing to do"
+                self.logger.info(message)
+                self.telemetry.fileFinished(path, "skipped")
+                return message
+            if folder != "":
+                await self.__createFolderTree("")
+            stat = os.stat(path)
+            self.telemetry.fileStarted(path, stat.st_size)
+            chunks, fileHash = await self.__transferFile(path, os.path.basename(path), folder)
+            await asyncio.to_thread(self._recordUpload, path, folder + os.path.basename(path), stat, fileHash)
+            message = "Upload completed with " + str(chunks) + " chunk(s)"
+            self.logger.info(message)
+            self.telemetry.fileFinished(path, "uploaded")
+            return message
+        except Exception as e:
+            self.telemetry.fileFinished(path, "failed", e)
+            if isinstance(e, ConnectorException):
+                raise
+            raise ConnectorException("Error while uploading single file: " + str(e))
+
+    # Folder tree creation method. Mirrors the destination folder and the local folder tree, if any, level by level,
+    # creating the sibling folders of each level concurrently. The tree is read in a separate thread, so that the
+    # event loop is not blocked while it is walked
+    async def __createFolderTree(self, path):
+        levels = await asyncio.to_thread(self._getFolderLevels, path)
+        self.folderIds = {}
+        for depth in sorted(levels):
+            creations = []
+            for folder in levels[depth]:
+                parent, _, name = folder.rpartition("/")
+                creations.append(self.__createFolder(name, parent))
+            await asyncio.gather(*creations)
+
+    # Folder creation method. Creates a remote folder inside the given parent folder (the root if empty), or looks it
+    # up if it already exists, and caches its id for the creation of its subfolders
+    async def __createFolder(self, name, parent=""):
+        path = parent + "/" + name if parent != "" else name
+        resource = "/drive/items/" + self.folderIds[parent] + "/children" if parent != "" else "/drive/root/children"
+        data = {
+            'name': name,
+            'folder': {},
+            '@microsoft.graph.conflictBehavior': 'fail'
+        }
+        try:
+            body = await self.__callGraph("POST", resource, data)
+        except ConnectorException as e:
+            if e.code != "nameAlreadyExists":
+                raise
+            body = await self.__callGraph("GET", "/drive/root:/" + quote(path))
+        self.folderIds[path] = body["id"]
+        return body["name"]
+
+    # File transfer method. Sends small files with a single request and larger ones through a (possibly resumed)
+    # upload session. Returns the number of requests used to transfer the content and, in incremental mode, the SHA1
+    # digest of the content sent
+    async def __transferFile(self, filePath, fileName, folder=""):
+        fileSize = os.path.getsize(filePath)
+        if fileSize <= int(self.smallFileSize) * 1024 * 1024:
+            await self.asyncByteBudget.acquire(fileSize)
+            try:
+                data = await asyncio.to_thread(self.__readFile, filePath)
+                headers = {
+                    "Content-Length": str(len(data)),
+                    "Content-Type": "application/octet-stream"
+                }
+                await self.__callAPI("PUT", self.graphUrl + "/drive/root:/" + quote(folder + fileName) + ":/content",
+                                     self.__streamRange(data, 0, len(data)), headers)
+                self.telemetry.chunkSent(filePath, fileSize, fileSize, fileSize)
+                return 1, hashlib.sha1(data).hexdigest() if self.incremental == "true" else None
+            finally:
+                await self.asyncByteBudget.release(fileSize)
+        uploadUrl, offset = await self.__openUploadSession(filePath, fileName, folder)
+        return await self.__uploadBytes(filePath, uploadUrl, offset)
+
+    # File reading method. Returns the whole content of the given file. Called in a separate thread, so that the event
+    # loop is not blocked while the file is read
+    def __readFile(self, filePath):
+        with open(filePath, "rb") as f:
+            return f.read()
+
+    # Upload session opening method. Resumes the session recorded in the journal for the given file, if still valid,
+    # otherwise requests a new one. Returns the upload url and the offset to start from. The journal is accessed in a
+    # separate thread, like every other local store
+    async def __openUploadSession(self, filePath, fileName, folder=""):
+        stat = os.stat(filePath)
+        session = await asyncio.to_thread(self.journal.find, os.path.abspath(filePath), folder + fileName, stat.st_size,
+                                          stat.st_mtime)
+        if session is not None:
+            try:
+                body = await self.__callAPI("GET", session[0], None, {}, authorize=False)
+                return session[0], self._getNextOffset(body, 0)
+            except ConnectorException:
+                await asyncio.to_thread(self.journal.remove, session[0])
+        body = await self.__callGraph("POST", "/drive/root:/" + quote(folder + fileName) + ":/createUploadSession", {})
+        await asyncio.to_thread(self.journal.save, os.path.abspath(filePath), folder + fileName, stat.st_size,
+                                stat.st_mtime, body["uploadUrl"], body.get("expirationDateTime", ""))
+        return body["uploadUrl"], 0
+
+    # Bytes transfer method. Sends a memory-mapped file to the given upload url chunk after chunk, starting from the
+    # given offset, recording every acknowledged chunk in the journal and recovering failed chunks from the range
+    # expected by the server. Each chunk is streamed in small slices, so that the event loop is never blocked by a
+    # large write and the memory held by a transfer stays bounded. Like the blocking connector, the next chunks are
+    # read ahead (and hashed, in incremental mode) in background. Returns the number of chunks sent and the SHA1
+    # digest of the file, if computed
+    async def __uploadBytes(self, filePath, uploadUrl, offset=0):
+        with open(filePath, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+            prefetcher = ChunkPrefetcher(mapping, self.incremental == "true", offset)
+            try:
+                chunks = await self.__uploadMapping(filePath, mapping, uploadUrl, offset, prefetcher)
+                fileHash = await asyncio.to_thread(prefetcher.digest)
+            finally:
+                await asyncio.to_thread(prefetcher.close)
+        await asyncio.to_thread(self.journal.remove, uploadUrl)
+        return chunks, fileHash
+
+    # Mapping transfer method. Sends the chunks of a memory-mapped file one after the other, keeping the configured
+    # number of chunks read ahead, and returns the number of chunks sent
+    async def __uploadMapping(self, filePath, mapping, uploadUrl, offset, prefetcher):
+        fileSize = len(mapping)
+        depth = int(self.pipelineDepth)
+        chunks = 0
+        recoveries = 0
+        while offset < fileSize:
+            length = min(self.chunkSizer.size, fileSize - offset)
+            if depth > 0:
+                prefetcher.prefetch(offset + length + self.chunkSizer.size * depth)
+            await self.asyncByteBudget.acquire(length)
+            try:
+                started = time.monotonic()
+                headers = {
+                    "Content-Length": str(length),
+                    "Content-Range": "bytes " + str(offset) + "-" + str(offset + length - 1) + "/" + str(fileSize)
+                }
+                body = await self.__callAPI("PUT", uploadUrl, self.__streamRange(mapping, offset, length), headers)
+                self.chunkSizer.onSuccess(length, time.monotonic() - started)
+            except ConnectorException:
+                self.chunkSizer.onFailure()
+                if recoveries >= self.retryPolicy.maxRetries:
+                    raise
+                recoveries += 1
+                offset = self._getNextOffset(await self.__callAPI("GET", uploadUrl, None, {}, authorize=False), 0)
+                continue
+            finally:
+                await self.asyncByteBudget.release(length)
+            self.telemetry.chunkSent(filePath, length, offset + length, fileSize)
+            offset = self._getNextOffset(body, offset + length)
+            await asyncio.to_thread(self.journal.update, uploadUrl, offset)
+            chunks += 1
+        return chunks
+
+    # Range streaming method. Returns a function building a fresh stream of the given range of a memory-mapped file or
+    # of a buffer, so that the range can be sent again when a request is retried. If the upload speed is limited,
+    # every slice waits for the limiter before being sent
+    def __streamRange(self, mapping, offset, length):
+        async def stream():
+            for start in range(offset, offset + length, ThrottledBody.SLICE):
+                piece = mapping[start:min(start + ThrottledBody.SLICE, offset + length)]
+                delay = self.bandwidth.reserve(len(piece))
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                yield piece
+        return stream
+
+    # Graph call method. Sends a request to the given Graph API resource and returns the decoded body of the response
+    async def __callGraph(self, method, resource, data=None):
+        headers = {}
+        if data is not None:
+            headers["Content-Type"] = "application/json"
+            data = json.dumps(data)
+        body = await self.__callAPI(method, self.graphUrl + resource, data, headers)
+        return json.loads(body)
+
+    # API call method. Sends a request, retrying the transient failures as told by the retry policy and renewing the
+    # token when it expires, and returns the body of the response
+    async def __callAPI(self, method, url, data, headers, authorize=True):
+        attempt = 0
+        while True:
+
+            # Send the request with the current token
+            token = await self.__getToken()
+            if authorize:
+                headers["Authorization"] = "Bearer " + token
+            self.logger.debug("Sending request to endpoint %s", url)
+            status, retryAfter, body = await self.__sendRequest(method, url, data, headers)
+            if status is not None and status < 400:
+                await self.asyncConcurrency.onSuccess()
+                return body
+
+            # If the failure is transient, wait and send the request again. Throttling responses also reduce the number
+            # of requests allowed in flight, and make every transfer wait for the time asked by the server
+            if self.retryPolicy.canRetry(status, attempt):
+                retryAfter = RetryPolicy.parseRetryAfter(retryAfter)
+                if status in (429, 503):
+                    await self.asyncConcurrency.onThrottle(retryAfter)
+                    self.logger.info("Request throttled by the server (%d): reducing concurrency to %d", status,
+                                     self.asyncConcurrency.limit)
+                delay = self.retryPolicy.getDelay(attempt, retryAfter)
+                self.telemetry.retry(url, status, attempt, delay)
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+
+            # If the token is expired, renew it and send the request again, otherwise raise an exception
+            errorCode = self._getErrorCode(status, body)
+            if errorCode == "InvalidAuthenticationToken" and authorize and attempt < self.retryPolicy.maxRetries:
+                await self.renewToken(token)
+                attempt += 1
+                continue
+            raise ConnectorException("Error while calling endpoint: " + errorCode, errorCode)
+
+    # Request sending method. Waits for a slot among the requests in flight, then sends a single request and returns its
+    # status, its Retry-After header and its body. The status is None if the connection failed or timed out. If data is
+    # a function, the body is built by calling it
+    async def __sendRequest(self, method, url, data, headers):
+        await self.asyncConcurrency.acquire()
+        started = time.monotonic()
+        try:
+            body = data() if callable(data) else data
+            async with self.client.request(method, url, data=body, headers=headers) as response:
+                text = await response.text()
+                self._logResponse(response.status, text)
+                return response.status, response.headers.get("Retry-After"), text
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.logger.info("Connection to %s failed: %s", url, e)
+            return None, None, ""
+        finally:
+            await self.asyncConcurrency.release()
+            self.telemetry.requestDone(time.monotonic() - started)
@@ -0,0 +1,88 @@
+# BandwidthLimiter.py
+
+# Importing libraries
+import time
+import threading
+
+
+class BandwidthLimiter:
+
+    # Object constructor. Sets the maximum rate, in bytes per second (0 for no limit), the time-of-day schedule
+    # overriding it, as a list of (start, end, rate) windows with start and end in minutes after midnight, and the
+    # limiter shared with other transfers, if any, that every reservation is also charged to
+    def __init__(self, rate=0, schedule=None, parent=None):
+        self.rate = rate
+        self.schedule = schedule or []
+        self.parent = parent
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Schedule parsing method. Turns a schedule like "08:00-18:00=512,22:00-06:00=4096", with rates in KB per second,
+    # into the list of windows used by the limiter. Raises a ValueError if the schedule is not valid
+    @staticmethod
+    def parseSchedule(text):
+        schedule = []
+        for window in filter(None, (part.strip() for part in text.split(","))):
+            times, rate = window.split("=")
+            start, end = (BandwidthLimiter.__parseTime(value) for value in times.split("-"))
+            if not rate.strip().isdigit():
+                raise ValueError("invalid rate " + rate)
+            schedule.append((start, end, int(rate) * 1024))
+        return schedule
+
+    # Time parsing method. Returns the minutes after midnight of a time like "18:30"
+    @staticmethod
+    def __parseTime(value):
+        hours, minutes = value.strip().split(":")
+        if not 0 <= int(hours) < 24 or not 0 <= int(minutes) < 60:
+            raise ValueError("invalid time " + value)
+        return int(hours) * 60 + int(minutes)
+
+    # Configure method. Changes the rate and, if given, the schedule. Transfers already running follow the new
+    # settings from their next slice
+    def configure(self, rate, schedule=None):
+        with self.lock:
+            self.rate = rate
+            if schedule is not None:
+                self.schedule = schedule
+
+    # Current rate method. Returns the rate in force now: the one of the schedule window containing the current time,
+    # if any, or the configured one. A window ending before it starts goes past midnight, and a window ending when it
+    # starts lasts the whole day
+    def getRate(self):
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, rate in self.schedule:
+            if start == end or (start <= minute < end) or (start > end and (minute >= start or minute < end)):
+                return rate
+        return self.rate
+
+    # Limited method. Returns True if this limiter, or the shared one, is currently limiting the rate
+    def isLimited(self):
+        return self.getRate() > 0 or (self.parent is not None and self.parent.isLimited())
+
+    # Reserve method. Charges the given amount of bytes to the bucket and returns how many seconds the caller has to
+    # wait before sending them. The bucket holds at most one second worth of bytes and can run into debt: the
+    # reservations are served in the order they are made, so that a large transfer sending its data slice after
+    # slice cannot delay a small file by more than a slice
+    def reserve(self, size):
+        delay = 0
+        with self.lock:
+            rate = self.getRate()
+            now = time.monotonic()
+            if rate > 0:
+                self.tokens = min(self.tokens + (now - self.updated) * rate, rate) - size
+                delay = -self.tokens / rate if self.tokens < 0 else 0
+            else:
+                self.tokens = 0.0
+            self.updated = now
+        if self.parent is not None:
+            delay = max(delay, self.parent.reserve(size))
+        return delay
+
+    # Consume method. Waits until the given amount of bytes can be sent
+    def consume(self, size):
+        delay = self.reserve(size)
+        if delay > 0:
+            time.sleep(delay)
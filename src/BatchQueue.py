@@ -0,0 +1,61 @@
+# BatchQueue.py
+
+# Importing libraries
+import threading
+from concurrent.futures import Future
+
+
+class BatchQueue:
+
+    # Object constructor. Collects the requests submitted by concurrent workers and hands them to the given send
+    # function in groups of at most the given size, waiting at most linger seconds for a group to fill up
+    def __init__(self, send, size=20, linger=0.05):
+        self.send = send
+        self.size = size
+        self.linger = linger
+        self.pending = []
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+
+    # Submit method. Queues a request and returns a future that will receive its response
+    def submit(self, request):
+        future = Future()
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("Batch queue is closed")
+            self.pending.append((request, future))
+            self.condition.notify_all()
+        return future
+
+    # Close method. Sends the requests still queued and stops the background thread
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+
+    # Background loop. Waits for a group to fill up (or for the linger time to pass) and sends it
+    def __run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                self.condition.wait_for(lambda: len(self.pending) >= self.size or self.closed, self.linger)
+                group = self.pending[:self.size]
+                self.pending = self.pending[self.size:]
+            self.__sendGroup(group)
+
+    # Sends a group of requests and hands every response, or the error of the whole group, to its future
+    def __sendGroup(self, group):
+        try:
+            responses = self.send([request for request, future in group])
+        except Exception as e:
+            for request, future in group:
+                future.set_exception(e)
+            return
+        for (request, future), response in zip(group, responses):
+            future.set_result(response)
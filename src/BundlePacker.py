@@ -0,0 +1,92 @@
+# BundlePacker.py
+
+# Importing libraries
+import io
+import json
+import mmap
+import time
+import uuid
+import hashlib
+import tarfile
+import tempfile
+import threading
+
+
+class BundlePacker:
+
+    # Object constructor. Prepares the packing of the files smaller than the given threshold, in bytes, that would be
+    # uploaded inside the given remote folder, into tar bundles closed once they reach the given size, in bytes, and
+    # compressed with gzip if requested. Bundles are named after the time the packing started and a random tag, so
+    # that the bundles of different runs, even when started in the same second, never replace each other. Files can be
+    # added from several threads at the same time
+    def __init__(self, folder, threshold, size, compress=False):
+        self.folder = folder
+        self.threshold = threshold
+        self.size = size
+        self.compress = compress
+        self.prefix = "bundle-" + time.strftime("%Y%m%d-%H%M%S") + "-" + uuid.uuid4().hex[:8] + "-"
+        self.count = 0
+        self.bundle = None
+        self.lock = threading.Lock()
+
+    # Add method. Adds the given local file, which would be uploaded to the given remote path, to the current bundle,
+    # under its path relative to the remote folder. Returns the bundle if it has reached its size and has been closed,
+    # otherwise None. The file is read and hashed by the calling thread, only its writing into the bundle is serialized
+    def add(self, filePath, remotePath, stat):
+        with open(filePath, "rb") as f:
+            data = f.read()
+        sha1 = hashlib.sha1(data).hexdigest()
+        info = tarfile.TarInfo(remotePath[len(self.folder):])
+        info.size = len(data)
+        info.mtime = int(stat.st_mtime)
+        info.mode = stat.st_mode & 0o777
+        with self.lock:
+            if self.bundle is None:
+                self.__open()
+            archive = self.bundle["archive"]
+            archive.addfile(info, io.BytesIO(data))
+
+            # The content of the file ends the archive written so far, padded to a whole number of blocks
+            offset = archive.offset - -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            self.bundle["entries"].append({"path": info.name, "offset": offset, "size": len(data), "sha1": sha1})
+            self.bundle["files"].append((filePath, remotePath, stat, sha1))
+            return self.__close() if self.bundle["buffer"].tell() >= self.size else None
+
+    # Close method. Closes the current bundle and returns it, or None if there is none, as a dictionary holding its
+    # name, the remote folder it goes to, its content mapped from its temporary file, the content of its index and the
+    # (path, remote path, stat, sha1) tuples of its files. The index maps the path of every file to the offset of its
+    # content inside the uncompressed archive. The temporary file is removed once the mapping is closed
+    def close(self):
+        with self.lock:
+            return self.__close()
+
+    # Closes the current bundle, while holding the lock
+    def __close(self):
+        if self.bundle is None:
+            return None
+        bundle, self.bundle = self.bundle, None
+        bundle["archive"].close()
+        with bundle["buffer"] as buffer:
+            buffer.flush()
+            data = mmap.mmap(buffer.fileno(), 0, access=mmap.ACCESS_READ)
+        index = {"bundle": bundle["name"], "compression": "gzip" if self.compress else None, "files": bundle["entries"]}
+        return {
+            "name": bundle["name"],
+            "folder": self.folder,
+            "data": data,
+            "index": json.dumps(index).encode(),
+            "files": bundle["files"]
+        }
+
+    # Starts a new bundle, written as a stream to an anonymous temporary file, so that the bundles waiting to be
+    # uploaded are held by the file cache instead of the memory of the script
+    def __open(self):
+        self.count += 1
+        buffer = tempfile.TemporaryFile()
+        self.bundle = {
+            "name": self.prefix + str(self.count).zfill(4) + (".tar.gz" if self.compress else ".tar"),
+            "buffer": buffer,
+            "archive": tarfile.open(fileobj=buffer, mode="w|gz" if self.compress else "w|", format=tarfile.PAX_FORMAT),
+            "entries": [],
+            "files": []
+        }
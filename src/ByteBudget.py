@@ -0,0 +1,27 @@
+# ByteBudget.py
+
+# Importing libraries
+import threading
+
+
+class ByteBudget:
+
+    # Object constructor. Sets the maximum amount of bytes that can be in flight at the same time
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    # Acquire method. Blocks until the given amount of bytes fits into the budget. A single request larger
+    # than the whole budget is let through when nothing else is in flight, so that it can never block forever
+    def acquire(self, size):
+        with self.condition:
+            while self.used > 0 and self.used + size > self.limit:
+                self.condition.wait()
+            self.used += size
+
+    # Release method. Gives back the given amount of bytes and wakes up the waiting workers
+    def release(self, size):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
@@ -0,0 +1,53 @@
+# ChunkPrefetcher.py
+
+# Importing libraries
+import mmap
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ChunkPrefetcher:
+
+    # Object constructor. Prepares a background thread that reads ahead the given memory-mapped file while the chunks
+    # before are being sent and, if requested, computes its SHA1 digest along the way. The file is hashed from the
+    # start, while a file that is not hashed is read ahead from the given offset only
+    def __init__(self, mapping, hashing=False, offset=0):
+        self.mapping = mapping
+        self.hashing = hashing
+        self.sha1 = hashlib.sha1()
+        self.hashed = 0
+        self.scheduled = 0 if hashing else offset
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    # Prefetch method. Schedules the read ahead of the file up to the given position, if not done yet. Ranges are
+    # processed in order, so the digest is always computed on contiguous bytes
+    def prefetch(self, end):
+        end = min(end, len(self.mapping))
+        if end > self.scheduled:
+            self.executor.submit(self.__read, self.scheduled, end)
+            self.scheduled = end
+
+    # Digest method. Waits for the background thread, hashes what is left and returns the SHA1 digest of the file, or
+    # None if the file is not being hashed
+    def digest(self):
+        if not self.hashing:
+            return None
+        self.executor.shutdown(wait=True)
+        self.__read(self.hashed, len(self.mapping))
+        return self.sha1.hexdigest()
+
+    # Close method. Stops the background thread, waiting for the range it is reading
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    # Reads the given range: asks the kernel to load its pages in background and, when hashing, feeds it to the digest
+    def __read(self, start, end):
+        if end <= start:
+            return
+        if hasattr(self.mapping, "madvise") and hasattr(mmap, "MADV_WILLNEED"):
+            aligned = start - start % mmap.PAGESIZE
+            self.mapping.madvise(mmap.MADV_WILLNEED, aligned, end - aligned)
+        if self.hashing and end > self.hashed:
+            with memoryview(self.mapping)[self.hashed:end] as view:
+                self.sha1.update(view)
+            self.hashed = end
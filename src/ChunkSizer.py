@@ -0,0 +1,43 @@
+# ChunkSizer.py
+
+# Importing libraries
+import threading
+
+
+class ChunkSizer:
+
+    # Graph API requires chunks to be a multiple of 320 KiB, and accepts up to 60 MiB per request
+    UNIT = 327680
+    MAXIMUM = 62914560
+
+    # Object constructor. Sets the initial chunk size, in bytes, and whether it has to adapt to the measured throughput.
+    # When adapting, the size is tuned so that a chunk takes about the given number of seconds to be sent
+    def __init__(self, initial, adaptive=False, target=5.0):
+        self.size = self.align(initial)
+        self.adaptive = adaptive
+        self.target = target
+        self.lock = threading.Lock()
+
+    # Alignment method. Rounds the given size down to a valid chunk size
+    @classmethod
+    def align(cls, size):
+        return max(cls.UNIT, min(cls.MAXIMUM, int(size) // cls.UNIT * cls.UNIT))
+
+    # Success method. Given a chunk sent in the given number of seconds, moves the size towards the one that would take
+    # the target time at the measured throughput, at most doubling or halving it at once. Chunks shorter than the
+    # current size (e.g. the last one of a file) say little about the link and are ignored
+    def onSuccess(self, length, seconds):
+        if not self.adaptive:
+            return
+        with self.lock:
+            if length < self.size:
+                return
+            ideal = length / max(seconds, 0.001) * self.target
+            self.size = self.align(min(self.size * 2, max(self.size / 2, ideal)))
+
+    # Failure method. Halves the size, so that less data is lost at the next failure
+    def onFailure(self):
+        if not self.adaptive:
+            return
+        with self.lock:
+            self.size = self.align(self.size // 2)
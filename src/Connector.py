@@ -3,36 +3,189 @@
 # Importing libraries
 import os
 import json
+import queue
+import atexit
+import mmap
+import time
+import hashlib
 import logging
+import threading
 import requests
 from .ConnectorException import ConnectorException
-from logging.handlers import RotatingFileHandler
+from .UploadResult import UploadResult
+from .ByteBudget import ByteBudget
+from .UploadJournal import UploadJournal
+from .SyncManifest import SyncManifest
+from .RemoteIndex import RemoteIndex
+from .BatchQueue import BatchQueue
+from .RetryPolicy import RetryPolicy
+from .ConcurrencyLimiter import ConcurrencyLimiter
+from .ChunkPrefetcher import ChunkPrefetcher
+from .ChunkSizer import ChunkSizer
+from .TokenManager import TokenManager
+from .BandwidthLimiter import BandwidthLimiter
+from .ThrottledBody import ThrottledBody
+from .Telemetry import Telemetry
+from .FileIndex import FileIndex
+from .FileHasher import FileHasher
+from .FileScanner import FileScanner
+from .BundlePacker import BundlePacker
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from urllib.parse import quote
-from dotenv import load_dotenv
+from dotenv import load_dotenv, dotenv_values
 from os.path import dirname, abspath
 
 
 class Connector:
 
-    # Object constructor. Reads the configuration from .env file and checks for errors
-    def __init__(self):
+    # Number of characters of a response body written to the log
+    LOGBODY = 1024
+
+    # Object constructor. Reads the configuration from the given file, or from the .env file of the script if not given,
+    # and checks for errors. If another connector of the same account is given, its token, connection pool and local
+    # stores are shared instead of creating new ones
+    def __init__(self, envFile="", account=None):
 
         # Try to load .env file and save configuration into object properties
         try:
-            env = dirname(dirname(abspath(__file__))) + "/.env"
-            load_dotenv(dotenv_path=env)
-            self.token = os.getenv('ACCESSTOKEN', "")
-            self.refreshToken = os.getenv('REFRESHTOKEN', "")
-            self.clientId = os.getenv('CLIENTID', "")
-            self.clientSecret = os.getenv('CLIENTSECRET', "")
-            self.fileName = os.getenv('FILENAME', "")
-            self.chunkSize = os.getenv('BLOCKSIZE', "")
-            self.logLevel = os.getenv('LOGLEVEL', "INFO")
+            self.envFile = abspath(envFile) if envFile != "" else dirname(dirname(abspath(__file__))) + "/.env"
+            settings = self.__readSettings(envFile)
+            self.clientId = settings.get('CLIENTID') or ""
+            self.clientSecret = settings.get('CLIENTSECRET') or ""
+            self.fileName = settings.get('FILENAME') or ""
+            self.chunkSize = settings.get('BLOCKSIZE') or ""
+            self.logLevel = settings.get('LOGLEVEL') or "INFO"
+            self.workers = settings.get('WORKERS') or "4"
+            self.maxInFlight = settings.get('MAXINFLIGHT') or "240"
+            self.poolSize = settings.get('POOLSIZE') or ""
+            self.timeout = settings.get('TIMEOUT') or "60"
+            self.incremental = settings.get('INCREMENTAL') or "false"
+            self.smallFileSize = settings.get('SMALLFILE') or "4"
+            self.batching = settings.get('BATCHING') or "true"
+            self.maxRetries = settings.get('MAXRETRIES') or "5"
+            self.pipelineDepth = settings.get('PIPELINEDEPTH') or "2"
+            self.adaptiveChunks = settings.get('ADAPTIVECHUNKS') or "true"
+            self.destination = (settings.get('DESTINATION') or "").strip("/")
+            self.bandwidthLimit = settings.get('BANDWIDTH') or "0"
+            self.bandwidthSchedule = settings.get('BANDWIDTHSCHEDULE') or ""
+            self.graphUrl = (settings.get('GRAPHURL') or "https://graph.microsoft.com/v1.0").rstrip("/")
+            self.tokenUrl = settings.get('TOKENURL') or TokenManager.URL
+            self.metricsFile = settings.get('METRICSFILE') or ""
+            self.hashWorkers = settings.get('HASHWORKERS') or ""
+            self.packSize = settings.get('PACKSIZE') or "0"
+            self.bundleSize = settings.get('BUNDLESIZE') or "32"
+            self.packCompression = settings.get('PACKCOMPRESSION') or "false"
+            if account is not None:
+                self.tokenManager = account.tokenManager
+            else:
+                self.tokenManager = TokenManager(self.clientId, self.clientSecret, settings.get('ACCESSTOKEN') or "",
+                                                 settings.get('REFRESHTOKEN') or "",
+                                                 float(settings.get('TOKENEXPIRY') or "0"),
+                                                 self.__requestToken, self.__saveConfig)
         except ConnectorException:
             raise
         except Exception:
             raise ConnectorException("Cannot read from .env file.")
 
+        # Configure logging, also for the token of the account
+        self.storeFolder = Connector.getStoreFolder(envFile)
+        self.__configureLogging()
+        if account is None:
+            self.tokenManager.logger = self.logger
+
+        # If (part of) configuration is missing, throw an exception
+        if (self.clientId == "" or self.clientSecret == "" or self.fileName == "" or self.chunkSize == ""):
+            raise ConnectorException(
+                "Script has not been configured yet. Please update the .env file and restart the script.")
+
+        # If the optional settings are not valid, throw an exception
+        self.__validateSettings()
+
+        # Prepare the HTTP session shared by every call, unless the account already has one
+        self.session = account.session if account is not None else self.__createSession()
+
+        # Open the journal of the upload sessions, used to resume interrupted uploads, the manifest of the uploaded
+        # files and the index of the remote items, both used to skip unchanged files in incremental mode, and the index
+        # of the local files found by the scans, with their digests. Accounts configured by their own file keep them
+        # in a folder of their own, named after the full path of the file, so that they never mix
+        self.sharesStores = account is not None
+        if account is not None:
+            self.journal, self.manifest, self.remoteIndex = account.journal, account.manifest, account.remoteIndex
+            self.fileIndex, self.hasher = account.fileIndex, account.hasher
+        else:
+            try:
+                folder = self.storeFolder
+                os.makedirs(folder, exist_ok=True)
+                self.journal = UploadJournal(folder + "/uploads.db")
+                self.manifest = SyncManifest(folder + "/manifest.db")
+                self.remoteIndex = RemoteIndex(folder + "/remote.db")
+                self.fileIndex = FileIndex(folder + "/files.db")
+            except Exception:
+                raise ConnectorException("Cannot open upload journal, manifest, remote index or file index")
+
+            # Prepare the processes hashing the large files, one per core unless configured
+            self.hasher = FileHasher(int(self.hashWorkers) if self.hashWorkers != "" else os.cpu_count() or 1,
+                                     self.fileIndex)
+
+        # Prepare the telemetry of the uploads. The connector owning the token of the account also tells it about the
+        # token refreshes, so that a refresh shared by many connectors counts once
+        self.telemetry = Telemetry()
+        if account is None:
+            self.tokenManager.listeners.append(self.__onTokenRefreshed)
+        self.metricsExported = 0
+
+        # Prepare the budget shared by the workers to limit the bytes in flight, and the limiter of the upload speed
+        self.byteBudget = ByteBudget(int(self.maxInFlight) * 1024 * 1024)
+        self.bandwidth = BandwidthLimiter(int(self.bandwidthLimit) * 1024,
+                                          BandwidthLimiter.parseSchedule(self.bandwidthSchedule))
+
+        # Prepare the policy used to retry the failed requests and the limiter of the requests in flight, which adapts
+        # to the throttling of the server. Besides the workers, one more request can be sent by the batch queue. The
+        # server throttles the whole account, so the limiter is shared with the other connectors of the same account
+        self.retryPolicy = RetryPolicy(int(self.maxRetries))
+        self.concurrency = account.concurrency if account is not None else ConcurrencyLimiter(int(self.workers) + 1)
+
+        # The queue grouping metadata requests into $batch calls is only active during directory uploads, together
+        # with the cache of the ids of the remote folders and the packer of the small files into bundles
+        self.batchQueue = None
+        self.packer = None
+        self.folderIds = {}
+        self.uploadFolder = self.destination
+
+        # Log script status
+        self.logger.debug("Script ready")
+
+    # Settings reading method. Returns the settings read from the given file. The .env file of the script is loaded
+    # into the environment, which keeps precedence over it; any other file is read on its own
+
+    def __readSettings(self, envFile):
+        if envFile == "":
+            load_dotenv(dotenv_path=self.envFile)
+            return os.environ
+        if not os.path.isfile(envFile):
+            raise ConnectorException("Cannot read from " + envFile + " file.")
+        return dotenv_values(envFile)
+
+    # Store folder method. Returns the folder of the local stores of the given configuration file: the logs folder
+    # for the .env file of the script, otherwise a folder named after the file and a short hash of its full path, so
+    # that files with the same name in different folders never share their stores
+    @staticmethod
+    def getStoreFolder(envFile=""):
+        folder = dirname(dirname(abspath(__file__))) + "/logs"
+        if envFile == "":
+            return folder
+        name = os.path.splitext(os.path.basename(envFile))[0].lstrip(".") or "env"
+        return folder + "/" + name + "-" + hashlib.sha1(abspath(envFile).encode()).hexdigest()[:12]
+
+    # Logging configuration method. Checks that the log file can be written and attaches it to the connector logger,
+    # unless another connector already did. Every account logs through a child logger of its own, named after the
+    # folder of its local stores ("default" for the .env file of the script), which filters the messages by the level
+    # configured for the account, so that the accounts of the same process never change the level of each other
+
+    def __configureLogging(self):
+
         # Try to access log file or throw an exception
         logFile = dirname(dirname(abspath(__file__))) + "/logs/connector.log"
         try:
@@ -47,28 +200,82 @@ class Connector:
 
         # Configure logging
         fp.close()
-        logLevel = logging.getLevelName(self.logLevel)
-        self.logger = logging.getLogger('connector_logger')
-        self.logger.setLevel(logLevel)
-        self.logger.propagate = False
+        account = os.path.basename(self.storeFolder) if self.storeFolder != Connector.getStoreFolder() else "default"
+        self.logger = logging.getLogger('connector_logger.' + account)
+        self.logger.setLevel(logging.getLevelName(self.logLevel))
+        parent = logging.getLogger('connector_logger')
+        parent.propagate = False
+        if any(isinstance(handler, QueueHandler) for handler in parent.handlers):
+            return
         fh = RotatingFileHandler(logFile, maxBytes=10485760, backupCount=10)
         formatter = logging.Formatter(
             '[%(asctime)-15s] %(levelname)s: %(message)s')
         fh.setFormatter(formatter)
-        fh.setLevel(logLevel)
-        self.logger.addHandler(fh)
 
-        # Change working directory to script directory
-        dname = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        os.chdir(dname)
+        # Write the log file from a background thread, so that the workers only queue their records, and flush the
+        # records still queued when the script exits
+        records = queue.SimpleQueue()
+        listener = QueueListener(records, fh, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+        parent.addHandler(QueueHandler(records))
+
+    # Response logging method. Logs the status and the beginning of the body of a response, only if debug messages are
+    # enabled, so that the body is neither decoded nor copied otherwise. If body is a function, the body is got by
+    # calling it
+
+    def _logResponse(self, status, body):
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        text = body() if callable(body) else body
+        if len(text) > self.LOGBODY:
+            text = text[:self.LOGBODY] + "... (" + str(len(text) - self.LOGBODY) + " more characters)"
+        self.logger.debug("Response received: %s %s", status, text)
+
+    # Access token property. Returns the access token to use, as given by the token manager
+    @property
+    def token(self):
+        return self.tokenManager.getToken()
+
+    # Refresh token property. Returns the refresh token currently held by the token manager
+    @property
+    def refreshToken(self):
+        return self.tokenManager.refreshToken
+
+    # Settings validation method. Checks the optional settings read from .env file and throws an exception if any is invalid
+
+    def __validateSettings(self):
+        if not self.workers.isdigit() or int(self.workers) < 1 or not self.maxInFlight.isdigit():
+            raise ConnectorException("WORKERS and MAXINFLIGHT must be positive integers.")
+        if (self.poolSize != "" and not self.poolSize.isdigit()) or not self.timeout.isdigit():
+            raise ConnectorException("POOLSIZE and TIMEOUT must be positive integers.")
+        if not self.maxRetries.isdigit() or not self.pipelineDepth.isdigit():
+            raise ConnectorException("MAXRETRIES and PIPELINEDEPTH must be positive integers.")
+        if not self.smallFileSize.isdigit() or int(self.smallFileSize) > 4:
+            raise ConnectorException("SMALLFILE must be an integer between 0 and 4.")
+        if any(value not in ("true", "false") for value in (self.incremental, self.batching, self.adaptiveChunks,
+                                                            self.packCompression)):
+            raise ConnectorException("INCREMENTAL, BATCHING, ADAPTIVECHUNKS and PACKCOMPRESSION must be either true or "
+                                     "false.")
+        if not self.packSize.isdigit() or not self.bundleSize.isdigit() or int(self.bundleSize) < 1:
+            raise ConnectorException("PACKSIZE and BUNDLESIZE must be positive integers.")
+        if not self.bandwidthLimit.isdigit() or (self.hashWorkers != "" and not self.hashWorkers.isdigit()):
+            raise ConnectorException("BANDWIDTH and HASHWORKERS must be non-negative integers.")
+        try:
+            BandwidthLimiter.parseSchedule(self.bandwidthSchedule)
+        except ValueError:
+            raise ConnectorException("BANDWIDTHSCHEDULE must be a list of windows like 08:00-18:00=512.")
 
-        # If (part of) configuration is missing, throw an exception
-        if (self.clientId == "" or self.clientSecret == "" or self.fileName == "" or self.chunkSize == ""):
-            raise ConnectorException(
-                "Script has not been configured yet. Please update the .env file and restart the script.")
+    # Session creation method. Returns an HTTP session keeping connections alive between requests. Unless configured,
+    # the pool is sized so that every worker can keep its own connection to the upload host and to the API host
 
-        # Log script status
-        self.logger.debug("Script ready")
+    def __createSession(self):
+        poolSize = int(self.poolSize) if self.poolSize != "" else max(10, int(self.workers) * 2)
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=poolSize)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
 
     # Login method. Prompts the user for the code, exchanges it for an authentication token and saves it into object properties
 
@@ -85,7 +292,7 @@ class Connector:
                 url = "https://login.microsoftonline.com/common/oauth2/v2.0/authorize" + \
                     "?client_id=" + self.clientId + \
                     "&response_type=code" + \
-                    "&redirect_uri=" + quote("https://apps.francescorega.eu/1DToken") + \
+                    "&redirect_uri=" + quote(TokenManager.REDIRECT) + \
                     "&scope=Files.ReadWrite+offline_access"
                 print("The authentication token has not yet been set.")
                 print("Please visit this address to authorize the app to access your account " +
@@ -101,28 +308,103 @@ class Connector:
                 raise ConnectorException(
                     "Error while creating authentication code: " + str(e))
 
-    # Upload method
+    # Upload method. Uploads the given path, or the configured one, into the given remote folder, or the configured one
 
-    def upload(self, requiredPath=""):
+    def upload(self, requiredPath="", destination=None):
+
+        # Find the path to upload and the remote folder to upload it into
+        path = self._resolvePath(requiredPath)
+        self._resolveDestination(destination)
+
+        # Prepare the chunk size shared by all the transfers of this upload
+        self._prepareChunkSizer()
+        self._prepareMetrics()
+        try:
 
-        # If filename path is relative add "files" folder, then normalize and log
+            # If configured path is a directory, let's call directory upload method
+            if os.path.isdir(path):
+                return self.__uploadDirectory(path)
+
+            # If configured path is a file, let's call file upload method
+            elif os.path.isfile(path):
+                return self.__uploadFile(path)
+
+            # If configured filename is a special file, exit with an error
+            else:
+                raise ConnectorException("Configured FILENAME is invalid")
+        finally:
+            self._exportMetrics(True)
+
+    # Close method. Stops the processes hashing the files and drops the digests still pending, and stops counting the
+    # token refreshes, unless they are shared with another connector of the same account, which stops them instead. The
+    # processes are started again if needed
+
+    def close(self):
+        if not self.sharesStores:
+            self.hasher.close()
+            if self.__onTokenRefreshed in self.tokenManager.listeners:
+                self.tokenManager.listeners.remove(self.__onTokenRefreshed)
+
+    # Token refresh listener. Records a refresh of the token of the account in the telemetry
+
+    def __onTokenRefreshed(self):
+        self.telemetry.tokenRefreshed()
+
+    # Path resolution method. Returns the path to upload: the given one, or the configured one if empty. If the path is
+    # relative add "files" folder of the script, then normalize and log
+
+    def _resolvePath(self, requiredPath):
         path = requiredPath if requiredPath != "" else self.fileName
         if not os.path.isabs(path):
-            path = "files/" + path
+            path = dirname(dirname(abspath(__file__))) + "/files/" + path
         path = os.path.normpath(path)
-        self.logger.info("Upload requested. Path is: " + path)
+        self.logger.info("Upload requested. Path is: %s", path)
+        return path
 
-        # If configured path is a directory, let's call directory upload method
-        if os.path.isdir(path):
-            return self.__uploadDirectory(path)
+    # Metrics preparation method. If a metrics file is configured, makes the telemetry export to it while the upload
+    # progresses
 
-        # If configured path is a file, let's call file upload method
-        elif os.path.isfile(path):
-            return self.__uploadFile(path)
+    def _prepareMetrics(self):
+        if self.metricsFile != "" and not self.metricsExported:
+            self.telemetry.on("progress", lambda **progress: self._exportMetrics())
+            self.metricsExported = time.monotonic()
 
-        # If configured filename is a special file, exit with an error
-        else:
-            raise ConnectorException("Configured FILENAME is invalid")
+    # Metrics export method. Writes the metrics to the configured file, if any, at most every 10 seconds unless forced
+
+    def _exportMetrics(self, force=False):
+        if self.metricsFile == "" or (not force and time.monotonic() - self.metricsExported < 10):
+            return
+        self.metricsExported = time.monotonic()
+        try:
+            self.telemetry.exportTo(self.metricsFile)
+        except Exception as e:
+            self.logger.error("Cannot write metrics to %s: %s", self.metricsFile, e)
+
+    # Destination resolution method. Sets the remote folder the upload goes into: the given one, or the configured one
+    # if not given, where an empty path stands for the root folder
+
+    def _resolveDestination(self, destination):
+        self.uploadFolder = (destination if destination is not None else self.destination).strip("/")
+        if self.uploadFolder != "":
+            self.logger.info("Upload destination is: %s", self.uploadFolder)
+
+    # Chunk sizer preparation method. Checks the configured chunk size and prepares the sizer shared by the workers, which
+    # rounds it to a multiple of 320 KiB as required by OneDrive and, if enabled, adapts it to the measured throughput
+
+    def _prepareChunkSizer(self):
+
+        # If configured chunk size is not a number, throw an exception
+        if not self.chunkSize.isdigit() or int(self.chunkSize) < 1:
+            raise ConnectorException("BLOCKSIZE must be a positive integer.")
+
+        # If configured chunk size is larger than the maximum chunk size allowed by OneDrive correct it, but show a warning
+        if int(self.chunkSize) > 60:
+            self.chunkSize = "60"
+            message = "Configured chunk size is larger than allowed: proceeding using 60MB chunks."
+            self.logger.info(message)
+            print(message)
+        self.chunkSizer = ChunkSizer(int(self.chunkSize) * 1024 * 1024, self.adaptiveChunks == "true")
+        self.logger.debug("Calculated chunk size is: %d bytes", self.chunkSizer.size)
 
     # Authentication method. Exchanges an authentication code or a refresh token with a new one and updates config
 
@@ -133,82 +415,100 @@ class Connector:
             self.logger.debug(
                 "Exchanging temporary token for a long-lasting one")
 
-            # Prepare data
-            url = "https://login.microsoftonline.com/common/oauth2/v2.0/token"
-            data = {
-                'client_id': self.clientId,
-                'redirect_uri': 'https://apps.francescorega.eu/1DToken',
-                'client_secret': self.clientSecret,
-            }
-            if isRefresh:
-                data["refresh_token"] = code
-                data["grant_type"] = 'refresh_token'
-            else:
-                data["code"] = code
-                data["grant_type"] = 'authorization_code'
-
-            # Log request
-            self.logger.debug("Sending request to endpoint " + url)
-
-            # Send request
-            response = requests.post(url, data)
-
-            # Log response
-            self.logger.debug("Response received:")
-            self.logger.debug(response)
-            self.logger.debug(response.text)
-
-            # Extract values from response
-            body = response.text
-            body = json.loads(body)
-
-            # Update .env file with new values
-            env = dirname(dirname(abspath(__file__))) + "/.env"
-            with open(env, "w") as f:
-                f.write("FILENAME=" + self.fileName + "\n")
-                f.write("BLOCKSIZE=" + self.chunkSize + "\n")
-                f.write("CLIENTID=" + self.clientId + "\n")
-                f.write("CLIENTSECRET=" + self.clientSecret + "\n")
-                f.write("LOGLEVEL=" + self.logLevel + "\n")
-                f.write("ACCESSTOKEN=" + body["access_token"] + "\n")
-                f.write("REFRESHTOKEN=" + body["refresh_token"])
-            self.logger.debug(".env file updated")
-
-            # Update object property, log and return
-            self.token = body["access_token"]
+            # Send request, update token pair and .env file, log and return
+            token = self.tokenManager.update(self.__requestToken(self.tokenManager.getRequestData(code, isRefresh)))
             self.logger.info("Got new token")
-            return body["access_token"]
+            return token
         except ConnectorException:
             raise
         except Exception as e:
             raise ConnectorException(
                 "Error while exchanging tokens: " + str(e))
 
-    # Folder creation method. Create a new remote folder with the given name as the root subfolder
-
-    def __createFolder(self, name):
+    # Token request method. Sends the given form to the token endpoint and returns the decoded response
+
+    def __requestToken(self, data):
+
+        # Log request
+        self.logger.debug("Sending request to endpoint %s", self.tokenUrl)
+
+        # Send request
+        response = self.session.post(self.tokenUrl, data=data, timeout=int(self.timeout))
+
+        # Log response
+        self._logResponse(response.status_code, lambda: response.text)
+        return json.loads(response.text)
+
+    # Configuration saving method. Rewrites the .env file with the current configuration and token pair. The file is
+    # written aside and then moved over the old one, so that it is never left half written
+
+    def __saveConfig(self):
+        env = self.envFile
+        with open(env + ".tmp", "w") as f:
+            f.write("FILENAME=" + self.fileName + "\n")
+            f.write("BLOCKSIZE=" + self.chunkSize + "\n")
+            f.write("CLIENTID=" + self.clientId + "\n")
+            f.write("CLIENTSECRET=" + self.clientSecret + "\n")
+            f.write("LOGLEVEL=" + self.logLevel + "\n")
+            f.write("WORKERS=" + self.workers + "\n")
+            f.write("MAXINFLIGHT=" + self.maxInFlight + "\n")
+            f.write("POOLSIZE=" + self.poolSize + "\n")
+            f.write("TIMEOUT=" + self.timeout + "\n")
+            f.write("INCREMENTAL=" + self.incremental + "\n")
+            f.write("SMALLFILE=" + self.smallFileSize + "\n")
+            f.write("BATCHING=" + self.batching + "\n")
+            f.write("MAXRETRIES=" + self.maxRetries + "\n")
+            f.write("PIPELINEDEPTH=" + self.pipelineDepth + "\n")
+            f.write("ADAPTIVECHUNKS=" + self.adaptiveChunks + "\n")
+            f.write("DESTINATION=" + self.destination + "\n")
+            f.write("BANDWIDTH=" + self.bandwidthLimit + "\n")
+            f.write("BANDWIDTHSCHEDULE=" + self.bandwidthSchedule + "\n")
+            f.write("GRAPHURL=" + self.graphUrl + "\n")
+            f.write("TOKENURL=" + self.tokenUrl + "\n")
+            f.write("METRICSFILE=" + self.metricsFile + "\n")
+            f.write("HASHWORKERS=" + self.hashWorkers + "\n")
+            f.write("PACKSIZE=" + self.packSize + "\n")
+            f.write("BUNDLESIZE=" + self.bundleSize + "\n")
+            f.write("PACKCOMPRESSION=" + self.packCompression + "\n")
+            f.write("ACCESSTOKEN=" + self.tokenManager.accessToken + "\n")
+            f.write("REFRESHTOKEN=" + self.refreshToken + "\n")
+            f.write("TOKENEXPIRY=" + str(int(self.tokenManager.expiresAt)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(env + ".tmp", env)
+        self.logger.debug(".env file updated")
+
+    # Folder creation method. Creates a new remote folder with the given name inside the given parent folder (the root
+    # if empty), or looks it up if it already exists, and caches its id for the creation of its subfolders
+
+    def __createFolder(self, name, parent=""):
         try:
 
             # Log request
             self.logger.debug(
                 "Requesting the creation of a new remote folder ")
 
-            # Prepare  data for the call
-            url = "https://graph.microsoft.com/v1.0/drive/root/children"
+            # Prepare  data for the call, addressing the parent folder by its cached id
+            path = parent + "/" + name if parent != "" else name
+            resource = "/drive/items/" + self.folderIds[parent] + "/children" if parent != "" else "/drive/root/children"
             data = {
                 'name': name,
-                'folder': {}
+                'folder': {},
+                '@microsoft.graph.conflictBehavior': 'fail'
             }
-            headers = {
-                "Authorization": "Bearer " + self.token,
-                "Content-Type": "application/json"
-            }
-            response = self.__callAPI(url, json.dumps(data), headers)
 
-            # Return generated folder name for confirmation
-            body = response.text
-            body = json.loads(body)
-            self.logger.info("Created folder named: " + body["name"])
+            # Send the call and, if the folder is already there, look it up instead
+            try:
+                body = self.__callGraph("POST", resource, data)
+                self.logger.info("Created folder named: %s", body["name"])
+            except ConnectorException as e:
+                if e.code != "nameAlreadyExists":
+                    raise
+                body = self.__callGraph("GET", "/drive/root:/" + quote(path))
+                self.logger.info("Found existing folder named: %s", body["name"])
+
+            # Cache the folder id and return its name for confirmation
+            self.folderIds[path] = body["id"]
             return body["name"]
         except ConnectorException:
             raise
@@ -216,36 +516,202 @@ class Connector:
             raise ConnectorException(
                 "Error while creating folder " + name + ": " + str(e))
 
-    # Upload session creation method. Refreshes the token, if needed, and request, a new url for a large file upload
+    # Folder tree creation method. Mirrors on the remote side the destination folder and the tree of folders found in
+    # the given local path, if any, level by level, creating the sibling folders of each level concurrently. Folders
+    # already known to the remote index are not created again
+
+    def __createFolderTree(self, path):
+        try:
+
+            # Log request
+            self.logger.debug("Mirroring the local folder tree")
+
+            # Group the remote paths of the folders by their depth
+            levels = self._getFolderLevels(path)
+
+            # Create each level once the previous one is done. When batching, use enough threads to fill a batch
+            self.folderIds = {}
+            threads = 20 if self.batchQueue is not None else int(self.workers)
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                for depth in sorted(levels):
+                    futures = []
+                    for folder in levels[depth]:
+                        item = self.remoteIndex.find(folder) if self.incremental == "true" else None
+                        if item is not None and item[1]:
+                            self.folderIds[folder] = item[4]
+                            continue
+                        parent, _, name = folder.rpartition("/")
+                        futures.append(executor.submit(self.__createFolder, name, parent))
+                    for future in futures:
+                        future.result()
+
+            # Return the number of folders for confirmation
+            count = sum(len(folders) for folders in levels.values())
+            self.logger.info("Remote folder tree ready with %d folder(s)", count)
+            return count
+        except ConnectorException:
+            raise
+        except Exception as e:
+            raise ConnectorException(
+                "Error while creating folder tree: " + str(e))
+
+    # Remote folder method. Returns the remote path matching a local folder inside the uploaded path, using the name of
+    # the uploaded path as top level folder inside the destination folder
+
+    def _getRemoteFolder(self, path, root):
+        relative = os.path.relpath(root, path)
+        folder = os.path.basename(path) if relative == "." else os.path.basename(path) + "/" + relative.replace(os.sep, "/")
+        return self._getDestinationPrefix() + folder
+
+    # Destination prefix method. Returns the path of the destination folder, ready to be prepended to a remote name
+
+    def _getDestinationPrefix(self):
+        return self.uploadFolder + "/" if self.uploadFolder != "" else ""
+
+    # Folder levels method. Returns the remote paths of the destination folder, of its parents and, if a local path is
+    # given, of the folders of its tree, grouped by their depth
+
+    def _getFolderLevels(self, path=""):
+        levels = {}
+        parts = self.uploadFolder.split("/") if self.uploadFolder != "" else []
+        for depth in range(len(parts)):
+            levels[depth] = ["/".join(parts[:depth + 1])]
+        if path != "":
+            for root, dirs, files in os.walk(path):
+                folder = self._getRemoteFolder(path, root)
+                levels.setdefault(folder.count("/"), []).append(folder)
+        return levels
+
+    # Upload session creation method. Refreshes the token, if needed, and request, a new url for a large file upload.
+    # If the local file path is given, the session is recorded in the journal so that it can be resumed later
 
-    def __getUploadUrl(self, fileName, folder=""):
+    def __getUploadUrl(self, fileName, folder="", filePath=""):
         try:
 
             # Log request
             self.logger.debug("Requesting a new upload url")
 
-            # Prepare  data for the call
-            url = "https://graph.microsoft.com/v1.0/drive/root:/" + \
-                folder + fileName + ":/createUploadSession"
-            data = {}
+            # Send the call
+            body = self.__callGraph("POST", "/drive/root:/" + quote(folder + fileName) + ":/createUploadSession", {})
+
+            # Extract uploadUrl value from body, record it and return it
+            self.logger.info("Got upload url: %s", body["uploadUrl"])
+            if filePath != "":
+                stat = os.stat(filePath)
+                self.journal.save(os.path.abspath(filePath), folder + fileName, stat.st_size, stat.st_mtime,
+                                  body["uploadUrl"], body.get("expirationDateTime", ""))
+            return body["uploadUrl"]
+        except ConnectorException:
+            raise
+        except Exception as e:
+            raise ConnectorException(
+                "Error while requesting an upload url: " + str(e))
+
+    # Remote index sync method. Brings the remote index of the given folder up to date, starting over if the folder
+    # does not exist yet or if the stored delta link has expired
+
+    def __syncRemoteIndex(self, folder):
+        try:
+            return self.__readDelta(folder)
+        except ConnectorException as e:
+
+            # If the folder does not exist yet, there is nothing to index
+            if e.code == "itemNotFound":
+                self.remoteIndex.reset(folder)
+                return 0
+
+            # If the delta link is no longer valid, start over with a full enumeration
+            if e.code.startswith("resyncRequired"):
+                self.logger.info("Remote index of folder %s has expired: rebuilding it", folder)
+                self.remoteIndex.reset(folder)
+                return self.__readDelta(folder)
+            raise
+
+    # Delta reading method. Pages through the changes of the given remote folder since the last sync, applying each
+    # page to the remote index as soon as it is received, and stores the delta link for the next sync
+
+    def __readDelta(self, folder):
+        try:
+
+            # Log request
+            self.logger.debug("Synchronizing the remote index of folder %s", folder)
+
+            # Start from the last delta link, if any, or from a full enumeration of the folder
+            url = self.remoteIndex.getDeltaLink(folder)
+            if url is None:
+                url = self.graphUrl + "/drive/root:/" + quote(folder) + \
+                    ":/delta?$select=id,name,size,parentReference,file,folder,deleted"
             headers = {
                 "Authorization": "Bearer " + self.token
             }
-            response = self.__callAPI(url, data, headers)
 
-            # Extract uploadUrl value from body, update object property and return it for confirmation
+            # Follow the pages until the delta link is returned
+            pages = 0
+            while url is not None:
+                response = self.__callAPI(url, None, headers, "get")
+                body = response.text
+                body = json.loads(body)
+                self.remoteIndex.applyPage(folder, body.get("value", []))
+                pages += 1
+                url = body.get("@odata.nextLink")
+                if url is None:
+                    self.remoteIndex.setDeltaLink(folder, body["@odata.deltaLink"])
+
+            # Return the number of pages received for confirmation
+            self.logger.info("Remote index of folder %s synchronized with %d page(s)", folder, pages)
+            return pages
+        except ConnectorException:
+            raise
+        except Exception as e:
+            raise ConnectorException(
+                "Error while synchronizing the remote index: " + str(e))
+
+    # Upload session opening method. Resumes the session recorded in the journal for the given file, if still valid,
+    # otherwise requests a new one. Returns the upload url and the offset to start from
+
+    def __openUploadSession(self, filePath, fileName, folder=""):
+        try:
+
+            # Look for an interrupted session of the same version of the file
+            stat = os.stat(filePath)
+            session = self.journal.find(os.path.abspath(filePath), folder + fileName, stat.st_size, stat.st_mtime)
+
+            # If found, ask the server which bytes it is still expecting
+            if session is not None:
+                uploadUrl = session[0]
+                try:
+                    offset = self.__getUploadOffset(uploadUrl)
+                    self.logger.info("Resuming upload of %s from byte %d", filePath, offset)
+                    return uploadUrl, offset
+                except ConnectorException:
+                    self.logger.info("Upload session of %s is no longer valid: starting over", filePath)
+                    self.journal.remove(uploadUrl)
+
+            # Otherwise start a new session
+            return self.__getUploadUrl(fileName, folder, filePath), 0
+        except ConnectorException:
+            raise
+        except Exception as e:
+            raise ConnectorException(
+                "Error while opening an upload session: " + str(e))
+
+    # Upload status method. Queries an upload session and returns the first byte the server is still expecting
+
+    def __getUploadOffset(self, uploadUrl):
+        try:
+            self.logger.debug("Requesting the status of an upload session")
+            response = self.__callAPI(uploadUrl, None, {}, "get")
             body = response.text
             body = json.loads(body)
-            self.logger.info("Got upload url: " + body["uploadUrl"])
-            self.uploadUrl = body["uploadUrl"]
-            return body["uploadUrl"]
+            ranges = body.get("nextExpectedRanges", [])
+            return int(ranges[0].split("-")[0]) if ranges else 0
         except ConnectorException:
             raise
         except Exception as e:
             raise ConnectorException(
-                "Error while requesting an upload url: " + str(e))
+                "Error while requesting the upload status: " + str(e))
 
-    # Upload directory method. Creates the remote folder and start a new transfer for each file inside it
+    # Upload directory method. Creates the remote folder and uploads the files inside it using a pool of workers
 
     def __uploadDirectory(self, path):
         try:
@@ -254,147 +720,618 @@ class Connector:
             self.logger.debug(
                 "Path that was requested to upload is a directory. Let's upload it.")
 
-            # Create a remote folder with the same name
-            self.__createFolder(os.path.basename(path))
-
-            # Read all files inside it
-            filesCount = 0
-            for root, dirs, files in os.walk(path):
+            # In incremental mode, fetch what the remote folder already contains
+            if self.incremental == "true":
+                self.__syncRemoteIndex(self._getRemoteFolder(path, path))
+
+            # While the folders are created and the workers run, their metadata requests are grouped into $batch calls.
+            # In packing mode, the small files are packed into bundles uploaded to the top folder
+            result = UploadResult()
+            workers = int(self.workers)
+            pending = threading.BoundedSemaphore(workers * 2)
+            if self.batching == "true":
+                self.batchQueue = BatchQueue(self.__callBatch)
+            if int(self.packSize) > 0:
+                self.packer = BundlePacker(self._getRemoteFolder(path, path) + "/", int(self.packSize) * 1024,
+                                           int(self.bundleSize) * 1024 * 1024, self.packCompression == "true")
+            try:
 
-                # For each file get an upload url and upload it
-                for name in files:
-                    self.logger.debug(
-                        "Let's upload another file from the selected folder")
-                    self.__getUploadUrl(name, os.path.basename(path) + "/")
-                    self.__uploadBytes(os.path.join(root, name))
-                    filesCount += 1
-
-            # Return a confirmation message
-            message = "Upload completed. " + \
-                str(filesCount) + " file(s) uploaded"
-            self.logger.info(message)
-            return message
+                # Scan the tree in background and, as soon as a folder is found, create it on the remote side and hand
+                # its files to the workers, keeping the number of queued files bounded so that huge trees do not fill
+                # the memory with pending jobs. When batching, use enough threads creating folders to fill a batch
+                self.folderIds = {}
+                self.folderCreations = {}
+                threads = 20 if self.batchQueue is not None else workers
+                with ThreadPoolExecutor(max_workers=threads) as folders, ThreadPoolExecutor(max_workers=workers) as executor:
+                    self.__dispatchFiles(folders, executor, pending, path, result)
+
+                # The last bundle is closed once every worker has added its files to it
+                if self.packer is not None and (bundle := self.packer.close()) is not None:
+                    self.__uploadBundle(bundle, self.folderCreations[self._getRemoteFolder(path, path)], result)
+                for folder, creation in self.folderCreations.items():
+                    if creation.exception() is not None:
+                        self.logger.error("Cannot create folder %s: %s", folder, creation.exception())
+                self.logger.info("Remote folder tree ready with %d folder(s)", len(self.folderCreations))
+            finally:
+                if self.batchQueue is not None:
+                    self.batchQueue.close()
+                    self.batchQueue = None
+                self.packer = None
+
+            # Return the aggregated result
+            self.logger.info("%s", result)
+            return result
         except ConnectorException:
             raise
         except Exception as e:
             raise ConnectorException(
                 "Error while uploading directory files: " + str(e))
 
+    # Files dispatch method. Scans the tree of the given path and hands every file found to the workers, which, in
+    # packing mode, add the small files to the current bundle. The remote folders are scheduled for creation as they
+    # are found, except the ones whose files all go into bundles, and each file waits for its folder to be created
+    # before being uploaded
+
+    def __dispatchFiles(self, folders, executor, pending, path, result):
+        top = self._getRemoteFolder(path, path)
+        scanner = FileScanner(path, onFolder=lambda root, files: self._indexFolder(path, root, files), logger=self.logger)
+        for root, files in scanner:
+            folder = self._getRemoteFolder(path, root)
+            folderReady = self.__ensureFolder(folders, folder) if not files else None
+            for name, stat in files:
+                if self.packer is not None and stat.st_size < self.packer.threshold:
+                    self.__submitJob(executor, pending, self.__packFile, os.path.join(root, name), folder + "/" + name,
+                                     stat, self.__ensureFolder(folders, top), result)
+                    continue
+                if folderReady is None:
+                    folderReady = self.__ensureFolder(folders, folder)
+                self.__submitJob(executor, pending, self.__uploadDirectoryFile, os.path.join(root, name),
+                                 folder + "/", folderReady, result)
+
+    # Folder ensuring method. Returns a future completed once the given remote folder exists, scheduling its creation
+    # after the one of its parent the first time it is asked for. Parents are always scheduled before their children,
+    # so that a creation never waits for one that has not started yet
+
+    def __ensureFolder(self, folders, folder):
+        if folder not in self.folderCreations:
+            parent = folder.rpartition("/")[0]
+            parentReady = self.__ensureFolder(folders, parent) if parent != "" else None
+            self.folderCreations[folder] = folders.submit(self.__createMirroredFolder, folder, parentReady)
+        return self.folderCreations[folder]
+
+    # Mirrored folder creation method. Waits for the parent folder, if any, then creates the given remote folder,
+    # unless it is already known to the remote index
+
+    def __createMirroredFolder(self, folder, parentReady):
+        if parentReady is not None:
+            parentReady.result()
+        item = self.remoteIndex.find(folder) if self.incremental == "true" else None
+        if item is not None and item[1]:
+            self.folderIds[folder] = item[4]
+            return
+        parent, _, name = folder.rpartition("/")
+        self.__createFolder(name, parent)
+
+    # Job submission method. Hands a job of a directory upload to the workers, once there is room among the queued ones
+
+    def __submitJob(self, executor, pending, *job):
+        pending.acquire()
+        future = executor.submit(*job)
+        future.add_done_callback(lambda f: pending.release())
+
+    # File packing method. Adds a small file of a directory upload to the current bundle, unless it is unchanged, and
+    # uploads the bundle once this file has filled it
+
+    def __packFile(self, filePath, remotePath, stat, folderReady, result):
+        try:
+            if self._isUnchanged(filePath, remotePath):
+                result.addSkipped(filePath)
+                self.telemetry.fileFinished(filePath, "skipped")
+                return
+            self.telemetry.fileStarted(filePath, stat.st_size)
+            bundle = self.packer.add(filePath, remotePath, stat)
+        except Exception as e:
+            result.addFailed(filePath, e)
+            self.telemetry.fileFinished(filePath, "failed", e)
+            return
+        if bundle is not None:
+            self.__uploadBundle(bundle, folderReady, result)
+
+    # Bundle upload method. Once its folder exists, uploads a bundle of small files and then its index, next to it,
+    # recording the outcome of every file of the bundle instead of raising. The bundle is sent from the mapping of its
+    # temporary file, which is closed and removed once uploaded
+
+    def __uploadBundle(self, bundle, folderReady, result):
+        try:
+            folderReady.result()
+            self.logger.debug("Uploading bundle %s of %d file(s)", bundle["name"], len(bundle["files"]))
+            with bundle["data"] as data:
+                self.__uploadBuffer(data, bundle["name"], bundle["folder"])
+            self.__uploadBuffer(bundle["index"], bundle["name"] + ".index.json", bundle["folder"])
+            for filePath, remotePath, stat, fileHash in bundle["files"]:
+                self._recordUpload(filePath, remotePath, stat, fileHash)
+                result.addUploaded(filePath, stat.st_size)
+                self.telemetry.fileFinished(filePath, "uploaded")
+        except Exception as e:
+            for filePath, remotePath, stat, fileHash in bundle["files"]:
+                result.addFailed(filePath, e)
+                self.telemetry.fileFinished(filePath, "failed", e)
+
+    # Upload directory file method. Once its folder exists, transfers one file of a directory upload, recording the
+    # outcome instead of raising
+
+    def __uploadDirectoryFile(self, filePath, folder, folderReady, result):
+        try:
+            folderReady.result()
+            self.logger.debug(
+                "Let's upload another file from the selected folder")
+            if self._isUnchanged(filePath, folder + os.path.basename(filePath)):
+                result.addSkipped(filePath)
+                self.telemetry.fileFinished(filePath, "skipped")
+                return
+            stat = os.stat(filePath)
+            self.telemetry.fileStarted(filePath, stat.st_size)
+            chunks, fileHash = self.__transferFile(filePath, os.path.basename(filePath), folder)
+            self._recordUpload(filePath, folder + os.path.basename(filePath), stat, fileHash)
+            result.addUploaded(filePath, stat.st_size)
+            self.telemetry.fileFinished(filePath, "uploaded")
+        except Exception as e:
+            result.addFailed(filePath, e)
+            self.telemetry.fileFinished(filePath, "failed", e)
+
     # Upload file method. Transfer a single file to the remote folder
     def __uploadFile(self, path):
         try:
             self.logger.debug(
                 "Path that was requested to upload is a file. Let's upload it.")
-            self.__getUploadUrl(os.path.basename(path))
-            chunks = self.__uploadBytes(path)
+            folder = self._getDestinationPrefix()
+            self.telemetry.addPending(os.path.getsize(path))
+            if self._isUnchanged(path, folder + os.path.basename(path)):
+                message = "File is unchanged since the last upload: nothing to do"
+                self.logger.info(message)
+                self.telemetry.fileFinished(path, "skipped")
+                return message
+            if folder != "":
+                self.__createFolderTree("")
+            stat = os.stat(path)
+            self.telemetry.fileStarted(path, stat.st_size)
+            chunks, fileHash = self.__transferFile(path, os.path.basename(path), folder)
+            self._recordUpload(path, folder + os.path.basename(path), stat, fileHash)
             message = "Upload completed with " + str(chunks) + " chunk(s)"
             self.logger.info(message)
+            self.telemetry.fileFinished(path, "uploaded")
             return message
-        except ConnectorException:
-            raise
         except Exception as e:
+            self.telemetry.fileFinished(path, "failed", e)
+            if isinstance(e, ConnectorException):
+                raise
             raise ConnectorException(
                 "Error while uploading single file: " + str(e))
 
-    # Bytes transfer method. Uploads a given file in chunks of bytes to the configured upload url
+    # File transfer method. Sends files up to the configured threshold with a single request, and larger files through
+    # a (possibly resumed) upload session. Returns the number of requests used to transfer the content and, in
+    # incremental mode, the SHA1 digest of the content sent
+
+    def __transferFile(self, filePath, fileName, folder=""):
+        if os.path.getsize(filePath) <= int(self.smallFileSize) * 1024 * 1024:
+            return self.__uploadSmallFile(filePath, fileName, folder)
+        uploadUrl, offset = self.__openUploadSession(filePath, fileName, folder)
+        return self.__uploadBytes(filePath, uploadUrl, offset)
+
+    # Buffer upload method. Uploads content held in memory or mapped from a file to the given remote file: with a single
+    # request up to the configured threshold, otherwise chunk after chunk through a new upload session. Returns the
+    # number of requests used to transfer the content
+
+    def __uploadBuffer(self, data, fileName, folder=""):
+        try:
+            size = len(data)
+            if size > int(self.smallFileSize) * 1024 * 1024:
+                uploadUrl = self.__getUploadUrl(fileName, folder)
+                prefetcher = ChunkPrefetcher(data)
+                try:
+                    return self.__uploadMapping(folder + fileName, data, uploadUrl, 0, prefetcher)
+                finally:
+                    prefetcher.close()
+            self.byteBudget.acquire(size)
+            try:
+                headers = {
+                    "Authorization": "Bearer " + self.token,
+                    "Content-Type": "application/octet-stream"
+                }
+                self.__callAPI(self.graphUrl + "/drive/root:/" + quote(folder + fileName) + ":/content",
+                               self._throttle(bytes(data)), headers, "put")
+                self.telemetry.chunkSent(folder + fileName, size, size, size)
+                return 1
+            finally:
+                self.byteBudget.release(size)
+        except ConnectorException:
+            raise
+        except Exception as e:
+            raise ConnectorException("Error while uploading " + fileName + ": " + str(e))
+
+    # Small file upload method. Uploads the whole content of a file with a single request, without an upload session
 
-    def __uploadBytes(self, filePath):
+    def __uploadSmallFile(self, filePath, fileName, folder=""):
+        try:
+
+            # Log request
+            self.logger.debug("Transferring small file with a single request")
+
+            # Wait until the file fits into the bytes in flight budget, then read and send it
+            fileSize = os.path.getsize(filePath)
+            self.byteBudget.acquire(fileSize)
+            try:
+                with open(filePath, "rb") as f:
+                    data = f.read()
+                url = self.graphUrl + "/drive/root:/" + \
+                    quote(folder + fileName) + ":/content"
+                headers = {
+                    "Authorization": "Bearer " + self.token,
+                    "Content-Type": "application/octet-stream"
+                }
+                self.__callAPI(url, self._throttle(data), headers, "put")
+                self.telemetry.chunkSent(filePath, fileSize, fileSize, fileSize)
+                fileHash = hashlib.sha1(data).hexdigest() if self.incremental == "true" else None
+            finally:
+                self.byteBudget.release(fileSize)
+            return 1, fileHash
+        except ConnectorException:
+            raise
+        except Exception as e:
+            raise ConnectorException("Error while uploading small file: " + str(e))
+
+    # Folder indexing method. Called by the scan with every folder read: records its files in the file index and in the
+    # totals of the upload and, in incremental mode, starts hashing in background the files whose change detection
+    # will need their digest, so that hashing runs ahead of the uploads on every core
+
+    def _indexFolder(self, path, root, files):
+        self.fileIndex.record([(os.path.abspath(os.path.join(root, name)), stat.st_size, stat.st_mtime, None, None)
+                               for name, stat in files])
+        folder = self._getRemoteFolder(path, root) + "/"
+        for name, stat in files:
+            self.telemetry.addPending(stat.st_size)
+            digest = self._getNeededDigest(os.path.join(root, name), folder + name, stat)
+            if digest is not None:
+                self.hasher.schedule(os.path.join(root, name), stat, digest == "quickXorHash")
+
+    # Needed digest method. In incremental mode, returns which digest the change detection of the given file will
+    # compare, "sha1" or "quickXorHash", or None if size and modification time are enough to tell
+
+    def _getNeededDigest(self, filePath, remotePath, stat):
+        if self.incremental != "true":
+            return None
+        entry = self.manifest.find(os.path.abspath(filePath), remotePath)
+        if entry is not None:
+            return "sha1" if entry[0] == stat.st_size and entry[1] != stat.st_mtime else None
+        item = self.remoteIndex.find(remotePath)
+        if item is None or item[1] or item[0] != stat.st_size:
+            return None
+        return "sha1" if item[2] is not None else "quickXorHash" if item[3] is not None else None
+
+    # Change detection method. In incremental mode, returns True if the given file matches the manifest. Size and
+    # modification time are compared first, and the file is hashed only when they cannot tell on their own
+
+    def _isUnchanged(self, filePath, remotePath):
+        if self.incremental != "true":
+            return False
+        entry = self.manifest.find(os.path.abspath(filePath), remotePath)
+        if entry is None:
+            return self.__isUnchangedRemotely(filePath, remotePath)
+        stat = os.stat(filePath)
+        if entry[0] != stat.st_size:
+            return False
+        if entry[1] == stat.st_mtime:
+            return True
+
+        # The file has been touched but may still have the same content: if so update its modification time
+        if self._hashFile(filePath) != entry[2]:
+            return False
+        self.manifest.record(os.path.abspath(filePath), remotePath, stat.st_size, stat.st_mtime, entry[2])
+        return True
+
+    # Remote change detection method. Returns True if the remote index already holds the given file with the same size
+    # and content, in which case the file is added to the manifest so that the next runs can rely on a cheap stat. The
+    # content is compared by SHA1 digest or, for the accounts reporting only that, by QuickXorHash
+
+    def __isUnchangedRemotely(self, filePath, remotePath):
+        item = self.remoteIndex.find(remotePath)
+        stat = os.stat(filePath)
+        if item is None or item[1] or item[0] != stat.st_size or (item[2] is None and item[3] is None):
+            return False
+        fileHash, quickXorHash = self.hasher.hash(filePath, item[2] is None)
+        matches = fileHash == item[2].lower() if item[2] is not None else quickXorHash == item[3]
+        if not matches:
+            return False
+        self.manifest.record(os.path.abspath(filePath), remotePath, stat.st_size, stat.st_mtime, fileHash)
+        return True
+
+    # Upload recording method. In incremental mode, stores the uploaded file in the manifest and in the file index with
+    # the digest computed while sending it, unless it has been modified while it was being transferred
+
+    def _recordUpload(self, filePath, remotePath, stat, fileHash):
+        if self.incremental != "true":
+            return
+        current = os.stat(filePath)
+        if current.st_size == stat.st_size and current.st_mtime == stat.st_mtime:
+            self.manifest.record(os.path.abspath(filePath), remotePath, stat.st_size, stat.st_mtime, fileHash)
+            self.fileIndex.record([(os.path.abspath(filePath), stat.st_size, stat.st_mtime, fileHash, None)])
+
+    # Hashing method. Returns the SHA1 digest of the given file, as recorded by the file index or computed by the hasher
+
+    def _hashFile(self, filePath):
+        return self.hasher.hash(filePath)[0]
+
+    # Bytes transfer method. Uploads a given file in chunks of bytes to the given upload url, starting from the given
+    # offset, and records every acknowledged chunk in the journal. The file is memory-mapped and every chunk is sent
+    # as a view on the mapping, so that its bytes are never copied into memory owned by the script. While a chunk is
+    # in flight, the next ones are read ahead (and hashed, in incremental mode) in background. Returns the number of
+    # chunks sent and the SHA1 digest of the file, if computed
+
+    def __uploadBytes(self, filePath, uploadUrl, offset=0):
         try:
 
             # Log request
             self.logger.debug("Transferring file via raw bytes")
 
-            # If configured chunk size is larger than the maximum chunk size allowed by OneDrive correct it, but show a warning
-            if int(self.chunkSize) > 60:
-                self.chunkSize = 60
-                message = "Configured chunk size is larger than allowed: proceeding using 60MB chunks."
-                self.logger.info(message)
-                print(message)
-
-            # Open local file and calculate size
-            with open(filePath, "rb") as f:
-                fileSize = os.path.getsize(f.name)
-                chunkSizeBytes = int(self.chunkSize) * 1024 * 1024
-                self.logger.debug("Calculated chunk size is: " + str(chunkSizeBytes) + " bytes")
-                i = 0
-
-                # Split it in chunks
-                while (byte := f.read(chunkSizeBytes)):
-                    rangeMin = chunkSizeBytes * i
-                    rangeMax = chunkSizeBytes * i + chunkSizeBytes - 1
-
-                    # Prevent the calculated rangeMax from being larger than the file size
-                    if rangeMax > fileSize:
-                        rangeMax = fileSize - 1
-
-                    # Log range
-                    self.logger.debug("Current range is: " + str(rangeMin) + " ~ " + str(rangeMax))
-
-                    # Send upload request
-                    url = self.uploadUrl
-                    data = byte
-                    headers = {
-                        "Authorization": "Bearer " + self.token,
-                        "Content-Length": str(rangeMax - rangeMin),
-                        "Content-Range": "bytes " + str(rangeMin) + "-" + str(rangeMax) + "/" + str(fileSize)
-                    }
-                    self.__callAPI(url, data, headers, "put")
-
-                    # Increase counter for next chunk
-                    i += 1
-
-                # Return chunks count for confirmation
-                self.logger.debug("Upload completed. " + str(i) + " chunks used.")
-                return i
+            # Open and map local file
+            with open(filePath, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+                if hasattr(mapping, "madvise"):
+                    mapping.madvise(mmap.MADV_SEQUENTIAL)
+                prefetcher = ChunkPrefetcher(mapping, self.incremental == "true", offset)
+                try:
+                    chunks = self.__uploadMapping(filePath, mapping, uploadUrl, offset, prefetcher)
+                    fileHash = prefetcher.digest()
+                finally:
+                    prefetcher.close()
+
+                # Forget the completed session and return chunks count for confirmation
+                self.journal.remove(uploadUrl)
+                self.logger.debug("Upload completed. %d chunks used.", chunks)
+                return chunks, fileHash
         except ConnectorException:
             raise
         except Exception as e:
             raise ConnectorException("Error while uploading chunk: " + str(e))
 
-    # API call method. Accepts the data to be sent, refreshes the token if necessary, and returns the response
+    # Mapping transfer method. Sends the chunks of a memory-mapped file one after the other, as required by upload
+    # sessions, keeping the configured number of chunks read ahead, and returns the number of chunks sent. The size of
+    # every chunk is picked by the chunk sizer, which is told how long each chunk took or whether it failed
+
+    def __uploadMapping(self, filePath, mapping, uploadUrl, offset, prefetcher):
+        fileSize = len(mapping)
+        depth = int(self.pipelineDepth)
+        chunks = 0
+        recoveries = 0
+        while offset < fileSize:
+
+            # Schedule the read ahead, then wait until the chunk fits into the bytes in flight budget and send a view on it
+            chunkSizeBytes = self.chunkSizer.size
+            length = min(chunkSizeBytes, fileSize - offset)
+            if depth > 0:
+                prefetcher.prefetch(offset + length + chunkSizeBytes * depth)
+            self.byteBudget.acquire(length)
+            try:
+                started = time.monotonic()
+                with memoryview(mapping)[offset:offset + length] as byte:
+                    response = self.__uploadChunk(uploadUrl, byte, offset, fileSize)
+                self.chunkSizer.onSuccess(length, time.monotonic() - started)
+            except ConnectorException:
+
+                # If the chunk failed for good, ask the server which bytes it has and start again from there
+                self.chunkSizer.onFailure()
+                if recoveries >= self.retryPolicy.maxRetries:
+                    raise
+                recoveries += 1
+                offset = self.__getUploadOffset(uploadUrl)
+                self.logger.info("Chunk upload failed: resuming from byte %d", offset)
+                continue
+            finally:
+                self.byteBudget.release(length)
+
+            # Let the kernel reclaim the pages of the chunk, then move to the first byte the server is expecting, which
+            # differs from the end of the chunk only if it has been acknowledged partially
+            self.__releasePages(mapping, offset, length)
+            self.telemetry.chunkSent(filePath, length, offset + length, fileSize)
+            offset = self._getNextOffset(response.text, offset + length)
+            self.journal.update(uploadUrl, offset)
+            chunks += 1
+        return chunks
+
+    # Next offset method. Returns the first byte expected by the server according to the body of the response to a
+    # chunk, or the given default if the response does not tell (e.g. when the upload is complete)
+
+    def _getNextOffset(self, body, default):
+        try:
+            ranges = json.loads(body).get("nextExpectedRanges", [])
+            return int(ranges[0].split("-")[0]) if ranges else default
+        except Exception:
+            return default
+
+    # Page releasing method. Tells the kernel that the mapped pages of an uploaded chunk are no longer needed, so that
+    # they do not count towards the memory of the script. Pages are still shared with the file cache
+
+    def __releasePages(self, mapping, offset, length):
+        if not hasattr(mapping, "madvise") or not hasattr(mmap, "MADV_DONTNEED"):
+            return
+        start = offset - offset % mmap.PAGESIZE
+        mapping.madvise(mmap.MADV_DONTNEED, start, offset + length - start)
+
+    # Chunk transfer method. Sends a single range of bytes to the given upload url
+
+    def __uploadChunk(self, uploadUrl, byte, rangeMin, fileSize):
+        try:
+
+            # Calculate the range covered by the chunk
+            rangeMax = rangeMin + len(byte) - 1
+
+            # Log range
+            self.logger.debug("Current range is: %d ~ %d", rangeMin, rangeMax)
+
+            # Send upload request
+            headers = {
+                "Authorization": "Bearer " + self.token,
+                "Content-Length": str(len(byte)),
+                "Content-Range": "bytes " + str(rangeMin) + "-" + str(rangeMax) + "/" + str(fileSize)
+            }
+            return self.__callAPI(uploadUrl, self._throttle(byte), headers, "put")
+        except ConnectorException:
+            raise
+        except Exception as e:
+            raise ConnectorException("Error while uploading chunk: " + str(e))
+
+    # Throttling method. If the upload speed is limited, returns the given data wrapped so that it is sent slice after
+    # slice at the allowed speed, otherwise returns the data as it is
+
+    def _throttle(self, data):
+        if self.bandwidth.isLimited():
+            return ThrottledBody(data, self.bandwidth)
+        return data
+
+    # Graph call method. Sends a request to the given Graph API resource, through the active batch queue if any, so that
+    # it is grouped with the ones of the other workers, and returns the decoded body of the response
+
+    def __callGraph(self, method, resource, data=None):
+        if self.batchQueue is not None:
+            request = {
+                "method": method,
+                "url": resource
+            }
+            if data is not None:
+                request["body"] = data
+                request["headers"] = {"Content-Type": "application/json"}
+            return self.__callBatched(request)
+        url = self.graphUrl + resource
+        headers = {
+            "Authorization": "Bearer " + self.token
+        }
+        if data is not None:
+            headers["Content-Type"] = "application/json"
+            data = json.dumps(data)
+        response = self.__callAPI(url, data, headers, method.lower())
+        body = response.text
+        return json.loads(body)
+
+    # Batched call method. Queues a single Graph API request in the active batch queue, waits for its response and
+    # returns its body, or throws an exception with the error code returned for it
+
+    def __callBatched(self, request):
+        response = self.batchQueue.submit(request).result()
+        body = response.get("body") or {}
+        if response["status"] >= 400:
+            errorCode = body.get("error", {}).get("code", str(response["status"]))
+            raise ConnectorException("Error while calling endpoint: " + errorCode, errorCode)
+        return body
+
+    # Batch call method. Sends up to 20 Graph API requests with a single $batch call and returns their responses in the
+    # same order. Sub-requests throttled by the server are sent again, alone, after the time it asks to wait, and the
+    # ones refused because the token has expired are sent again with a new token, up to the configured retries
+
+    def __callBatch(self, requests):
+        try:
+            responses = [None] * len(requests)
+            pending = list(range(len(requests)))
+            attempt = 0
+            while pending:
+
+                # Log request
+                self.logger.debug("Sending %d request(s) in a single batch", len(pending))
+
+                # Send the pending requests, using their position as id
+                url = self.graphUrl + "/$batch"
+                data = {
+                    "requests": [dict(requests[i], id=str(i)) for i in pending]
+                }
+                headers = {
+                    "Authorization": "Bearer " + self.token,
+                    "Content-Type": "application/json"
+                }
+                response = self.__callAPI(url, json.dumps(data), headers)
+                body = response.text
+                body = json.loads(body)
+
+                # Demultiplex the responses, collecting the throttled ones with the longest time to wait, and the ones
+                # refused because the token has expired
+                throttled = []
+                expired = []
+                retryAfter = 0
+                for item in body["responses"]:
+                    index = int(item["id"])
+                    responses[index] = item
+                    if attempt >= self.retryPolicy.maxRetries:
+                        continue
+                    if item["status"] in (429, 503):
+                        throttled.append(index)
+                        itemHeaders = {k.lower(): v for k, v in item.get("headers", {}).items()}
+                        itemRetryAfter = RetryPolicy.parseRetryAfter(itemHeaders.get("retry-after"))
+                        retryAfter = max(retryAfter, itemRetryAfter if itemRetryAfter is not None else 2 ** attempt)
+                    elif item["status"] == 401 and \
+                            (item.get("body") or {}).get("error", {}).get("code") == "InvalidAuthenticationToken":
+                        expired.append(index)
+                pending = throttled + expired
+
+                # Make every request wait before sending the throttled ones again
+                if throttled:
+                    self.logger.info("%d batched request(s) throttled: retrying in %s second(s)", len(throttled),
+                                     retryAfter)
+                    self.concurrency.onThrottle(retryAfter)
+                    for index in throttled:
+                        self.telemetry.retry(self.graphUrl + requests[index]["url"], responses[index]["status"], attempt,
+                                             retryAfter)
+
+                # Refresh the token, like for any other request, before sending the refused ones again
+                if expired:
+                    self.__refreshToken(headers)
+                if pending:
+                    attempt += 1
+
+            # Return the responses in the order of the requests
+            return responses
+        except ConnectorException:
+            raise
+        except Exception as e:
+            raise ConnectorException("Error while sending batch: " + str(e))
+
+    # API call method. Accepts the data to be sent, refreshes the token if necessary, retries the transient failures
+    # and returns the response
     def __callAPI(self, url, data, headers, method="post"):
         try:
 
-            # Loop indefinitely
+            # Loop until the request succeeds, fails for good or runs out of attempts
+            attempt = 0
             while True:
 
                 # Log request
-                self.logger.debug("Sending request to endpoint " + url)
+                self.logger.debug("Sending request to endpoint %s", url)
 
                 # Call endpoint with the given method
-                if method == "post":
-                    response = requests.post(url, data=data, headers=headers)
-                elif method == "put":
-                    response = requests.put(url, data=data, headers=headers)
-                else:
+                if method not in ("get", "post", "put"):
                     raise ConnectorException("Missing method")
-
-                # Log response
-                self.logger.debug("Response received:")
-                self.logger.debug(response)
-                self.logger.debug(response.text)
+                response = self.__sendRequest(url, data, headers, method)
 
                 # If the request is successful, exit the loop
-                if response.ok:
+                if response is not None and response.ok:
+                    self.concurrency.onSuccess()
                     break
 
+                # If the failure is transient, wait and send the request again
+                if self.__waitForRetry(url, response, attempt):
+                    attempt += 1
+                    continue
+
                 # Check the error code
-                body = response.text
-                body = json.loads(body)
-                errorCode = body["error"]["code"]
+                if response is not None:
+                    errorCode = self._getErrorCode(response.status_code, response.text)
+                else:
+                    errorCode = self._getErrorCode(None, "")
 
                 # If token is expired, refresh it and update header
-                if errorCode == "InvalidAuthenticationToken":
-                    self.logger.debug("Token is invalid: requesting a new one")
-                    self.__exchangeToken(self.refreshToken, True)
-                    headers["Authorization"] = "Bearer " + self.token
-                    message = "Token has been refreshed"
-                    self.logger.info(message)
-                    print(message)
-
-                # Otherwise raise an exception
+                if errorCode == "InvalidAuthenticationToken" and attempt < self.retryPolicy.maxRetries:
+                    self.__refreshToken(headers)
+                    attempt += 1
+
+                # Otherwise raise an exception, keeping the error code for the callers that can handle it
                 else:
-                    raise Exception(errorCode)
+                    raise ConnectorException("Error while calling endpoint: " + errorCode, errorCode)
 
             # Return the response received
             return response
@@ -402,3 +1339,65 @@ class Connector:
             raise
         except Exception as e:
             raise ConnectorException("Error while calling endpoint: " + str(e))
+
+    # Error code method. Returns the error code found in the body of a failed response with the given status, or a
+    # description of the failure if the body does not carry one
+
+    def _getErrorCode(self, status, body):
+        if status is None:
+            return "connectionError"
+        try:
+            body = json.loads(body)
+            return body["error"]["code"]
+        except Exception:
+            return str(status)
+
+    # Token refresh method. Refreshes the expired token and updates the given headers. Only the first worker hitting
+    # an expired token refreshes it, the others wait for it and reuse the new one
+
+    def __refreshToken(self, headers):
+        self.logger.debug("Token is invalid: requesting a new one")
+        try:
+            token = self.tokenManager.refresh(headers["Authorization"][len("Bearer "):])
+        except Exception as e:
+            raise ConnectorException("Error while exchanging tokens: " + str(e))
+        headers["Authorization"] = "Bearer " + token
+        self.logger.info("Token has been refreshed")
+
+    # Request sending method. Sends a single request within the concurrency limit and returns the response, or None if
+    # the connection failed or timed out
+
+    def __sendRequest(self, url, data, headers, method):
+        self.concurrency.acquire()
+        started = time.monotonic()
+        try:
+            response = self.session.request(method, url, data=data, headers=headers, timeout=int(self.timeout))
+        except (requests.ConnectionError, requests.Timeout) as e:
+            self.logger.info("Connection to %s failed: %s", url, e)
+            return None
+        finally:
+            self.concurrency.release()
+            self.telemetry.requestDone(time.monotonic() - started)
+
+        # Log response
+        self._logResponse(response.status_code, lambda: response.text)
+        return response
+
+    # Retry waiting method. If the given failed response (None for a connection error) can be retried, waits for the
+    # time asked by the server or for a jittered exponential backoff and returns True. Throttling responses also
+    # reduce the number of requests allowed in flight, and make every worker wait for the time asked by the server
+
+    def __waitForRetry(self, url, response, attempt):
+        status = response.status_code if response is not None else None
+        if not self.retryPolicy.canRetry(status, attempt):
+            return False
+        retryAfter = RetryPolicy.parseRetryAfter(response.headers.get("Retry-After")) if response is not None else None
+        if status in (429, 503):
+            self.concurrency.onThrottle(retryAfter)
+            self.logger.info("Request throttled by the server (%d): reducing concurrency to %d", status,
+                             self.concurrency.limit)
+        delay = self.retryPolicy.getDelay(attempt, retryAfter)
+        self.logger.info("Retrying request to %s in %.2f second(s)", url, delay)
+        self.telemetry.retry(url, status, attempt, delay)
+        time.sleep(delay)
+        return True
@@ -2,8 +2,9 @@ import logging
 
 
 class ConnectorException(Exception):
-    def __init__(self, message):
+    def __init__(self, message, code=""):
         exception_logger = logging.getLogger(
             'connector_logger.connectorexception')
         exception_logger.error(message)
+        self.code = code
         super().__init__(message)
@@ -0,0 +1,306 @@
+# FakeGraphServer.py
+
+# Importing libraries
+import re
+import json
+import time
+import random
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, quote, unquote
+
+
+class FakeGraphServer:
+
+    # Object constructor. Prepares an empty drive served on the given port of the local host (0 for a free one). Every
+    # request to the drive waits for the given latency, in seconds, and is throttled or failed with the given
+    # probabilities, throttled requests asking to retry after the given seconds. If an access token is given, requests
+    # carrying a different one are refused as expired, and the token endpoint issues new ones
+    def __init__(self, port=0, latency=0, throttleRate=0, failureRate=0, retryAfter=0, accessToken=None, seed=0,
+                 hashContent=True, pageSize=200):
+        self.port = port
+        self.latency = latency
+        self.throttleRate = throttleRate
+        self.failureRate = failureRate
+        self.retryAfter = retryAfter
+        self.accessToken = accessToken
+        self.hashContent = hashContent
+        self.pageSize = pageSize
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.server = None
+        self.reset()
+
+    # Reset method. Empties the drive, forgets the upload sessions and clears the counters
+    def reset(self):
+        with self.lock:
+            self.version = 0
+            self.items = {"root": {"id": "root", "name": "root", "parent": None, "path": "", "size": 0, "folder": True,
+                                   "sha1": None, "version": 0}}
+            self.paths = {"": "root"}
+            self.sessions = {}
+            self.stats = {"requests": 0, "bytes": 0, "throttled": 0, "failed": 0, "tokens": 0}
+
+    # Context manager entry. Starts the server
+    def __enter__(self):
+        self.start()
+        return self
+
+    # Context manager exit. Stops the server
+    def __exit__(self, excType, exc, traceback):
+        self.stop()
+
+    # Start method. Starts serving in a background thread
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                fake.serve(self)
+
+            def do_POST(self):
+                fake.serve(self)
+
+            def do_PUT(self):
+                fake.serve(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", self.port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_port
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    # Stop method. Stops serving and closes the listening socket
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    # Url property. Returns the base url of the Graph API served
+    @property
+    def url(self):
+        return "http://127.0.0.1:" + str(self.port) + "/v1.0"
+
+    # Token url property. Returns the url of the token endpoint served
+    @property
+    def tokenUrl(self):
+        return "http://127.0.0.1:" + str(self.port) + "/common/oauth2/v2.0/token"
+
+    # Find method. Returns the item stored at the given path, or None if there is none
+    def find(self, path):
+        with self.lock:
+            id = self.paths.get(path.strip("/"))
+            return dict(self.items[id]) if id is not None else None
+
+    # Count method. Returns how many requests of the given kind have been served
+    def count(self, kind):
+        with self.lock:
+            return self.stats.get(kind, 0)
+
+    # Serve method. Answers a single HTTP request received by the given handler
+    def serve(self, handler):
+        length = int(handler.headers.get("Content-Length", 0))
+        body = handler.rfile.read(length) if length > 0 else b""
+        parts = urlsplit(handler.path)
+        if parts.path != "/stats":
+            with self.lock:
+                self.stats["requests"] += 1
+                self.stats["bytes"] += len(body)
+        if self.latency > 0:
+            time.sleep(self.latency)
+        status, headers, payload = self.__dispatch(handler.command, parts.path, parse_qs(parts.query),
+                                                   handler.headers, body, True)
+        data = json.dumps(payload).encode() if payload is not None else b""
+        handler.send_response(status)
+        for key, value in headers.items():
+            handler.send_header(key, value)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    # Dispatch method. Routes a request to the method handling it and returns its status, headers and body. Besides
+    # the token endpoint and the drive, the counters are served at /stats. Faults are injected in the requests to the
+    # drive, and in each request of a batch instead of in the batch itself
+    def __dispatch(self, method, path, query, headers, body, outer):
+        if path.endswith("/oauth2/v2.0/token"):
+            return self.__issueToken()
+        if path == "/stats":
+            with self.lock:
+                return 200, {}, dict(self.stats)
+        if path.startswith("/upload/"):
+            fault = self.__injectFault()
+            return fault if fault is not None else self.__handleSession(method, path[len("/upload/"):], headers, body)
+        if outer and self.accessToken is not None and headers.get("Authorization") != "Bearer " + self.accessToken:
+            return self.__error(401, "InvalidAuthenticationToken")
+        path = path[len("/v1.0"):] if path.startswith("/v1.0") else path
+        if path == "/$batch":
+            return self.__handleBatch(json.loads(body))
+        fault = self.__injectFault()
+        if fault is not None:
+            return fault
+        return self.__route(method, unquote(path), query, body)
+
+    # Route method. Handles a request to the drive
+    def __route(self, method, path, query, body):
+        children = re.match(r"^/drive/(?:root|items/([^/]+))/children$", path)
+        if children and method == "POST":
+            return self.__createFolder(children.group(1) or "root", json.loads(body))
+        address = re.match(r"^/drive/root:/(.*?)(?::/(\w+))?$", path)
+        if address is None:
+            return self.__error(400, "invalidRequest")
+        itemPath, action = address.group(1).strip("/"), address.group(2)
+        if action is None and method == "GET":
+            item = self.find(itemPath)
+            return (200, {}, self.__describe(item)) if item is not None else self.__error(404, "itemNotFound")
+        if action == "delta" and method == "GET":
+            return self.__readDelta(itemPath, query)
+        if action == "createUploadSession" and method == "POST":
+            return self.__createSession(itemPath)
+        if action == "content" and method == "PUT":
+            return 201, {}, self.__describe(self.__storeFile(itemPath, len(body), self.__hash(body)))
+        return self.__error(400, "invalidRequest")
+
+    # Fault injection method. Returns a throttling or failure response, as often as configured, or None
+    def __injectFault(self):
+        with self.lock:
+            draw = self.random.random()
+            if draw < self.throttleRate:
+                self.stats["throttled"] += 1
+                return 429, {"Retry-After": str(self.retryAfter)}, {"error": {"code": "activityLimitReached"}}
+            if draw < self.throttleRate + self.failureRate:
+                self.stats["failed"] += 1
+                return 503, {}, {"error": {"code": "serviceNotAvailable"}}
+        return None
+
+    # Token issuing method. Returns a new token pair, which becomes the only one accepted if tokens are checked
+    def __issueToken(self):
+        with self.lock:
+            self.stats["tokens"] += 1
+            token = "FAKE_TOKEN_" + str(self.stats["tokens"])
+            if self.accessToken is not None:
+                self.accessToken = token
+        return 200, {}, {"token_type": "Bearer", "expires_in": 3600, "access_token": token,
+                         "refresh_token": "FAKE_REFRESH_" + str(self.stats["tokens"])}
+
+    # Batch method. Handles every request of a batch on its own and returns their responses together
+    def __handleBatch(self, batch):
+        responses = []
+        for request in batch.get("requests", []):
+            body = json.dumps(request["body"]).encode() if "body" in request else b""
+            parts = urlsplit(request["url"])
+            status, headers, payload = self.__dispatch(request["method"], parts.path, parse_qs(parts.query), {}, body,
+                                                       False)
+            responses.append({"id": request["id"], "status": status, "headers": headers, "body": payload})
+        return 200, {}, {"responses": responses}
+
+    # Folder creation method. Creates a folder inside the folder with the given id, failing if the name is taken
+    def __createFolder(self, parentId, data):
+        with self.lock:
+            parent = self.items.get(parentId)
+            if parent is None:
+                return self.__error(404, "itemNotFound")
+            path = (parent["path"] + "/" + data["name"]).strip("/")
+            if path in self.paths:
+                return self.__error(409, "nameAlreadyExists")
+            item = self.__addItem(path, True, 0, None)
+        return 201, {}, self.__describe(item)
+
+    # Upload session creation method. Opens a session to upload a file to the given path
+    def __createSession(self, path):
+        with self.lock:
+            id = "S" + str(len(self.sessions) + 1) + "_" + str(self.random.getrandbits(32))
+            self.sessions[id] = {"path": path, "received": 0, "sha1": hashlib.sha1(), "lock": threading.Lock()}
+        return 200, {}, {"uploadUrl": "http://127.0.0.1:" + str(self.port) + "/upload/" + id,
+                         "expirationDateTime": "2099-01-01T00:00:00Z"}
+
+    # Upload session method. Reports the range expected by a session, or appends a chunk to it. A chunk must start
+    # where the previous one ended, and the last one completes the file. The chunks of a session are handled one at a
+    # time under its own lock, so that concurrent or retried chunks cannot interleave, while the server lock is only
+    # held to check and update the session, not to hash the chunk
+    def __handleSession(self, method, id, headers, body):
+        contentRange = re.match(r"bytes (\d+)-(\d+)/(\d+)", headers.get("Content-Range", ""))
+        with self.lock:
+            session = self.sessions.get(id)
+        if session is None:
+            return self.__error(404, "itemNotFound")
+        with session["lock"]:
+            with self.lock:
+                if id not in self.sessions:
+                    return self.__error(404, "itemNotFound")
+                if method == "GET":
+                    return 200, {}, {"nextExpectedRanges": [str(session["received"]) + "-"]}
+                if contentRange is None or int(contentRange.group(1)) != session["received"]:
+                    return self.__error(416, "invalidRange")
+                if int(contentRange.group(2)) - int(contentRange.group(1)) + 1 != len(body):
+                    return self.__error(400, "invalidRequest")
+                session["received"] += len(body)
+                complete = session["received"] >= int(contentRange.group(3))
+                if complete:
+                    del self.sessions[id]
+            if self.hashContent:
+                session["sha1"].update(body)
+            if not complete:
+                return 202, {}, {"nextExpectedRanges": [str(session["received"]) + "-"]}
+        sha1 = session["sha1"].hexdigest() if self.hashContent else None
+        return 201, {}, self.__describe(self.__storeFile(session["path"], session["received"], sha1))
+
+    # Delta method. Returns a page of the items under the given folder changed since the version given by the link
+    def __readDelta(self, path, query):
+        with self.lock:
+            root = self.paths.get(path)
+            if root is None:
+                return self.__error(404, "itemNotFound")
+            since = int(query.get("token", ["0"])[0])
+            skip = int(query.get("skip", ["0"])[0])
+            changed = [item for item in sorted(self.items.values(), key=lambda item: item["version"])
+                       if item["version"] > since and (item["path"] == path or item["path"].startswith(path + "/"))]
+            page = [self.__describe(item) for item in changed[skip:skip + self.pageSize]]
+            link = self.url + "/drive/root:/" + quote(path) + ":/delta?token="
+            if skip + self.pageSize < len(changed):
+                return 200, {}, {"value": page, "@odata.nextLink": link + str(since) + "&skip=" + str(skip + self.pageSize)}
+            return 200, {}, {"value": page, "@odata.deltaLink": link + str(self.version)}
+
+    # File storing method. Stores a file at the given path, replacing any previous one, and returns it
+    def __storeFile(self, path, size, sha1):
+        with self.lock:
+            return self.__addItem(path, False, size, sha1)
+
+    # Item adding method. Stores an item at the given path, creating its missing parent folders as the real service
+    # does, and returns it
+    def __addItem(self, path, isFolder, size, sha1):
+        parentPath, _, name = path.rpartition("/")
+        if parentPath not in self.paths:
+            self.__addItem(parentPath, True, 0, None)
+        self.version += 1
+        id = self.paths.get(path) or "ID" + str(self.version)
+        item = {"id": id, "name": name, "parent": self.paths[parentPath], "path": path, "size": size,
+                "folder": isFolder, "sha1": sha1, "version": self.version}
+        self.items[id] = item
+        self.paths[path] = id
+        return item
+
+    # Hashing method. Returns the SHA1 digest of the given content, if content is hashed
+    def __hash(self, content):
+        return hashlib.sha1(content).hexdigest() if self.hashContent else None
+
+    # Description method. Returns the given item as described by the Graph API
+    def __describe(self, item):
+        description = {"id": item["id"], "name": item["name"], "size": item["size"],
+                       "parentReference": {"id": item["parent"]}}
+        if item["folder"]:
+            description["folder"] = {}
+        else:
+            description["file"] = {"hashes": {"sha1Hash": item["sha1"].upper()} if item["sha1"] else {}}
+        return description
+
+    # Error method. Returns an error response with the given status and code
+    def __error(self, status, code):
+        return status, {}, {"error": {"code": code}}
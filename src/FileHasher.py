@@ -0,0 +1,104 @@
+# FileHasher.py
+
+# Importing libraries
+import os
+import mmap
+import hashlib
+import threading
+import multiprocessing
+from .QuickXorHash import QuickXorHash
+from concurrent.futures import ProcessPoolExecutor
+
+
+class FileHasher:
+
+    # Files smaller than this are hashed by the calling thread, since sending them to another process costs more than
+    # hashing them
+    THRESHOLD = 1048576
+
+    # Size of the blocks fed to the digests
+    BLOCK = 4194304
+
+    # Object constructor. Sets the number of processes hashing the files (0 to hash them in the calling thread) and the
+    # index keeping the digests already computed. The processes are started the first time a large file is hashed
+    def __init__(self, processes, index):
+        self.processes = processes
+        self.index = index
+        self.executor = None
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    # Digest computing method. Returns the SHA1 digest of the given file and, if requested, its QuickXorHash, reading
+    # it through a memory mapping. Runs in the hashing processes, so it only depends on its arguments
+    @staticmethod
+    def compute(path, quickXor=False):
+        sha1 = hashlib.sha1()
+        xor = QuickXorHash() if quickXor else None
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size > 0:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapping, memoryview(mapping) as view:
+                    for start in range(0, size, FileHasher.BLOCK):
+                        with view[start:start + FileHasher.BLOCK] as block:
+                            sha1.update(block)
+                            if xor is not None:
+                                xor.update(block)
+        return sha1.hexdigest(), xor.base64Digest() if xor is not None else None
+
+    # Schedule method. Starts hashing the given large file in background, unless its digests are already known, so
+    # that they are ready when asked for
+    def schedule(self, path, stat, quickXor=False):
+        if self.processes == 0 or stat.st_size < self.THRESHOLD or self.__findKnown(path, stat, quickXor) is not None:
+            return
+        with self.lock:
+            if (path, quickXor) not in self.pending:
+                self.pending[(path, quickXor)] = (stat, self.__getExecutor().submit(self.compute, path, quickXor))
+
+    # Hash method. Returns the SHA1 digest of the given file and, if requested, its QuickXorHash: from the index if
+    # the file has not changed since they were computed, from the background hashing if scheduled, or computed now
+    def hash(self, path, quickXor=False):
+        stat = os.stat(path)
+        known = self.__findKnown(path, stat, quickXor)
+        if known is not None:
+            return known
+        with self.lock:
+            scheduled, future = self.pending.pop((path, quickXor), (None, None))
+        if future is None or (scheduled.st_size, scheduled.st_mtime) != (stat.st_size, stat.st_mtime):
+            if self.processes > 0 and stat.st_size >= self.THRESHOLD:
+                with self.lock:
+                    future = self.__getExecutor().submit(self.compute, path, quickXor)
+            else:
+                future = None
+        digests = future.result() if future is not None else self.compute(path, quickXor)
+
+        # Keep the digests only if the file has not been changed while it was being hashed
+        current = os.stat(path)
+        if (current.st_size, current.st_mtime) == (stat.st_size, stat.st_mtime):
+            self.index.record([(os.path.abspath(path), stat.st_size, stat.st_mtime) + digests])
+        return digests
+
+    # Close method. Stops the hashing processes, if started
+    def close(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True, cancel_futures=True)
+                self.executor = None
+            self.pending = {}
+
+    # Returns the digests recorded in the index for the given file, if it has not changed since and they include the
+    # QuickXorHash when requested
+    def __findKnown(self, path, stat, quickXor):
+        entry = self.index.find(os.path.abspath(path))
+        if entry is None or entry[0] != stat.st_size or entry[1] != stat.st_mtime or entry[2] is None:
+            return None
+        if quickXor and entry[3] is None:
+            return None
+        return entry[2], entry[3]
+
+    # Returns the pool of hashing processes, starting it if needed. New processes are spawned instead of forked, since
+    # forking a process running many threads can leave locks held in the child
+    def __getExecutor(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.processes,
+                                                mp_context=multiprocessing.get_context("spawn"))
+        return self.executor
@@ -0,0 +1,50 @@
+# FileIndex.py
+
+# Importing libraries
+import os
+import sqlite3
+import threading
+
+
+class FileIndex:
+
+    # Object constructor. Opens (or creates) the database that keeps the local files found by the scans, with their
+    # digests once computed
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime REAL NOT NULL, sha1 TEXT, quickXorHash TEXT)")
+
+    # Find method. Returns size, modification time and digests recorded for the given file, if known
+    def find(self, path):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT size, mtime, sha1, quickXorHash FROM files WHERE path = ?", (path,)).fetchone()
+
+    # List method. Returns path, size, modification time and digests of the files recorded inside the given folder,
+    # ordered by path
+    def list(self, folder):
+        prefix = os.path.join(folder, "")
+        with self.lock:
+            return self.connection.execute(
+                "SELECT path, size, mtime, sha1, quickXorHash FROM files WHERE substr(path, 1, ?) = ? ORDER BY path",
+                (len(prefix), prefix)).fetchall()
+
+    # Record method. Stores the given entries, as (path, size, modification time, sha1, quickXorHash) tuples, in a
+    # single transaction. A digest not given is kept if the file has the same size and modification time, and
+    # forgotten otherwise
+    def record(self, entries):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT INTO files (path, size, mtime, sha1, quickXorHash) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (path) DO UPDATE SET "
+                "sha1 = CASE WHEN size = excluded.size AND mtime = excluded.mtime "
+                "THEN coalesce(excluded.sha1, sha1) ELSE excluded.sha1 END, "
+                "quickXorHash = CASE WHEN size = excluded.size AND mtime = excluded.mtime "
+                "THEN coalesce(excluded.quickXorHash, quickXorHash) ELSE excluded.quickXorHash END, "
+                "size = excluded.size, mtime = excluded.mtime", entries)
@@ -0,0 +1,94 @@
+# FileScanner.py
+
+# Importing libraries
+import os
+import queue
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class FileScanner:
+
+    # Folders read and not yet consumed before the threads reading the tree wait for the consumer
+    BACKLOG = 1024
+
+    # Object constructor. Prepares the scan of the tree of the given folder by the given number of threads. If given,
+    # onFolder is called with every folder read, by the thread that read it, before the folder is handed over, and
+    # the folders and files that cannot be read are logged to the given logger
+    def __init__(self, path, threads=4, onFolder=None, logger=None):
+        self.path = path
+        self.threads = threads
+        self.onFolder = onFolder
+        self.results = queue.Queue(self.BACKLOG)
+        self.stop = threading.Event()
+        self.running = 0
+        self.lock = threading.Lock()
+        self.executor = None
+        self.logger = logger or logging.getLogger('connector_logger')
+
+    # Iteration method. Reads the tree and yields every folder as soon as it has been read, as a (path, files) tuple
+    # where files lists the (name, stat) pairs of the files inside it. Folders come in no particular order. As os.walk
+    # does, links to folders are listed but not followed, and folders that cannot be read are skipped. If the consumer
+    # stops early, the threads stop too
+    def __iter__(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        self.__submit(self.path)
+        try:
+            while (item := self.results.get()) is not None:
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.stop.set()
+            self.executor.shutdown(wait=True, cancel_futures=True)
+
+    # Schedules the reading of the given folder
+    def __submit(self, folder):
+        with self.lock:
+            self.running += 1
+        self.executor.submit(self.__read, folder)
+
+    # Reads a folder, schedules the reading of its subfolders and hands its files over. The last folder to finish tells
+    # the consumer that the whole tree has been read
+    def __read(self, folder):
+        try:
+            files = []
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if self.stop.is_set():
+                        return
+                    if not entry.is_dir():
+                        files.append((entry.name, self.__stat(entry)))
+                    elif not entry.is_symlink():
+                        self.__submit(entry.path)
+            files = [(name, stat) for name, stat in files if stat is not None]
+            if self.onFolder is not None:
+                self.onFolder(folder, files)
+            self.__put((folder, files))
+        except OSError as e:
+            self.logger.info("Cannot read folder %s: %s", folder, e)
+        except Exception as e:
+            self.__put(e)
+        finally:
+            with self.lock:
+                self.running -= 1
+                if self.running == 0:
+                    self.__put(None)
+
+    # Returns the details of the file of the given folder entry, following links, or None if they cannot be read
+    def __stat(self, entry):
+        try:
+            return entry.stat()
+        except OSError as e:
+            self.logger.info("Cannot read file %s: %s", entry.path, e)
+            return None
+
+    # Waits for room in the queue and adds the given item, giving up if the consumer has gone
+    def __put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.results.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
@@ -0,0 +1,98 @@
+# JobRunner.py
+
+# Importing libraries
+import json
+from .Connector import Connector
+from .ConnectorException import ConnectorException
+from .ByteBudget import ByteBudget
+from .BandwidthLimiter import BandwidthLimiter
+from .Telemetry import Telemetry
+from concurrent.futures import ThreadPoolExecutor
+from os.path import abspath
+
+
+class JobRunner:
+
+    # Object constructor. Takes the jobs to run, each one with the configuration file of its account ("account"), the
+    # local path to upload ("source"), the remote folder to upload it into ("destination", optional) and its own
+    # upload speed limit in KB per second ("bandwidth", optional), and the amount of bytes, in MB, that all the jobs
+    # together can have in flight at the same time. The speed of all the jobs together is limited by the bandwidth
+    # limiter of the runner, which can be reconfigured while the jobs run
+    def __init__(self, jobs, maxInFlight=240, bandwidth=None):
+        for number, job in enumerate(jobs, 1):
+            if not job.get("account") or not job.get("source"):
+                raise ConnectorException("Job " + str(number) + " must have both an account and a source.")
+            if not str(job.get("bandwidth", "0")).isdigit():
+                raise ConnectorException("The bandwidth of job " + str(number) + " must be a positive integer.")
+        self.jobs = jobs
+        self.maxInFlight = maxInFlight
+        self.bandwidth = bandwidth if bandwidth is not None else BandwidthLimiter()
+        self.accounts = {}
+        self.connectors = []
+        self.telemetry = Telemetry()
+
+    # Load method. Returns a runner for the jobs listed in the given JSON file. The file holds either the list of the
+    # jobs or an object with the list ("jobs") and the limit of the upload speed of all the jobs together, in KB per
+    # second ("bandwidth"), possibly overridden by a time-of-day schedule ("schedule")
+    @staticmethod
+    def load(jobsFile, maxInFlight=240):
+        try:
+            with open(jobsFile) as f:
+                jobs = json.load(f)
+            settings = jobs if isinstance(jobs, dict) else {"jobs": jobs}
+            bandwidth = BandwidthLimiter(int(settings.get("bandwidth", 0)) * 1024,
+                                         BandwidthLimiter.parseSchedule(settings.get("schedule", "")))
+        except Exception as e:
+            raise ConnectorException("Cannot read jobs from " + jobsFile + ": " + str(e))
+        return JobRunner(settings.get("jobs", []), maxInFlight, bandwidth)
+
+    # Run method. Runs all the jobs at the same time and returns their outcomes, in the same order as the jobs: the
+    # result of the upload or the exception that stopped it. While the jobs run, their connectors are available in
+    # the same order, so that the speed limit of each job can be reconfigured
+    def run(self):
+        self.connectors = connectors = [self.__getConnector(job["account"]) for job in self.jobs]
+
+        # Give every job the same share of the bytes in flight, so that a large job cannot starve the others, and its
+        # own speed limit, if any, on top of the one of all the jobs together. The telemetry of all the jobs is
+        # gathered by the runner
+        share = self.maxInFlight * 1024 * 1024 // len(self.jobs) if self.jobs else 0
+        for connector, job in zip(connectors, self.jobs):
+            connector.byteBudget = ByteBudget(share)
+            connector.telemetry = self.telemetry
+            if "bandwidth" in job:
+                connector.bandwidth.configure(int(job["bandwidth"]) * 1024)
+            connector.bandwidth.parent = self.bandwidth
+
+        # Start the jobs and wait for all of them, then stop the processes hashing the files of every account
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, len(self.jobs))) as executor:
+                futures = [executor.submit(self.__runJob, connector, job)
+                           for connector, job in zip(connectors, self.jobs)]
+                return [future.result() for future in futures]
+        finally:
+            for account in self.accounts.values():
+                account.close()
+
+    # Connector method. Returns a new connector for the given account. The first connector of an account logs in, the
+    # next ones share its token, its connection pool and its local stores. Two accounts can never share the folder of
+    # their local stores, or the uploads of one would be resumed or skipped for the other
+    def __getConnector(self, envFile):
+        account = self.accounts.get(abspath(envFile))
+        if account is None:
+            for other in self.accounts.values():
+                if other.storeFolder == Connector.getStoreFolder(envFile):
+                    raise ConnectorException("Accounts " + other.envFile + " and " + abspath(envFile) +
+                                             " would share the same local stores.")
+        connector = Connector(envFile, account)
+        if account is None:
+            connector.login()
+            self.accounts[abspath(envFile)] = connector
+        return connector
+
+    # Job running method. Uploads the source of the given job with the given connector, returning the exception
+    # instead of raising it so that a failed job does not stop the others
+    def __runJob(self, connector, job):
+        try:
+            return connector.upload(job["source"], job.get("destination"))
+        except ConnectorException as e:
+            return e
@@ -0,0 +1,58 @@
+# QuickXorHash.py
+
+# Importing libraries
+import base64
+
+
+class QuickXorHash:
+
+    # Width of the digest, in bits, and shift between the positions two consecutive bytes are XORed at
+    WIDTH = 160
+    SHIFT = 11
+
+    # Bytes read at once. A byte is XORed at the same position as the byte 160 bytes before it, so the bytes of a block
+    # are first folded into 160 columns, each one holding the XOR of the bytes falling at the same position
+    BLOCK = 160 * 4096
+
+    # Masks used to fold a block in halves until only the 160 columns are left
+    FOLDS = [(1 << (1280 << depth)) - 1 for depth in range(11, -1, -1)]
+
+    # Object constructor. Prepares empty columns, following the interface of the hashlib digests
+    def __init__(self, data=b""):
+        self.columns = 0
+        self.length = 0
+        self.update(data)
+
+    # Update method. Adds the given bytes, or view on them, to the digest
+    def update(self, data):
+        with memoryview(data) as view:
+            for start in range(0, len(view), self.BLOCK):
+                value = int.from_bytes(view[start:start + self.BLOCK], "little")
+                for mask in self.FOLDS:
+                    value = (value & mask) ^ (value >> mask.bit_length())
+
+                # The first byte of the block goes in the column following the bytes already added
+                offset = (self.length + start) % 160 * 8
+                self.columns ^= ((value << offset) | (value >> (1280 - offset))) & self.FOLDS[-1]
+            self.length += len(view)
+
+    # Digest method. Returns the 20 bytes of the digest: every column XORed at its position, with the length of the
+    # data XORed into the last 8 bytes
+    def digest(self):
+        state = 0
+        for column in range(160):
+            value = (self.columns >> (column * 8)) & 0xFF
+            shift = column * self.SHIFT % self.WIDTH
+            state ^= (value << shift) | (value >> (self.WIDTH - shift))
+        digest = bytearray((state & ((1 << self.WIDTH) - 1)).to_bytes(20, "little"))
+        for index, value in enumerate(self.length.to_bytes(8, "little")):
+            digest[12 + index] ^= value
+        return bytes(digest)
+
+    # Hex digest method. Returns the digest as hexadecimal digits
+    def hexdigest(self):
+        return self.digest().hex()
+
+    # Base64 digest method. Returns the digest encoded as OneDrive reports it
+    def base64Digest(self):
+        return base64.b64encode(self.digest()).decode()
@@ -0,0 +1,80 @@
+# RemoteIndex.py
+
+# Importing libraries
+import sqlite3
+import threading
+
+
+class RemoteIndex:
+
+    # Object constructor. Opens (or creates) the database that keeps a compact copy of the remote folders state
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS items ("
+                "id TEXT PRIMARY KEY, root TEXT NOT NULL, path TEXT NOT NULL, size INTEGER NOT NULL, "
+                "isFolder INTEGER NOT NULL, sha1 TEXT, quickXorHash TEXT)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS itemsPath ON items (path)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS links (root TEXT PRIMARY KEY, deltaLink TEXT NOT NULL)")
+
+    # Delta link getter. Returns the link to request the changes of the given remote folder since the last sync, if any
+    def getDeltaLink(self, root):
+        with self.lock:
+            row = self.connection.execute("SELECT deltaLink FROM links WHERE root = ?", (root,)).fetchone()
+            return row[0] if row else None
+
+    # Delta link setter. Stores the link returned at the end of a sync of the given remote folder
+    def setDeltaLink(self, root, deltaLink):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO links (root, deltaLink) VALUES (?, ?)", (root, deltaLink))
+
+    # Reset method. Forgets everything known about the given remote folder, so that the next sync starts over
+    def reset(self, root):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM items WHERE root = ?", (root,))
+            self.connection.execute("DELETE FROM links WHERE root = ?", (root,))
+
+    # Find method. Returns size, folder flag, hashes and id of the item at the given path, if known
+    def find(self, path):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT size, isFolder, sha1, quickXorHash, id FROM items WHERE path = ?", (path,)).fetchone()
+
+    # Page application method. Applies a page of items returned by the delta API of the given remote folder. Parents
+    # always come before their children, so the path of every item can be built from the one of its parent
+    def applyPage(self, root, items):
+        with self.lock, self.connection:
+            for item in items:
+                if "deleted" in item:
+                    self.__delete(item["id"])
+                else:
+                    self.__upsert(root, item)
+
+    # Stores a single item, moving its children along if it is a folder that has been renamed or moved
+    def __upsert(self, root, item):
+        parentId = item.get("parentReference", {}).get("id")
+        parent = self.connection.execute("SELECT path FROM items WHERE id = ?", (parentId,)).fetchone()
+        path = parent[0] + "/" + item["name"] if parent else root
+        previous = self.connection.execute("SELECT path FROM items WHERE id = ?", (item["id"],)).fetchone()
+        if previous and previous[0] != path:
+            self.connection.execute(
+                "UPDATE items SET path = ? || substr(path, ?) WHERE substr(path, 1, ?) = ?",
+                (path, len(previous[0]) + 1, len(previous[0]) + 1, previous[0] + "/"))
+        hashes = item.get("file", {}).get("hashes", {})
+        self.connection.execute(
+            "INSERT OR REPLACE INTO items (id, root, path, size, isFolder, sha1, quickXorHash) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (item["id"], root, path, item.get("size", 0), int("folder" in item), hashes.get("sha1Hash"),
+             hashes.get("quickXorHash")))
+
+    # Removes a single item, together with its children if it is a folder
+    def __delete(self, id):
+        previous = self.connection.execute("SELECT path FROM items WHERE id = ?", (id,)).fetchone()
+        if previous:
+            self.connection.execute(
+                "DELETE FROM items WHERE substr(path, 1, ?) = ?", (len(previous[0]) + 1, previous[0] + "/"))
+        self.connection.execute("DELETE FROM items WHERE id = ?", (id,))
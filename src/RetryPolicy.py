@@ -0,0 +1,36 @@
+# RetryPolicy.py
+
+# Importing libraries
+import random
+
+
+class RetryPolicy:
+
+    # HTTP status codes of the errors that are worth retrying
+    RETRYABLE = (429, 500, 502, 503, 504)
+
+    # Object constructor. Sets how many times a request can be retried and the bounds of the backoff, in seconds
+    def __init__(self, maxRetries=5, base=1, cap=60):
+        self.maxRetries = maxRetries
+        self.base = base
+        self.cap = cap
+
+    # Retry check method. Returns True if a request that failed with the given status (None for a connection error)
+    # at the given attempt can be sent again
+    def canRetry(self, status, attempt):
+        return attempt < self.maxRetries and (status is None or status in self.RETRYABLE)
+
+    # Delay method. Returns how long to wait before the next attempt: the time asked by the server if any, otherwise
+    # a random time up to an exponentially growing bound ("full jitter"), so that the workers do not retry all together
+    def getDelay(self, attempt, retryAfter=None):
+        if retryAfter is not None:
+            return retryAfter
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+    # Retry-After parsing method. Returns the number of seconds in the given header value, or None if it is missing
+    # or expressed as a date. Headers of the batched responses can hold the number itself instead of a string
+    @staticmethod
+    def parseRetryAfter(value):
+        if value is None or not str(value).strip().isdigit():
+            return None
+        return int(str(value).strip())
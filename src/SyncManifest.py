@@ -0,0 +1,33 @@
+# SyncManifest.py
+
+# Importing libraries
+import sqlite3
+import threading
+
+
+class SyncManifest:
+
+    # Object constructor. Opens (or creates) the manifest database that keeps track of the files already uploaded
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "path TEXT NOT NULL, remotePath TEXT NOT NULL, size INTEGER NOT NULL, mtime REAL NOT NULL, "
+                "hash TEXT NOT NULL, PRIMARY KEY (path, remotePath))")
+
+    # Find method. Returns size, modification time and hash recorded for the given file, if it was uploaded before
+    def find(self, path, remotePath):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT size, mtime, hash FROM files WHERE path = ? AND remotePath = ?", (path, remotePath)).fetchone()
+
+    # Record method. Stores the state of the given file as it has been uploaded
+    def record(self, path, remotePath, size, mtime, hash):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO files (path, remotePath, size, mtime, hash) VALUES (?, ?, ?, ?, ?)",
+                (path, remotePath, size, mtime, hash))
@@ -0,0 +1,179 @@
+# Telemetry.py
+
+# Importing libraries
+import os
+import json
+import time
+import logging
+import threading
+
+
+class Telemetry:
+
+    # Counters kept, with the help shown when they are exported
+    COUNTERS = {
+        "requests_total": "Requests sent to the server",
+        "bytes_sent_total": "Bytes of file content acknowledged by the server",
+        "chunks_total": "Chunks and small files acknowledged by the server",
+        "files_uploaded_total": "Files uploaded",
+        "files_skipped_total": "Files skipped because unchanged",
+        "files_failed_total": "Files that could not be uploaded",
+        "retries_total": "Requests sent again after a transient failure",
+        "throttle_events_total": "Responses asking to slow down",
+        "token_refreshes_total": "Access tokens refreshed"
+    }
+
+    # Histograms kept, with their help and the upper bounds of their buckets
+    HISTOGRAMS = {
+        "request_seconds": ("Time taken by a request to be answered",
+                            (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)),
+        "chunk_bytes": ("Size of the chunks and small files sent",
+                        (65536, 262144, 1048576, 4194304, 16777216, 67108864))
+    }
+
+    # Events that can be hooked, each one called with keyword arguments describing it
+    EVENTS = ("fileStarted", "fileCompleted", "fileSkipped", "fileFailed", "chunkSent", "retry", "tokenRefreshed",
+              "progress")
+
+    # Object constructor. Prepares empty counters and histograms, and the prefix of the exported metrics
+    def __init__(self, prefix="onedrive_connector_"):
+        self.prefix = prefix
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.histograms = {name: {"buckets": [0] * (len(bounds) + 1), "sum": 0, "count": 0}
+                           for name, (help, bounds) in self.HISTOGRAMS.items()}
+        self.hooks = {event: [] for event in self.EVENTS}
+        self.filesTotal = 0
+        self.bytesTotal = 0
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger('connector_logger')
+
+    # Hook method. Registers a function to call every time the given event happens
+    def on(self, event, callback):
+        if event not in self.hooks:
+            raise ValueError("unknown event " + event)
+        self.hooks[event].append(callback)
+
+    # Emit method. Calls the functions hooked to the given event. A failing hook is logged and does not stop the upload
+    def emit(self, event, **data):
+        for callback in self.hooks[event]:
+            try:
+                callback(**data)
+            except Exception as e:
+                self.logger.error("Telemetry hook for %s failed: %s", event, e)
+
+    # Increment method. Adds the given value to a counter
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    # Observe method. Records a value in a histogram
+    def observe(self, name, value):
+        bounds = self.HISTOGRAMS[name][1]
+        with self.lock:
+            histogram = self.histograms[name]
+            histogram["buckets"][next((i for i, bound in enumerate(bounds) if value <= bound), len(bounds))] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    # Discovery method. Adds a file found by an upload to the totals used to estimate the remaining time
+    def addPending(self, size):
+        with self.lock:
+            self.filesTotal += 1
+            self.bytesTotal += size
+
+    # Progress method. Returns the files and bytes done so far out of the ones found, the average speed, in bytes
+    # per second, and the estimated seconds left (None until something has been sent)
+    def getProgress(self):
+        with self.lock:
+            filesDone = self.counters["files_uploaded_total"] + self.counters["files_skipped_total"] + \
+                self.counters["files_failed_total"]
+            bytesDone = self.counters["bytes_sent_total"]
+            elapsed = time.monotonic() - self.started
+            speed = bytesDone / elapsed if elapsed > 0 else 0
+            return {
+                "filesDone": filesDone,
+                "filesTotal": self.filesTotal,
+                "bytesDone": bytesDone,
+                "bytesTotal": self.bytesTotal,
+                "speed": speed,
+                "eta": max(0, self.bytesTotal - bytesDone) / speed if speed > 0 else None
+            }
+
+    # File start method. Records the start of the transfer of a file
+    def fileStarted(self, path, size):
+        self.emit("fileStarted", path=path, size=size)
+
+    # File end method. Records how the transfer of a file ended: "uploaded", "skipped" or "failed"
+    def fileFinished(self, path, outcome, error=None):
+        self.increment("files_" + outcome + "_total")
+        if outcome == "uploaded":
+            self.emit("fileCompleted", path=path)
+        elif outcome == "skipped":
+            self.emit("fileSkipped", path=path)
+        else:
+            self.emit("fileFailed", path=path, error=error)
+        self.emit("progress", **self.getProgress())
+
+    # Chunk method. Records a chunk of the given file acknowledged by the server, ending at the given offset
+    def chunkSent(self, path, length, offset, size):
+        self.increment("bytes_sent_total", length)
+        self.increment("chunks_total")
+        self.observe("chunk_bytes", length)
+        self.emit("chunkSent", path=path, length=length, offset=offset, size=size)
+        self.emit("progress", **self.getProgress())
+
+    # Request method. Records a request answered, or failed, after the given seconds
+    def requestDone(self, seconds):
+        self.increment("requests_total")
+        self.observe("request_seconds", seconds)
+
+    # Retry method. Records a request about to be sent again after the given failure status (None for a connection
+    # error), telling whether the server asked to slow down
+    def retry(self, url, status, attempt, delay):
+        self.increment("retries_total")
+        if status in (429, 503):
+            self.increment("throttle_events_total")
+        self.emit("retry", url=url, status=status, attempt=attempt, delay=delay)
+
+    # Token refresh method. Records a new access token
+    def tokenRefreshed(self):
+        self.increment("token_refreshes_total")
+        self.emit("tokenRefreshed")
+
+    # Prometheus export method. Returns the counters and the histograms in the Prometheus text format
+    def toPrometheus(self):
+        lines = []
+        with self.lock:
+            for name, help in self.COUNTERS.items():
+                lines += ["# HELP " + self.prefix + name + " " + help, "# TYPE " + self.prefix + name + " counter",
+                          self.prefix + name + " " + str(self.counters[name])]
+            for name, (help, bounds) in self.HISTOGRAMS.items():
+                histogram = self.histograms[name]
+                lines += ["# HELP " + self.prefix + name + " " + help, "# TYPE " + self.prefix + name + " histogram"]
+                cumulative = 0
+                for bound, count in zip(list(bounds) + ["+Inf"], histogram["buckets"]):
+                    cumulative += count
+                    lines.append(self.prefix + name + '_bucket{le="' + str(bound) + '"} ' + str(cumulative))
+                lines += [self.prefix + name + "_sum " + str(histogram["sum"]),
+                          self.prefix + name + "_count " + str(histogram["count"])]
+        return "\n".join(lines) + "\n"
+
+    # File export method. Writes the metrics to the given file, in the Prometheus text format or, if the name of the
+    # file ends with .json, as JSON. The file is written aside and then moved over the old one, so that a collector
+    # reading it never finds it half written
+    def exportTo(self, path):
+        with open(path + ".tmp", "w") as f:
+            f.write(self.toJson() if path.endswith(".json") else self.toPrometheus())
+        os.replace(path + ".tmp", path)
+
+    # JSON export method. Returns the counters, the histograms and the progress as a JSON document
+    def toJson(self):
+        progress = self.getProgress()
+        with self.lock:
+            histograms = {}
+            for name, (help, bounds) in self.HISTOGRAMS.items():
+                histogram = self.histograms[name]
+                histograms[name] = {"buckets": dict(zip([str(bound) for bound in bounds] + ["+Inf"], histogram["buckets"])),
+                                    "sum": histogram["sum"], "count": histogram["count"]}
+            return json.dumps({"counters": dict(self.counters), "histograms": histograms, "progress": progress})
@@ -0,0 +1,26 @@
+# ThrottledBody.py
+
+
+class ThrottledBody:
+
+    # Size of the slices the body is sent in
+    SLICE = 262144
+
+    # Object constructor. Wraps the data to send, as bytes or as a view on them, and the limiter every slice is
+    # charged to before being sent. A view is kept as it is, so that it can still be released by its owner
+    def __init__(self, data, limiter):
+        self.data = data if isinstance(data, memoryview) else memoryview(data)
+        self.limiter = limiter
+
+    # Length method. Returns the size of the body, so that it is sent with its length instead of in chunked encoding
+    def __len__(self):
+        return len(self.data)
+
+    # Iteration method. Yields the body slice after slice, waiting for the limiter before each one, and releases every
+    # slice once it has been sent. A new iteration starts again from the beginning, so that the body can be sent again
+    # when a request is retried
+    def __iter__(self):
+        for start in range(0, len(self.data), self.SLICE):
+            with self.data[start:start + self.SLICE] as piece:
+                self.limiter.consume(len(piece))
+                yield piece
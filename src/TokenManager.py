@@ -0,0 +1,123 @@
+# TokenManager.py
+
+# Importing libraries
+import time
+import logging
+import threading
+
+
+class TokenManager:
+
+    # Endpoint used to exchange codes and refresh tokens, and redirect uri registered for the app
+    URL = "https://login.microsoftonline.com/common/oauth2/v2.0/token"
+    REDIRECT = "https://apps.francescorega.eu/1DToken"
+
+    # Seconds before the expiry of the access token from which a new one is requested in background
+    MARGIN = 300
+
+    # Object constructor. Keeps the credentials of the app, the current token pair with the time it expires at (0 if
+    # unknown), the function sending a form to the token endpoint and returning the decoded response, and the function
+    # used to persist a new token pair
+    def __init__(self, clientId, clientSecret, accessToken, refreshToken, expiresAt, exchange, save):
+        self.clientId = clientId
+        self.clientSecret = clientSecret
+        self.accessToken = accessToken
+        self.refreshToken = refreshToken
+        self.expiresAt = expiresAt
+        self.exchange = exchange
+        self.save = save
+        self.lock = threading.Lock()
+        self.refreshLock = threading.Lock()
+        self.saveLock = threading.Lock()
+        self.refreshing = False
+        self.retryAt = 0
+        self.saving = None
+        self.listeners = []
+        self.logger = logging.getLogger('connector_logger')
+
+    # Request data method. Returns the form to send to the token endpoint to exchange the given authorization code, or
+    # the given refresh token
+    def getRequestData(self, code, isRefresh=False):
+        data = {
+            'client_id': self.clientId,
+            'redirect_uri': self.REDIRECT,
+            'client_secret': self.clientSecret,
+        }
+        if isRefresh:
+            data["refresh_token"] = code
+            data["grant_type"] = 'refresh_token'
+        else:
+            data["code"] = code
+            data["grant_type"] = 'authorization_code'
+        return data
+
+    # Token method. Returns the access token to use. If it is about to expire a new one is requested in background,
+    # while the current one is still returned; if it has already expired, waits for the new one
+    def getToken(self):
+        if self.expiresAt > 0 and self.refreshToken != "":
+            remaining = self.expiresAt - time.time()
+            if remaining <= 0:
+                return self.refresh(self.accessToken)
+            if remaining <= self.MARGIN:
+                self.__refreshInBackground()
+        return self.accessToken
+
+    # Refresh method. Exchanges the refresh token for a new token pair, unless the given access token has already been
+    # replaced in the meantime, and returns the new access token. Only one refresh runs at a time: the callers arriving
+    # while it runs wait for it and share its result. The functions registered as listeners are called after every
+    # refresh
+    def refresh(self, expiredToken=None):
+        with self.refreshLock:
+            if expiredToken is not None and expiredToken != self.accessToken:
+                return self.accessToken
+            token = self.update(self.exchange(self.getRequestData(self.refreshToken, True)))
+        for listener in self.listeners:
+            listener()
+        return token
+
+    # Update method. Stores the token pair returned by the token endpoint, keeping the current refresh token if a new
+    # one has not been issued, starts persisting it and returns the new access token
+    def update(self, body):
+        with self.lock:
+            self.accessToken = body["access_token"]
+            self.refreshToken = body.get("refresh_token", self.refreshToken)
+            self.expiresAt = time.time() + int(body["expires_in"]) if "expires_in" in body else 0
+            self.saving = threading.Thread(target=self.__persist)
+            self.saving.start()
+            return self.accessToken
+
+    # Flush method. Waits until the last token pair has been persisted
+    def flush(self):
+        saving = self.saving
+        if saving is not None:
+            saving.join()
+
+    # Background refresh method. Starts refreshing the token in a separate thread, unless a refresh is already running
+    # or the last one failed less than a minute ago
+    def __refreshInBackground(self):
+        with self.lock:
+            if self.refreshing or time.time() < self.retryAt:
+                return
+            self.refreshing = True
+        threading.Thread(target=self.__refreshAhead, args=(self.accessToken,), daemon=True).start()
+
+    # Ahead refresh method. Refreshes the given token before it expires. A failure is only logged, since the token is
+    # still valid and will be refreshed again on next use
+    def __refreshAhead(self, token):
+        try:
+            self.refresh(token)
+            self.logger.info("Token refreshed ahead of its expiry")
+        except Exception as e:
+            self.retryAt = time.time() + 60
+            self.logger.info("Cannot refresh token ahead of its expiry: %s", e)
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+    # Persist method. Saves the current token pair, one save at a time so that the last one always wins
+    def __persist(self):
+        with self.saveLock:
+            try:
+                self.save()
+            except Exception as e:
+                self.logger.error("Cannot save token pair: %s", e)
@@ -0,0 +1,61 @@
+# UploadJournal.py
+
+# Importing libraries
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+
+class UploadJournal:
+
+    # Object constructor. Opens (or creates) the journal database that keeps track of the open upload sessions
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "path TEXT NOT NULL, remotePath TEXT NOT NULL, size INTEGER NOT NULL, mtime REAL NOT NULL, "
+                "uploadUrl TEXT NOT NULL UNIQUE, expiration TEXT NOT NULL, offset INTEGER NOT NULL DEFAULT 0, "
+                "PRIMARY KEY (path, remotePath))")
+
+    # Find method. Returns the upload url and the acknowledged offset of a resumable session for the given file, if any.
+    # Sessions opened for a different version of the file or already expired are dropped
+    def find(self, path, remotePath, size, mtime):
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                "SELECT size, mtime, uploadUrl, expiration, offset FROM sessions WHERE path = ? AND remotePath = ?",
+                (path, remotePath)).fetchone()
+            if row is None:
+                return None
+            if row[0] != size or row[1] != mtime or self.__isExpired(row[3]):
+                self.connection.execute("DELETE FROM sessions WHERE path = ? AND remotePath = ?", (path, remotePath))
+                return None
+            return row[2], row[4]
+
+    # Save method. Records a new upload session for the given file
+    def save(self, path, remotePath, size, mtime, uploadUrl, expiration):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO sessions (path, remotePath, size, mtime, uploadUrl, expiration, offset) "
+                "VALUES (?, ?, ?, ?, ?, ?, 0)", (path, remotePath, size, mtime, uploadUrl, expiration))
+
+    # Update method. Records the number of bytes acknowledged by the server for the given session
+    def update(self, uploadUrl, offset):
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE sessions SET offset = ? WHERE uploadUrl = ?", (offset, uploadUrl))
+
+    # Remove method. Forgets the given session, once completed or no longer valid
+    def remove(self, uploadUrl):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM sessions WHERE uploadUrl = ?", (uploadUrl,))
+
+    # Checks whether the given expiration date returned by Graph API (e.g. 2021-01-01T00:00:00.000Z) is in the past
+    def __isExpired(self, expiration):
+        try:
+            date = datetime.strptime(expiration[:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc)
+        except ValueError:
+            return True
+        return date <= datetime.now(timezone.utc)
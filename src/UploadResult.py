@@ -0,0 +1,47 @@
+# UploadResult.py
+
+# Importing libraries
+import threading
+
+
+class UploadResult:
+
+    # Object constructor. Prepares the counters shared by all the upload workers
+    def __init__(self):
+        self.uploaded = []
+        self.failed = {}
+        self.skipped = []
+        self.bytesUploaded = 0
+        self.lock = threading.Lock()
+
+    # Successful upload method. Records a file that has been completely transferred
+    def addUploaded(self, path, size):
+        with self.lock:
+            self.uploaded.append(path)
+            self.bytesUploaded += size
+
+    # Skipped upload method. Records a file that did not need to be transferred because it is unchanged
+    def addSkipped(self, path):
+        with self.lock:
+            self.skipped.append(path)
+
+    # Failed upload method. Records a file that could not be transferred together with its error
+    def addFailed(self, path, error):
+        with self.lock:
+            self.failed[path] = str(error)
+
+    # Returns True if every file has been uploaded
+    @property
+    def ok(self):
+        return len(self.failed) == 0
+
+    # Builds the confirmation message shown at the end of the upload
+    def __str__(self):
+        message = "Upload completed. " + str(len(self.uploaded)) + " file(s) uploaded"
+        if self.skipped:
+            message += ", " + str(len(self.skipped)) + " file(s) unchanged"
+        if self.failed:
+            message += ", " + str(len(self.failed)) + " file(s) failed:"
+            for path, error in self.failed.items():
+                message += "\n" + path + ": " + error
+        return message
@@ -1,9 +1,35 @@
+import io
 import os
+import re
 import json
+import asyncio
+import hashlib
+import shutil
+import tarfile
+import tempfile
+import time
+import logging
 import unittest
+import threading
+import requests
 import requests_mock
+from requests.adapters import HTTPAdapter
+from unittest import mock
+from aioresponses import aioresponses
+from logging.handlers import QueueHandler
 from src.Connector import Connector
+from src.AsyncConnector import AsyncConnector
 from src.ConnectorException import ConnectorException
+from src.ChunkSizer import ChunkSizer
+from src.RetryPolicy import RetryPolicy
+from src.JobRunner import JobRunner
+from src.BandwidthLimiter import BandwidthLimiter
+from src.ThrottledBody import ThrottledBody
+from src.FakeGraphServer import FakeGraphServer
+from src.FileScanner import FileScanner
+from src.FileHasher import FileHasher
+from src.QuickXorHash import QuickXorHash
+from src.BundlePacker import BundlePacker
 
 
 class TestConnector(unittest.TestCase):
@@ -19,6 +45,32 @@ class TestConnector(unittest.TestCase):
                 f.write("ACCESSTOKEN=FAKE_ACCESSTOKEN\n")
                 f.write("REFRESHTOKEN=FAKE_REFRESHTOKEN")
 
+    def batch_callback(self, request, context):
+        responses = []
+        for item in request.json()["requests"]:
+            if item["url"].endswith("/children"):
+                folder_id = "ID_" + item["body"]["name"].upper()
+                responses.append({"id": item["id"], "status": 201, "body": {"id": folder_id, "name": item["body"]["name"]}})
+            elif item["url"].endswith("/sub/broken.txt:/createUploadSession"):
+                responses.append({"id": item["id"], "status": 500, "body": {"error": {"code": "generalException"}}})
+            elif item["url"].endswith("/a.txt:/createUploadSession") and not getattr(self, "throttled", False):
+                self.throttled = True
+                responses.append({"id": item["id"], "status": 429, "headers": {"Retry-After": "0"}})
+            else:
+                responses.append({"id": item["id"], "status": 200,
+                                  "body": {"uploadUrl": "https://sn1234.up.1drv.com/up/fakeurl"}})
+        return {"responses": responses}
+
+    def write_env(self, path, server=None, **settings):
+        settings = {"ACCESSTOKEN": "FAKE_ACCESSTOKEN", "REFRESHTOKEN": "FAKE_REFRESHTOKEN", **settings}
+        if server is not None:
+            settings.update(GRAPHURL=server.url, TOKENURL=server.tokenUrl)
+        with open(path, "w") as f:
+            f.write("FILENAME=unused\nBLOCKSIZE=1\nCLIENTID=FAKE_CLIENTID\nCLIENTSECRET=FAKE_CLIENTSECRET\n")
+            f.writelines(key + "=" + value + "\n" for key, value in settings.items())
+        self.addCleanup(shutil.rmtree, Connector.getStoreFolder(path), ignore_errors=True)
+        return path
+
     def test_init(self):
         try:
             Connector()
@@ -38,6 +90,7 @@ class TestConnector(unittest.TestCase):
                            text=json.dumps(expected_result))
             try:
                 connector = Connector()
+                connector.tokenManager.save = lambda: None
                 token = connector._Connector__exchangeToken("FAKE_CODE")
                 self.assertEqual("FAKE_ACCESSTOKEN", token)
             except ConnectorException as e:
@@ -99,3 +152,734 @@ class TestConnector(unittest.TestCase):
             except ConnectorException as e:
                 self.fail(
                     "__getUploadUrl() raised a ConnectorException: " + str(e))
+
+    def test_upload_directory(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(os.path.join(tmp, "sub"))
+            for name in ["a.txt", "b.txt", os.path.join("sub", "broken.txt")]:
+                with open(os.path.join(tmp, name), "wb") as f:
+                    f.write(b"FAKE_CONTENT")
+            with requests_mock.Mocker() as m:
+                m.register_uri('POST', '/v1.0/$batch', json=self.batch_callback)
+                m.register_uri('PUT', 'https://sn1234.up.1drv.com/up/fakeurl',
+                               text=json.dumps({"id": "000000-000000-000000"}))
+                try:
+                    connector = Connector()
+                    connector.chunkSize = "1"
+                    connector.smallFileSize = "0"
+                    result = connector.upload(tmp)
+                    self.assertEqual(2, len(result.uploaded))
+                    self.assertEqual([os.path.join(tmp, "sub", "broken.txt")], list(result.failed))
+                    self.assertFalse(result.ok)
+                    self.assertTrue(self.throttled)
+                    urls = [r["url"] for h in m.request_history if h.url.endswith("$batch") for r in h.json()["requests"]]
+                    self.assertIn("/drive/items/ID_" + os.path.basename(tmp).upper() + "/children", urls)
+                except ConnectorException as e:
+                    self.fail("upload() raised a ConnectorException: " + str(e))
+
+    def test_batch_retries(self):
+        calls = []
+
+        def batch(request, context):
+            calls.append(request.headers["Authorization"])
+            item = request.json()["requests"][0]
+            if len(calls) == 1:
+                return {"responses": [{"id": item["id"], "status": 401,
+                                       "body": {"error": {"code": "InvalidAuthenticationToken"}}}]}
+            return {"responses": [{"id": item["id"], "status": 429, "headers": {"Retry-After": "0"}}]}
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST', '/v1.0/$batch', json=batch)
+            m.register_uri('POST', '/common/oauth2/v2.0/token',
+                           text=json.dumps({"access_token": "NEW_ACCESSTOKEN", "refresh_token": "NEW_REFRESHTOKEN"}))
+            try:
+                connector = Connector()
+                connector.tokenManager.save = lambda: None
+                connector.retryPolicy.maxRetries = 2
+                responses = connector._Connector__callBatch([{"method": "GET", "url": "/drive/root"}])
+                self.assertEqual(429, responses[0]["status"])
+                self.assertEqual(["Bearer FAKE_ACCESSTOKEN", "Bearer NEW_ACCESSTOKEN", "Bearer NEW_ACCESSTOKEN"], calls)
+            except ConnectorException as e:
+                self.fail("__callBatch() raised a ConnectorException: " + str(e))
+
+    def test_stream_folders(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(os.path.join(tmp, "late"))
+            for name in ["early.txt", os.path.join("late", "late.txt")]:
+                with open(os.path.join(tmp, name), "wb") as f:
+                    f.write(b"FAKE_CONTENT")
+            uploading = threading.Event()
+            waited = []
+            scandir = os.scandir
+
+            # The scan of the second folder waits for the upload of the file of the first one
+            def scan(path):
+                if os.path.basename(path) == "late":
+                    waited.append(uploading.wait(5))
+                return scandir(path)
+
+            def receive(request, context):
+                uploading.set()
+                return json.dumps({"id": "000000-000000-000000"})
+            with requests_mock.Mocker() as m, mock.patch("os.scandir", scan):
+                m.register_uri('POST', '/v1.0/$batch', json=self.batch_callback)
+                m.register_uri('PUT', 'https://sn1234.up.1drv.com/up/fakeurl', text=receive)
+                try:
+                    connector = Connector()
+                    connector.chunkSize = "1"
+                    connector.smallFileSize = "0"
+                    result = connector.upload(tmp)
+                    self.assertEqual(2, len(result.uploaded))
+                    self.assertEqual([True], waited)
+                    names = [r["body"]["name"] for h in m.request_history if h.url.endswith("$batch")
+                             for r in h.json()["requests"] if r["url"].endswith("/children")]
+                    self.assertEqual([os.path.basename(tmp), "late"], names)
+                except ConnectorException as e:
+                    self.fail("upload() raised a ConnectorException: " + str(e))
+
+    def test_session_pool(self):
+        with tempfile.TemporaryDirectory() as tmp, mock.patch("src.Connector.HTTPAdapter", wraps=HTTPAdapter) as adapters:
+            try:
+                connector = Connector()
+                self.assertGreaterEqual(adapters.call_args.kwargs["pool_maxsize"], 10)
+                adapter = connector.session.get_adapter("https://graph.microsoft.com")
+                self.assertIs(adapter, connector.session.get_adapter("https://sn1234.up.1drv.com"))
+
+                # A configured size replaces the default one
+                Connector(self.write_env(os.path.join(tmp, "pool_" + os.path.basename(tmp) + ".env"), POOLSIZE="3"))
+                self.assertEqual(3, adapters.call_args.kwargs["pool_maxsize"])
+            except ConnectorException as e:
+                self.fail("Connector() raised a ConnectorException: " + str(e))
+
+    def test_resume_upload(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "resumed.txt")
+            with open(path, "wb") as f:
+                f.write(b"FAKE_CONTENT")
+            with requests_mock.Mocker() as m:
+                m.register_uri('GET', 'https://sn1234.up.1drv.com/up/resumedurl',
+                               text=json.dumps({"nextExpectedRanges": ["5-11"]}))
+                m.register_uri('PUT', 'https://sn1234.up.1drv.com/up/resumedurl',
+                               text=json.dumps({"id": "000000-000000-000000"}))
+                try:
+                    connector = Connector()
+                    connector.chunkSize = "1"
+                    connector.smallFileSize = "0"
+                    stat = os.stat(path)
+                    connector.journal.save(path, "resumed.txt", stat.st_size, stat.st_mtime,
+                                           "https://sn1234.up.1drv.com/up/resumedurl", "2999-01-01T00:00:00.000Z")
+                    connector.upload(path)
+                    self.assertEqual("bytes 5-11/12", m.request_history[-1].headers["Content-Range"])
+                    self.assertIsNone(connector.journal.find(path, "resumed.txt", stat.st_size, stat.st_mtime))
+                except ConnectorException as e:
+                    self.fail("upload() raised a ConnectorException: " + str(e))
+
+    def test_incremental_upload(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in ["same.txt", "touched.txt", "changed.txt"]:
+                with open(os.path.join(tmp, name), "wb") as f:
+                    f.write(b"FAKE_CONTENT")
+            with requests_mock.Mocker() as m:
+                m.register_uri('POST', '/v1.0/drive/root/children',
+                               text=json.dumps({"id": "000000-000000-000000", "name": os.path.basename(tmp)}))
+                m.register_uri('POST', re.compile(r':/createUploadSession$'),
+                               text=json.dumps({"uploadUrl": "https://sn1234.up.1drv.com/up/fakeurl"}))
+                m.register_uri('PUT', 'https://sn1234.up.1drv.com/up/fakeurl',
+                               text=json.dumps({"id": "000000-000000-000000"}))
+                m.register_uri('GET', re.compile(r':/delta'), status_code=404,
+                               text=json.dumps({"error": {"code": "itemNotFound"}}))
+                try:
+                    connector = Connector()
+                    connector.chunkSize = "1"
+                    connector.smallFileSize = "0"
+                    connector.incremental = "true"
+                    connector.batching = "false"
+                    self.assertEqual(3, len(connector.upload(tmp).uploaded))
+                    os.utime(os.path.join(tmp, "touched.txt"), (0, 0))
+                    with open(os.path.join(tmp, "changed.txt"), "wb") as f:
+                        f.write(b"FAKE_CONTENT_CHANGED")
+                    result = connector.upload(tmp)
+                    self.assertEqual([os.path.join(tmp, "changed.txt")], result.uploaded)
+                    self.assertEqual(2, len(result.skipped))
+                except ConnectorException as e:
+                    self.fail("upload() raised a ConnectorException: " + str(e))
+
+    def test_remote_index(self):
+        first_page = {
+            "value": [
+                {"id": "ROOT", "name": "FAKE_FOLDER", "folder": {}, "parentReference": {"id": "DRIVE"}},
+                {"id": "SUB", "name": "sub", "folder": {}, "parentReference": {"id": "ROOT"}},
+                {"id": "FILE", "name": "a.txt", "size": 12, "parentReference": {"id": "SUB"},
+                 "file": {"hashes": {"sha1Hash": "FAKE_SHA1"}}}
+            ],
+            "@odata.nextLink": "https://graph.microsoft.com/v1.0/drive/root:/FAKE_FOLDER:/delta?token=page2"
+        }
+        second_page = {
+            "value": [
+                {"id": "SUB", "name": "renamed", "folder": {}, "parentReference": {"id": "ROOT"}}
+            ],
+            "@odata.deltaLink": "https://graph.microsoft.com/v1.0/drive/root:/FAKE_FOLDER:/delta?token=latest"
+        }
+        with requests_mock.Mocker() as m:
+            m.register_uri('GET', '/v1.0/drive/root:/FAKE_FOLDER:/delta', [
+                {"text": json.dumps(first_page)}, {"text": json.dumps(second_page)}])
+            try:
+                connector = Connector()
+                connector.remoteIndex.reset("FAKE_FOLDER")
+                pages = connector._Connector__syncRemoteIndex("FAKE_FOLDER")
+                self.assertEqual(2, pages)
+                self.assertIsNone(connector.remoteIndex.find("FAKE_FOLDER/sub/a.txt"))
+                self.assertEqual((12, 0, "FAKE_SHA1", None, "FILE"), connector.remoteIndex.find("FAKE_FOLDER/renamed/a.txt"))
+                self.assertTrue(connector.remoteIndex.getDeltaLink("FAKE_FOLDER").endswith("token=latest"))
+            except ConnectorException as e:
+                self.fail(
+                    "__syncRemoteIndex() raised a ConnectorException: " + str(e))
+
+    def test_upload_small_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "small file.txt")
+            with open(path, "wb") as f:
+                f.write(b"FAKE_CONTENT")
+            with requests_mock.Mocker() as m:
+                m.register_uri('PUT', '/v1.0/drive/root:/small%20file.txt:/content',
+                               text=json.dumps({"id": "000000-000000-000000"}))
+                try:
+                    connector = Connector()
+                    connector.chunkSize = "1"
+                    self.assertEqual("Upload completed with 1 chunk(s)", connector.upload(path))
+                    self.assertEqual(1, m.call_count)
+                    self.assertEqual(b"FAKE_CONTENT", m.request_history[0].body)
+                except ConnectorException as e:
+                    self.fail("upload() raised a ConnectorException: " + str(e))
+
+    def test_create_existing_folder(self):
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST', '/v1.0/drive/root/children', status_code=409,
+                           text=json.dumps({"error": {"code": "nameAlreadyExists"}}))
+            m.register_uri('GET', '/v1.0/drive/root:/FAKE_FOLDER',
+                           text=json.dumps({"id": "000000-000000-000000", "name": "FAKE_FOLDER"}))
+            try:
+                connector = Connector()
+                folder = connector._Connector__createFolder("FAKE_FOLDER")
+                self.assertEqual("FAKE_FOLDER", folder)
+                self.assertEqual("000000-000000-000000", connector.folderIds["FAKE_FOLDER"])
+            except ConnectorException as e:
+                self.fail(
+                    "__createFolder() raised a ConnectorException: " + str(e))
+
+    def test_retry_throttled_request(self):
+        expected_result = {
+            "uploadUrl": "https://sn1234.up.1drv.com/up/fakeurl",
+            "expirationDateTime": "2021-01-01T00:00:00.000Z"
+        }
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST', '/v1.0/drive/root:/fakefile:/createUploadSession', [
+                {"status_code": 429, "headers": {"Retry-After": "0"},
+                 "text": json.dumps({"error": {"code": "activityLimitReached"}})},
+                {"exc": requests.exceptions.ConnectionError},
+                {"status_code": 502, "text": "Bad Gateway"},
+                {"text": json.dumps(expected_result)}])
+            try:
+                connector = Connector()
+                connector.retryPolicy.base = 0
+                url = connector._Connector__getUploadUrl("fakefile")
+                self.assertEqual("https://sn1234.up.1drv.com/up/fakeurl", url)
+                self.assertEqual(4, m.call_count)
+                self.assertLess(connector.concurrency.limit, connector.concurrency.maximum)
+            except ConnectorException as e:
+                self.fail(
+                    "__getUploadUrl() raised a ConnectorException: " + str(e))
+        self.assertEqual(3, RetryPolicy.parseRetryAfter(3))
+        self.assertIsNone(RetryPolicy.parseRetryAfter("1.5"))
+        self.assertIsNone(RetryPolicy.parseRetryAfter("Wed, 21 Oct 2015 07:28:00 GMT"))
+
+    def test_recover_failed_chunk(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "recovered.txt")
+            with open(path, "wb") as f:
+                f.write(b"FAKE_CONTENT")
+            with requests_mock.Mocker() as m:
+                m.register_uri('POST', '/v1.0/drive/root:/recovered.txt:/createUploadSession',
+                               text=json.dumps({"uploadUrl": "https://sn1234.up.1drv.com/up/recoveredurl",
+                                                "expirationDateTime": "2999-01-01T00:00:00.000Z"}))
+                m.register_uri('PUT', 'https://sn1234.up.1drv.com/up/recoveredurl', [
+                    {"status_code": 416, "text": json.dumps({"error": {"code": "invalidRange"}})},
+                    {"text": json.dumps({"id": "000000-000000-000000"})}])
+                m.register_uri('GET', 'https://sn1234.up.1drv.com/up/recoveredurl',
+                               text=json.dumps({"nextExpectedRanges": ["6-"]}))
+                try:
+                    connector = Connector()
+                    connector.chunkSize = "1"
+                    connector.smallFileSize = "0"
+                    connector.upload(path)
+                    self.assertEqual("bytes 6-11/12", m.request_history[-1].headers["Content-Range"])
+                except ConnectorException as e:
+                    self.fail("upload() raised a ConnectorException: " + str(e))
+
+    def test_upload_mapped_chunks(self):
+        content = os.urandom(1024 * 1024 * 2 + 1000)
+        received = []
+
+        def put_callback(request, context):
+            self.assertIsInstance(request.body, memoryview)
+            received.append(bytes(request.body))
+            return json.dumps({"id": "000000-000000-000000"})
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "mapped.bin")
+            with open(path, "wb") as f:
+                f.write(content)
+            with requests_mock.Mocker() as m:
+                m.register_uri('POST', '/v1.0/drive/root:/mapped.bin:/createUploadSession',
+                               text=json.dumps({"uploadUrl": "https://sn1234.up.1drv.com/up/mappedurl",
+                                                "expirationDateTime": "2999-01-01T00:00:00.000Z"}))
+                m.register_uri('PUT', 'https://sn1234.up.1drv.com/up/mappedurl', text=put_callback)
+                try:
+                    connector = Connector()
+                    connector.chunkSize = "1"
+                    connector.smallFileSize = "0"
+                    connector.adaptiveChunks = "false"
+                    self.assertEqual("Upload completed with 3 chunk(s)", connector.upload(path))
+                    self.assertEqual(content, b"".join(received))
+                except ConnectorException as e:
+                    self.fail("upload() raised a ConnectorException: " + str(e))
+
+    def test_pipelined_upload(self):
+        content = os.urandom(1024 * 1024 * 2 + 1000)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "pipelined.bin")
+            with open(path, "wb") as f:
+                f.write(content)
+            with requests_mock.Mocker() as m:
+                m.register_uri('POST', '/v1.0/drive/root:/pipelined.bin:/createUploadSession',
+                               text=json.dumps({"uploadUrl": "https://sn1234.up.1drv.com/up/pipelinedurl",
+                                                "expirationDateTime": "2999-01-01T00:00:00.000Z"}))
+                m.register_uri('PUT', 'https://sn1234.up.1drv.com/up/pipelinedurl', [
+                    {"status_code": 202, "text": json.dumps({"nextExpectedRanges": ["900000-"]})},
+                    {"status_code": 202, "text": json.dumps({"nextExpectedRanges": ["1883040-"]})},
+                    {"text": json.dumps({"id": "000000-000000-000000"})}])
+                try:
+                    connector = Connector()
+                    connector.chunkSize = "1"
+                    connector.smallFileSize = "0"
+                    connector.adaptiveChunks = "false"
+                    connector.incremental = "true"
+                    self.assertEqual("Upload completed with 3 chunk(s)", connector.upload(path))
+                    ranges = [h.headers["Content-Range"] for h in m.request_history if h.method == "PUT"]
+                    self.assertEqual(["bytes 0-983039/2098152", "bytes 900000-1883039/2098152",
+                                      "bytes 1883040-2098151/2098152"], ranges)
+                    entry = connector.manifest.find(path, "pipelined.bin")
+                    self.assertEqual(hashlib.sha1(content).hexdigest(), entry[2])
+                except ConnectorException as e:
+                    self.fail("upload() raised a ConnectorException: " + str(e))
+
+    def test_chunk_sizer(self):
+        sizer = ChunkSizer(1024 * 1024, True)
+        self.assertEqual(983040, sizer.size)
+        sizer.onSuccess(sizer.size, 0.01)
+        self.assertEqual(983040 * 2, sizer.size)
+        sizer.onSuccess(sizer.size, 60)
+        self.assertEqual(983040, sizer.size)
+        sizer.onFailure()
+        self.assertEqual(327680, sizer.size)
+        self.assertEqual(ChunkSizer.MAXIMUM, ChunkSizer.align(100 * 1024 * 1024))
+        self.assertEqual(0, ChunkSizer.MAXIMUM % ChunkSizer.UNIT)
+
+    def test_async_upload_directory(self):
+        async def run(tmp):
+            with aioresponses() as m:
+                m.post('https://graph.microsoft.com/v1.0/drive/root/children', repeat=True,
+                       payload={"id": "ID_ROOT", "name": os.path.basename(tmp)})
+                m.post('https://graph.microsoft.com/v1.0/drive/items/ID_ROOT/children',
+                       payload={"id": "ID_SUB", "name": "sub"})
+                m.post(re.compile(r"https://graph.microsoft.com/v1.0/drive/root:/.*:/createUploadSession"), repeat=True,
+                       payload={"uploadUrl": "https://sn1234.up.1drv.com/up/asyncurl"})
+                m.put('https://sn1234.up.1drv.com/up/asyncurl', repeat=True, payload={"id": "000000-000000-000000"})
+                async with AsyncConnector() as connector:
+                    connector.chunkSize = "1"
+                    connector.smallFileSize = "0"
+                    result = await connector.upload(tmp)
+                    return result, m.requests
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(os.path.join(tmp, "sub"))
+            for name in ["a.txt", "b.txt", os.path.join("sub", "c.txt")]:
+                with open(os.path.join(tmp, name), "wb") as f:
+                    f.write(b"FAKE_CONTENT")
+            try:
+                result, requests = asyncio.run(run(tmp))
+                self.assertEqual(3, len(result.uploaded))
+                self.assertTrue(result.ok)
+                self.assertEqual(3, len([key for key in requests for call in requests[key] if key[0] == "PUT"]))
+            except ConnectorException as e:
+                self.fail("upload() raised a ConnectorException: " + str(e))
+
+    def test_async_throttled_request(self):
+        async def run(path):
+            with aioresponses() as m:
+                for attempt in range(3):
+                    m.post('https://graph.microsoft.com/v1.0/drive/root:/throttled.txt:/createUploadSession', status=429,
+                           headers={"Retry-After": "0"}, payload={"error": {"code": "activityLimitReached"}})
+                m.post('https://graph.microsoft.com/v1.0/drive/root:/throttled.txt:/createUploadSession',
+                       payload={"uploadUrl": "https://sn1234.up.1drv.com/up/throttledurl"})
+                m.put('https://sn1234.up.1drv.com/up/throttledurl', payload={"id": "000000-000000-000000"})
+                async with AsyncConnector() as connector:
+                    connector.chunkSize = "1"
+                    connector.smallFileSize = "0"
+                    message = await connector.upload(path)
+                    return message, connector.asyncConcurrency
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "throttled.txt")
+            with open(path, "wb") as f:
+                f.write(b"FAKE_CONTENT")
+            try:
+                message, concurrency = asyncio.run(run(path))
+                self.assertEqual("Upload completed with 1 chunk(s)", message)
+                self.assertLess(concurrency.limit, concurrency.maximum)
+                self.assertEqual(0, concurrency.active)
+            except ConnectorException as e:
+                self.fail("upload() raised a ConnectorException: " + str(e))
+
+    def test_async_accounts(self):
+        async def run(env, paths):
+            with aioresponses() as m:
+                m.post(re.compile(r"https://graph.microsoft.com/v1.0/drive/root:/.*:/createUploadSession"), repeat=True,
+                       payload={"uploadUrl": "https://sn1234.up.1drv.com/up/accounturl"})
+                m.put('https://sn1234.up.1drv.com/up/accounturl', repeat=True, payload={"id": "000000-000000-000000"})
+                async with AsyncConnector(env) as first, AsyncConnector(env, first) as second:
+                    messages = await asyncio.gather(first.upload(paths[0]), second.upload(paths[1]))
+                    self.assertIs(first.client, second.client)
+                    self.assertIs(first.asyncConcurrency, second.asyncConcurrency)
+                    self.assertIs(first.tokenManager, second.tokenManager)
+                    self.assertIs(first.journal, second.journal)
+                    self.assertEqual(Connector.getStoreFolder(env), second.storeFolder)
+                    tokens = {call.kwargs["headers"]["Authorization"] for key in m.requests for call in m.requests[key]
+                              if key[0] == "POST"}
+                    return messages, tokens, first.client
+        with tempfile.TemporaryDirectory() as tmp:
+            env = self.write_env(os.path.join(tmp, "async.env"), SMALLFILE="0", ACCESSTOKEN="ASYNC_TOKEN")
+            paths = [os.path.join(tmp, name) for name in ["one.txt", "two.txt"]]
+            for path in paths:
+                with open(path, "wb") as f:
+                    f.write(b"FAKE_CONTENT")
+            try:
+                messages, tokens, client = asyncio.run(run(env, paths))
+                self.assertEqual(["Upload completed with 1 chunk(s)"] * 2, messages)
+                self.assertEqual({"Bearer ASYNC_TOKEN"}, tokens)
+                self.assertTrue(client.closed)
+            except ConnectorException as e:
+                self.fail("upload() raised a ConnectorException: " + str(e))
+
+    def test_async_renew_token(self):
+        async def run(path):
+            with aioresponses() as m:
+                m.post('https://graph.microsoft.com/v1.0/drive/root:/renew.txt:/createUploadSession', status=401,
+                       payload={"error": {"code": "InvalidAuthenticationToken"}})
+                m.post('https://graph.microsoft.com/v1.0/drive/root:/renew.txt:/createUploadSession',
+                       payload={"uploadUrl": "https://sn1234.up.1drv.com/up/renewurl"})
+                m.put('https://sn1234.up.1drv.com/up/renewurl', payload={"id": "000000-000000-000000"})
+                async with AsyncConnector() as connector:
+                    connector.chunkSize = "1"
+                    connector.smallFileSize = "0"
+                    connector.tokenManager.save = lambda: None
+                    connector.incremental = "true"
+                    message = await connector.upload(path)
+                    self.assertEqual(hashlib.sha1(b"FAKE_CONTENT").hexdigest(), connector.manifest.find(path, "renew.txt")[2])
+                    return message, connector.token, connector.refreshToken
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "renew.txt")
+            with open(path, "wb") as f:
+                f.write(b"FAKE_CONTENT")
+            try:
+                with requests_mock.Mocker() as m:
+                    m.register_uri('POST', '/common/oauth2/v2.0/token',
+                                   text=json.dumps({"access_token": "NEW_ACCESSTOKEN", "refresh_token": "NEW_REFRESHTOKEN"}))
+                    message, token, refreshToken = asyncio.run(run(path))
+                self.assertEqual("Upload completed with 1 chunk(s)", message)
+                self.assertEqual("NEW_ACCESSTOKEN", token)
+                self.assertEqual("NEW_REFRESHTOKEN", refreshToken)
+            except ConnectorException as e:
+                self.fail("upload() raised a ConnectorException: " + str(e))
+
+    def test_refresh_token_ahead(self):
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST', '/common/oauth2/v2.0/token', text=json.dumps({
+                "expires_in": 3600, "access_token": "NEW_ACCESSTOKEN", "refresh_token": "NEW_REFRESHTOKEN"}))
+            try:
+                connector = Connector()
+                saved = []
+                connector.tokenManager.save = lambda: saved.append(connector.refreshToken)
+                connector.tokenManager.expiresAt = time.time() + 60
+                token = connector.tokenManager.accessToken
+                connector.token
+                connector.tokenManager.refresh(token)
+                connector.tokenManager.flush()
+                self.assertEqual(1, m.call_count)
+                self.assertIn("refresh_token=FAKE_REFRESHTOKEN", m.request_history[0].text)
+                self.assertEqual("NEW_ACCESSTOKEN", connector.token)
+                self.assertEqual("NEW_REFRESHTOKEN", connector.refreshToken)
+                self.assertEqual(["NEW_REFRESHTOKEN"], saved)
+                self.assertGreater(connector.tokenManager.expiresAt, time.time() + 3000)
+
+                # A refresh shared by the connectors of the same account counts once
+                shared = Connector(account=connector)
+                shared.telemetry = connector.telemetry
+                connector.tokenManager.refresh()
+                connector.tokenManager.flush()
+                self.assertEqual(2, connector.telemetry.counters["token_refreshes_total"])
+                connector.close()
+                self.assertEqual([], connector.tokenManager.listeners)
+            except ConnectorException as e:
+                self.fail("refresh() raised a ConnectorException: " + str(e))
+
+    def test_job_runner(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for account in ["alpha", "beta"]:
+                self.write_env(os.path.join(tmp, account + ".env"), SMALLFILE="0", BATCHING="false",
+                               ACCESSTOKEN=account.upper() + "_TOKEN", REFRESHTOKEN=account.upper() + "_REFRESH")
+            for name in ["one.txt", "two.txt", "three.txt"]:
+                with open(os.path.join(tmp, name), "wb") as f:
+                    f.write(b"FAKE_CONTENT")
+            jobs = [
+                {"account": os.path.join(tmp, "alpha.env"), "source": os.path.join(tmp, "one.txt"),
+                 "destination": "Backups/A"},
+                {"account": os.path.join(tmp, "alpha.env"), "source": os.path.join(tmp, "two.txt")},
+                {"account": os.path.join(tmp, "beta.env"), "source": os.path.join(tmp, "three.txt"), "destination": "B"}
+            ]
+            cwd = os.getcwd()
+            with requests_mock.Mocker() as m:
+                m.register_uri('POST', re.compile(r"/v1.0/drive/(root|items/\w+)/children"),
+                               json=lambda request, context: {"id": "ID_" + request.json()["name"],
+                                                              "name": request.json()["name"]})
+                m.register_uri('POST', re.compile(r"/v1.0/drive/root:/.*:/createUploadSession"),
+                               json={"uploadUrl": "https://sn1234.up.1drv.com/up/joburl"})
+                m.register_uri('PUT', 'https://sn1234.up.1drv.com/up/joburl',
+                               text=json.dumps({"id": "000000-000000-000000"}))
+                try:
+                    runner = JobRunner(jobs)
+                    results = runner.run()
+                    self.assertEqual(["Upload completed with 1 chunk(s)"] * 3, results)
+                    self.assertEqual(cwd, os.getcwd())
+                    sessions = {h.path: h.headers["Authorization"] for h in m.request_history
+                                if h.method == "POST" and h.path.endswith("createuploadsession")}
+                    self.assertEqual({"/v1.0/drive/root:/backups/a/one.txt:/createuploadsession": "Bearer ALPHA_TOKEN",
+                                      "/v1.0/drive/root:/two.txt:/createuploadsession": "Bearer ALPHA_TOKEN",
+                                      "/v1.0/drive/root:/b/three.txt:/createuploadsession": "Bearer BETA_TOKEN"}, sessions)
+                    folders = [h.json()["name"] for h in m.request_history if h.path.endswith("/children")]
+                    self.assertEqual(["A", "B", "Backups"], sorted(folders))
+                except ConnectorException as e:
+                    self.fail("run() raised a ConnectorException: " + str(e))
+
+            # Files with the same name in different folders are different accounts, with stores of their own
+            for account in ["alice", "bob"]:
+                os.makedirs(os.path.join(tmp, account))
+                self.write_env(os.path.join(tmp, account, ".env"))
+            stores = {Connector(os.path.join(tmp, account, ".env")).storeFolder for account in ["alice", "bob"]}
+            self.assertEqual(2, len(stores))
+            getStoreFolder = Connector.getStoreFolder
+            self.addCleanup(shutil.rmtree, getStoreFolder(os.path.join(tmp, ".env")), ignore_errors=True)
+            Connector.getStoreFolder = staticmethod(lambda envFile="": getStoreFolder(os.path.join(tmp, ".env")))
+            try:
+                runner = JobRunner([{"account": os.path.join(tmp, account, ".env"), "source": "unused"}
+                                    for account in ["alice", "bob"]])
+                self.assertRaisesRegex(ConnectorException, "same local stores", runner.run)
+            finally:
+                Connector.getStoreFolder = getStoreFolder
+
+    def test_bandwidth_limiter(self):
+        shared = BandwidthLimiter(1024 * 1024)
+        limiter = BandwidthLimiter(0, parent=shared)
+        self.assertTrue(limiter.isLimited())
+        self.assertAlmostEqual(0.5, limiter.reserve(512 * 1024), places=1)
+        self.assertAlmostEqual(1.0, limiter.reserve(512 * 1024), places=1)
+        shared.configure(0)
+        self.assertFalse(limiter.isLimited())
+        self.assertEqual(0, limiter.reserve(512 * 1024))
+        schedule = BandwidthLimiter.parseSchedule("08:00-18:00=512, 22:00-06:00=4096")
+        self.assertEqual([(480, 1080, 524288), (1320, 360, 4194304)], schedule)
+        limiter.configure(0, [(0, 0, 2048)])
+        self.assertEqual(2048, limiter.getRate())
+        self.assertRaises(ValueError, BandwidthLimiter.parseSchedule, "25:00-06:00=512")
+
+    def test_throttled_upload(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "throttled.bin")
+            content = os.urandom(600000)
+            with open(path, "wb") as f:
+                f.write(content)
+            with requests_mock.Mocker() as m:
+                m.register_uri('POST', '/v1.0/drive/root:/throttled.bin:/createUploadSession',
+                               text=json.dumps({"uploadUrl": "https://sn1234.up.1drv.com/up/throttledurl"}))
+                sent = []
+
+                def receive(request, context):
+                    sent.extend(bytes(piece) for piece in request.body)
+                    return json.dumps({"id": "000000-000000-000000"})
+                m.register_uri('PUT', 'https://sn1234.up.1drv.com/up/throttledurl', text=receive)
+                try:
+                    connector = Connector()
+                    connector.chunkSize = "1"
+                    connector.smallFileSize = "0"
+                    connector.bandwidth.configure(1024 * 1024 * 1024)
+                    self.assertEqual("Upload completed with 1 chunk(s)", connector.upload(path))
+                    self.assertIsInstance(m.request_history[-1].body, ThrottledBody)
+                    self.assertEqual("600000", m.request_history[-1].headers["Content-Length"])
+                    self.assertEqual([262144, 262144, 75712], [len(piece) for piece in sent])
+                    self.assertEqual(content, b"".join(sent))
+                except ConnectorException as e:
+                    self.fail("upload() raised a ConnectorException: " + str(e))
+
+    def test_fake_graph_server(self):
+        with tempfile.TemporaryDirectory() as tmp, \
+                FakeGraphServer(throttleRate=0.1, failureRate=0.05, accessToken="CURRENT_TOKEN") as server:
+            env = self.write_env(os.path.join(tmp, "fake_" + os.path.basename(tmp) + ".env"), server,
+                                 ACCESSTOKEN="EXPIRED_TOKEN", INCREMENTAL="true", SMALLFILE="1")
+            source = os.path.join(tmp, "source")
+            os.makedirs(os.path.join(source, "sub"))
+            contents = {"small.txt": b"FAKE_CONTENT", os.path.join("sub", "large.bin"): os.urandom(2500000)}
+            for name, content in contents.items():
+                with open(os.path.join(source, name), "wb") as f:
+                    f.write(content)
+            try:
+                connector = Connector(env)
+                result = connector.upload(source, "Backups")
+                connector.tokenManager.flush()
+                connector.close()
+                self.assertIsNone(connector.hasher.executor)
+                self.assertTrue(result.ok)
+                self.assertEqual(2, len(result.uploaded))
+                self.assertEqual(1, server.count("tokens"))
+                for name, content in contents.items():
+                    item = server.find("Backups/source/" + name.replace(os.sep, "/"))
+                    self.assertEqual(len(content), item["size"])
+                    self.assertEqual(hashlib.sha1(content).hexdigest(), item["sha1"])
+                result = Connector(env).upload(source, "Backups")
+                self.assertEqual(2, len(result.skipped))
+            except ConnectorException as e:
+                self.fail("upload() raised a ConnectorException: " + str(e))
+
+    def test_telemetry(self):
+        with tempfile.TemporaryDirectory() as tmp, FakeGraphServer(throttleRate=0.2, seed=1) as server:
+            env = self.write_env(os.path.join(tmp, "telemetry_" + os.path.basename(tmp) + ".env"), server,
+                                 SMALLFILE="1", METRICSFILE=os.path.join(tmp, "metrics.json"))
+            source = os.path.join(tmp, "source")
+            os.makedirs(source)
+            for name, size in (("small.txt", 100), ("large.bin", 2500000)):
+                with open(os.path.join(source, name), "wb") as f:
+                    f.write(os.urandom(size))
+            events = []
+            try:
+                connector = Connector(env)
+                connector.telemetry.on("fileCompleted", lambda path: events.append(path))
+                connector.telemetry.on("chunkSent", lambda **chunk: 1 / 0)
+                self.assertTrue(connector.upload(source).ok)
+                self.assertEqual(2, len(events))
+                metrics = connector.telemetry.toPrometheus()
+                self.assertIn("onedrive_connector_bytes_sent_total 2500100\n", metrics)
+                self.assertIn("onedrive_connector_files_uploaded_total 2\n", metrics)
+                self.assertRegex(metrics, r'onedrive_connector_request_seconds_bucket\{le="\+Inf"\} [1-9]')
+                with open(os.path.join(tmp, "metrics.json")) as f:
+                    exported = json.load(f)
+                self.assertEqual(exported["counters"]["retries_total"], exported["counters"]["throttle_events_total"])
+                self.assertEqual(server.count("throttled"), exported["counters"]["throttle_events_total"])
+                self.assertEqual(0, exported["progress"]["eta"])
+            except ConnectorException as e:
+                self.fail("upload() raised a ConnectorException: " + str(e))
+
+    def test_lazy_logging(self):
+        connector = Connector()
+        self.assertEqual(1, sum(isinstance(handler, QueueHandler) for handler in connector.logger.parent.handlers))
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        level = connector.logger.level
+        connector.logger.addHandler(handler)
+        try:
+            connector.logger.setLevel(logging.INFO)
+            connector._logResponse(200, lambda: 1 / 0)
+            self.assertEqual([], records)
+            connector.logger.setLevel(logging.DEBUG)
+            connector._logResponse(200, "A" * 5000)
+            self.assertEqual("Response received: 200 " + "A" * 1024 + "... (3976 more characters)",
+                             records[0].getMessage())
+        finally:
+            connector.logger.removeHandler(handler)
+            connector.logger.setLevel(level)
+
+        # Every account logs at its own level
+        with tempfile.TemporaryDirectory() as tmp:
+            verbose = Connector(self.write_env(os.path.join(tmp, "verbose.env"), LOGLEVEL="DEBUG"))
+            quiet = Connector(self.write_env(os.path.join(tmp, "quiet.env"), LOGLEVEL="ERROR"))
+            self.assertTrue(verbose.logger.isEnabledFor(logging.DEBUG))
+            self.assertFalse(quiet.logger.isEnabledFor(logging.INFO))
+            self.assertIs(verbose.logger, Connector(account=verbose, envFile=verbose.envFile).logger)
+
+    def test_scan_and_hash(self):
+        self.assertEqual("AAAAAAAAAAAAAAAAAAAAAAAAAAA=", QuickXorHash().base64Digest())
+        self.assertEqual("SgAAAAAAAAAAAAAAAQAAAAAAAAA=", QuickXorHash(b"J").base64Digest())
+        with tempfile.TemporaryDirectory() as tmp:
+            contents = {os.path.join("a", "b", "large.bin"): os.urandom(3000000), "small.txt": b"FAKE_CONTENT"}
+            for name, content in contents.items():
+                os.makedirs(os.path.dirname(os.path.join(tmp, name)), exist_ok=True)
+                with open(os.path.join(tmp, name), "wb") as f:
+                    f.write(content)
+            found = {os.path.join(root, name): stat.st_size for root, files in FileScanner(tmp, 2) for name, stat in files}
+            self.assertEqual({os.path.join(tmp, name): len(content) for name, content in contents.items()}, found)
+            connector = Connector(self.write_env(os.path.join(tmp, "hash.env")))
+            self.addCleanup(connector.close)
+            hasher = FileHasher(1, connector.fileIndex)
+            try:
+                for name, content in contents.items():
+                    path = os.path.join(tmp, name)
+                    hasher.schedule(path, os.stat(path), True)
+                    digests = (hashlib.sha1(content).hexdigest(), QuickXorHash(content).base64Digest())
+                    self.assertEqual(digests, hasher.hash(path, True))
+                    self.assertEqual(digests, connector.fileIndex.find(path)[2:])
+            finally:
+                hasher.close()
+            self.assertEqual(sorted(found), [entry[0] for entry in connector.fileIndex.list(tmp)])
+            connector.incremental = "true"
+            connector.remoteIndex.applyPage("FAKE_QUICKXOR", [
+                {"id": "FAKE_QUICKXOR", "name": "small.txt", "size": 12, "parentReference": {"id": "NONE"},
+                 "file": {"hashes": {"quickXorHash": QuickXorHash(b"FAKE_CONTENT").base64Digest()}}}])
+            self.assertTrue(connector._isUnchanged(os.path.join(tmp, "small.txt"), "FAKE_QUICKXOR"))
+
+    def test_small_file_packing(self):
+        with tempfile.TemporaryDirectory() as tmp, FakeGraphServer() as server:
+            source = os.path.join(tmp, "source")
+            os.makedirs(os.path.join(source, "sub"))
+            contents = {os.path.join("sub", "file" + str(index) + ".log"): os.urandom(index * 7) for index in range(300)}
+            contents["large.bin"] = os.urandom(2500000)
+            for name, content in contents.items():
+                with open(os.path.join(source, name), "wb") as f:
+                    f.write(content)
+
+            # Every file can be found in a bundle by the offset given by its index
+            packer = BundlePacker("Backups/source/", 1024, 50000)
+            bundles = [packer.add(os.path.join(source, name), "Backups/source/" + name, os.stat(os.path.join(source, name)))
+                       for name in contents if name != "large.bin"] + [packer.close()]
+            bundles = [bundle for bundle in bundles if bundle is not None]
+            self.assertEqual(11, len(bundles))
+            self.assertNotEqual(packer.prefix, BundlePacker("Backups/source/", 1024, 50000).prefix)
+            for bundle in bundles:
+                with bundle["data"] as data, tarfile.open(fileobj=io.BytesIO(data), mode="r:") as archive:
+                    for entry in json.loads(bundle["index"])["files"]:
+                        content = contents[entry["path"].replace("/", os.sep)]
+                        self.assertEqual(content, archive.extractfile(entry["path"]).read())
+                        self.assertEqual(content, data[entry["offset"]:entry["offset"] + entry["size"]])
+
+            # Small files are uploaded in a single compressed bundle, next to its index, the others on their own
+            env = self.write_env(os.path.join(tmp, "packing_" + os.path.basename(tmp) + ".env"), server, SMALLFILE="0",
+                                 INCREMENTAL="true", PACKSIZE="4", BUNDLESIZE="1", PACKCOMPRESSION="true")
+            try:
+                result = Connector(env).upload(source)
+                self.assertTrue(result.ok)
+                self.assertEqual(301, len(result.uploaded))
+                self.assertLess(server.count("requests"), 20)
+                names = sorted(path for path in server.paths if path.startswith("source/bundle-"))
+                self.assertEqual(2, len(names))
+                self.assertTrue(names[0].endswith(".tar.gz") and names[1] == names[0] + ".index.json")
+                self.assertIsNone(server.find("source/sub/file1.log"))
+                self.assertIsNone(server.find("source/sub"))
+                self.assertEqual(2500000, server.find("source/large.bin")["size"])
+                self.assertEqual(301, len(Connector(env).upload(source).skipped))
+            except ConnectorException as e:
+                self.fail("upload() raised a ConnectorException: " + str(e))